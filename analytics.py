@@ -0,0 +1,219 @@
+"""Incremental analytics: per-camera, per-class rollups and detection heatmaps
+
+Each processed frame updates, in O(detections):
+
+- minute and hour buckets per (camera, class): detections seen and the peak
+  number seen in a single frame, plus frames processed per camera
+- a heatmap per (camera, class): a small NumPy grid accumulating the
+  bottom-centre of every box, in frame-relative coordinates
+
+Dashboards read these directly instead of rescanning raw detections or
+re-running video. A background thread checkpoints everything to one .npz
+file every CHECKPOINT_INTERVAL seconds, and it is reloaded on start. The
+rollups (as JSON) and the heatmaps are written together to a temporary file
+that then replaces the checkpoint, so a crash never leaves them out of step.
+Each app keeps its own checkpoint file (see get_analytics).
+"""
+import atexit
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from cameras import DEFAULT_CAMERA
+
+ANALYTICS_PATH = os.environ.get('ANALYTICS_PATH', 'analytics.npz')
+CHECKPOINT_INTERVAL = float(os.environ.get('ANALYTICS_CHECKPOINT_INTERVAL', 60))
+# Heatmap grid (rows, columns)
+HEATMAP_SIZE = (36, 64)
+# Bucket sizes in seconds, and how many of the newest buckets each series keeps
+GRANULARITIES = {'minute': 60, 'hour': 3600}
+RETENTION = {'minute': 24 * 60, 'hour': 90 * 24}
+
+
+class Analytics:
+    """Rollups and heatmaps updated frame by frame, checkpointed to disk"""
+
+    def __init__(self, path=ANALYTICS_PATH, checkpoint_interval=CHECKPOINT_INTERVAL):
+        self.path = path
+        self.checkpoint_interval = checkpoint_interval
+        # granularity -> camera -> class -> {bucket start: [detections, peak per frame]}
+        self._counts = {granularity: {} for granularity in GRANULARITIES}
+        # granularity -> camera -> {bucket start: frames}
+        self._frames = {granularity: {} for granularity in GRANULARITIES}
+        # (camera, class) -> float32 grid
+        self._heatmaps = {}
+        self._lock = threading.Lock()
+        # Held while writing files, so the periodic and the final checkpoint never interleave
+        self._checkpoint_lock = threading.Lock()
+        self._dirty = False
+        self.checkpoints = 0
+        self.checkpoint_time = 0.0
+        self.load()
+
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._checkpoint_loop, name='analytics-checkpoint', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def update(self, camera, dets, names, ts, frame_shape):
+        """Fold one processed frame's (N, 6) detections into the rollups and heatmaps"""
+        camera = camera or DEFAULT_CAMERA
+        height, width = frame_shape[:2]
+        classes = dets[:, 5].astype(np.int64)
+        # Bottom-centre of each box on the heatmap grid
+        rows = np.clip((dets[:, 3] / height * HEATMAP_SIZE[0]).astype(np.int64), 0, HEATMAP_SIZE[0] - 1)
+        cols = np.clip(((dets[:, 0] + dets[:, 2]) / 2 / width * HEATMAP_SIZE[1]).astype(np.int64), 0, HEATMAP_SIZE[1] - 1)
+        per_class = {int(cls): int(n) for cls, n in zip(*np.unique(classes, return_counts=True))}
+
+        with self._lock:
+            for granularity, size in GRANULARITIES.items():
+                bucket = int(ts // size) * size
+                frames = self._frames[granularity].setdefault(camera, {})
+                frames[bucket] = frames.get(bucket, 0) + 1
+                counts = self._counts[granularity].setdefault(camera, {})
+                for cls, n in per_class.items():
+                    entry = counts.setdefault(names[cls], {}).setdefault(bucket, [0, 0])
+                    entry[0] += n
+                    entry[1] = max(entry[1], n)
+            for cls in per_class:
+                key = (camera, names[cls])
+                heatmap = self._heatmaps.get(key)
+                if heatmap is None:
+                    heatmap = self._heatmaps[key] = np.zeros(HEATMAP_SIZE, dtype=np.float32)
+                mask = classes == cls
+                np.add.at(heatmap, (rows[mask], cols[mask]), 1.0)
+            self._dirty = True
+
+    def rollup(self, camera=None, cls=None, granularity='minute', since=None):
+        """Buckets with detections, per-frame peak and frames processed, per camera and class"""
+        result = []
+        with self._lock:
+            for cam, classes in self._counts[granularity].items():
+                if camera is not None and cam != camera:
+                    continue
+                frames = self._frames[granularity].get(cam, {})
+                for name, buckets in classes.items():
+                    if cls is not None and name != cls:
+                        continue
+                    result.append({
+                        'camera': cam,
+                        'class': name,
+                        'buckets': [{'bucket': bucket, 'detections': count, 'peak': peak, 'frames': frames.get(bucket, 0)}
+                                    for bucket, (count, peak) in sorted(buckets.items())
+                                    if since is None or bucket >= since]
+                    })
+        return result
+
+    def heatmap(self, camera=None, cls=None):
+        """Accumulated grid for a camera (all classes unless cls is given); None if nothing matches"""
+        camera = camera or DEFAULT_CAMERA
+        with self._lock:
+            grids = [grid for (cam, name), grid in self._heatmaps.items()
+                     if cam == camera and (cls is None or name == cls)]
+            return np.sum(grids, axis=0) if grids else None
+
+    def _prune(self):
+        """Drop the oldest buckets beyond each granularity's retention (caller holds the lock)"""
+        for granularity, size in GRANULARITIES.items():
+            newest = max((max(frames) for frames in self._frames[granularity].values() if frames), default=0)
+            oldest = newest - RETENTION[granularity] * size
+            for frames in self._frames[granularity].values():
+                for bucket in [bucket for bucket in frames if bucket < oldest]:
+                    del frames[bucket]
+            for classes in self._counts[granularity].values():
+                for buckets in classes.values():
+                    for bucket in [bucket for bucket in buckets if bucket < oldest]:
+                        del buckets[bucket]
+
+    def checkpoint(self):
+        """Write the rollups (JSON) and heatmaps to one .npz file, replacing the previous checkpoint atomically"""
+        start_time = time.perf_counter()
+        with self._lock:
+            self._prune()
+            keys = list(self._heatmaps)
+            state = {
+                'counts': self._counts,
+                'frames': self._frames,
+                'heatmap_keys': [list(key) for key in keys]
+            }
+            # Serialise while holding the lock so the snapshot is consistent
+            payload = json.dumps(state)
+            grids = np.stack([self._heatmaps[key] for key in keys]) if keys else np.zeros((0,) + HEATMAP_SIZE, np.float32)
+            self._dirty = False
+
+        with self._checkpoint_lock:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(self.path + '.tmp', 'wb') as f:
+                np.savez(f, state=np.array(payload), heatmaps=grids)
+            os.replace(self.path + '.tmp', self.path)
+            self.checkpoints += 1
+            self.checkpoint_time += time.perf_counter() - start_time
+
+    def load(self):
+        """Restore the last checkpoint, if there is one"""
+        if not os.path.exists(self.path):
+            return
+        try:
+            with np.load(self.path) as data:
+                state = json.loads(str(data['state']))
+                grids = data['heatmaps']
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Error loading analytics checkpoint: {str(e)}")
+            return
+        # JSON object keys are strings; bucket starts are integers
+        for granularity in GRANULARITIES:
+            self._counts[granularity] = {
+                camera: {name: {int(bucket): entry for bucket, entry in buckets.items()} for name, buckets in classes.items()}
+                for camera, classes in state['counts'].get(granularity, {}).items()
+            }
+            self._frames[granularity] = {
+                camera: {int(bucket): n for bucket, n in frames.items()}
+                for camera, frames in state['frames'].get(granularity, {}).items()
+            }
+        if grids.shape[1:] == HEATMAP_SIZE:
+            self._heatmaps = {tuple(key): grid.copy() for key, grid in zip(state['heatmap_keys'], grids)}
+
+    def _checkpoint_loop(self):
+        while not self._stopped.wait(self.checkpoint_interval):
+            if self._dirty:
+                try:
+                    self.checkpoint()
+                except OSError as e:
+                    print(f"Error checkpointing analytics: {str(e)}")
+
+    def stats(self):
+        """Series counts and checkpoint cost"""
+        with self._lock:
+            return {
+                'path': self.path,
+                'series': sum(len(classes) for classes in self._counts['minute'].values()),
+                'heatmaps': len(self._heatmaps),
+                'checkpoints': self.checkpoints,
+                'avg_checkpoint_ms': round(1000 * self.checkpoint_time / self.checkpoints, 2) if self.checkpoints else None,
+                'unsaved_changes': self._dirty
+            }
+
+    def close(self):
+        """Stop the checkpoint thread and write a final checkpoint"""
+        if not self._stopped.is_set():
+            self._stopped.set()
+            if self._dirty:
+                self.checkpoint()
+
+
+_analytics = {}
+_analytics_lock = threading.Lock()
+
+
+def get_analytics(path=ANALYTICS_PATH):
+    """Return the analytics accumulator checkpointed to path, restoring its checkpoint on first use
+
+    Apps pass their own path, so apps running side by side never overwrite each other's checkpoint.
+    """
+    with _analytics_lock:
+        if path not in _analytics:
+            _analytics[path] = Analytics(path)
+        return _analytics[path]
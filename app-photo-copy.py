@@ -1,59 +1,128 @@
-from flask import Flask, request, render_template, jsonify, send_file, Response
-import torch
-import numpy as np
-import cv2
-from PIL import Image
-import io
+# Imported first so the startup timings cover the whole module
+from startup import startup_timer
+from flask import Flask, Blueprint, Response, request, jsonify, send_from_directory, stream_with_context
 import os
 import time
-import base64
 import uuid
-import sys
-import tempfile
+import threading
 from werkzeug.utils import secure_filename
 
-app = Flask(__name__)
+# torch, OpenCV and the helpers built on them are imported where they are used
+from resolution import ResolutionLadder, parse_img_size
+from model_swap import ServedModels
+from routes import shared_routes, request_profile
+from cameras import DEFAULT_CAMERA
+from detection_store import get_store, parse_time
+from uploads import create_upload, get_upload, UploadError, CHUNK_SIZE
+from jobs import create_job, get_job
 
-# Create directories for uploads and results
-os.makedirs('static/uploads', exist_ok=True)
-os.makedirs('static/results', exist_ok=True)
+bp = Blueprint('detector', __name__)
 
 # Model settings
 MODEL_PATH = "cars.pt"
 CONF_THRESHOLD = 0.25
 IOU_THRESHOLD = 0.45
 
-# Global variable for the model
-model = None
+# Refresh the YOLOv5 hub cache on startup (slow; only needed after upgrading YOLOv5)
+FORCE_RELOAD = os.environ.get('FORCE_RELOAD', '0') == '1'
 
-def load_model():
-    """Load the YOLOv5 model with path fix for Windows"""
-    global model
-    if model is None:
-        try:
-            # Fix for the PosixPath issue on Windows
-            import pathlib
-            temp = pathlib.PosixPath
-            pathlib.PosixPath = pathlib.WindowsPath
-            
-            # Force reload to avoid cache issues
-            model = torch.hub.load('ultralytics/yolov5', 'custom', path=MODEL_PATH, force_reload=True)
-            model.conf = CONF_THRESHOLD
-            model.iou = IOU_THRESHOLD
-            
-            print("Model loaded successfully!")
-            return model
-        except Exception as e:
-            print(f"Error loading model: {str(e)}")
-            sys.exit(1)
-    return model
-
-@app.route('/')
+# Multi-process inference: number of worker processes (0 runs the model in-process)
+INFERENCE_WORKERS = int(os.environ.get('INFERENCE_WORKERS', 0))
+# Torch threads per worker or for the in-process model (workers default to an even split of the cores)
+TORCH_THREADS = int(os.environ.get('TORCH_THREADS', 0)) or None
+# Torch inter-op threads (in-process model only; workers use one)
+TORCH_INTEROP_THREADS = int(os.environ.get('TORCH_INTEROP_THREADS', 0)) or None
+
+# Optimized CPU execution: 'fuse' (Conv+BN fusion, channels_last, inference mode), 'trace' (plus
+# TorchScript graphs cached in OPTIMIZED_CACHE_DIR) or 'compile' (plus torch.compile); empty runs eager
+OPTIMIZE = os.environ.get('OPTIMIZE') or None
+
+# Latency SLO (seconds per frame) for the adaptive inference resolution ladder
+LATENCY_SLO = float(os.environ.get('LATENCY_SLO', 0.2))
+
+# Tiled inference for high-resolution frames (enabled per request with tiled=1)
+TILE_SIZE = int(os.environ.get('TILE_SIZE', 640))
+TILE_OVERLAP = float(os.environ.get('TILE_OVERLAP', 0.2))
+# Also merge in a downscaled full-frame pass so objects larger than a tile are found
+TILE_FULL_FRAME = os.environ.get('TILE_FULL_FRAME', '0') == '1'
+
+# Quality-gated distortion correction before inference (per request with preprocess=1/0)
+PREPROCESS = os.environ.get('PREPROCESS', '0') == '1'
+
+# Motion gate: skip inference on frames that barely changed (per request with motion_gate=1/0)
+MOTION_GATE = os.environ.get('MOTION_GATE', '0') == '1'
+MOTION_THRESHOLD = float(os.environ.get('MOTION_THRESHOLD', 0.01))
+MOTION_MAX_INTERVAL = int(os.environ.get('MOTION_MAX_INTERVAL', 30))
+MOTION_METHOD = os.environ.get('MOTION_METHOD', 'diff')
+# Number of recent video jobs whose motion-gate stats are kept
+MAX_TRACKED_JOBS = 100
+
+# Shared scheduler batching frames from all video jobs and live cameras into one forward pass
+BATCH_SCHEDULER = os.environ.get('BATCH_SCHEDULER', '0') == '1'
+SCHEDULER_MAX_BATCH = int(os.environ.get('SCHEDULER_MAX_BATCH', 8))
+
+# Segment-parallel processing of long videos: number of worker processes, each with its own decoder and
+# model (per job with segments=N; 0 or 1 processes the video sequentially in this process)
+VIDEO_SEGMENT_WORKERS = int(os.environ.get('VIDEO_SEGMENT_WORKERS', 0))
+
+# Event clips: short pre/post-roll clips and snapshots in EVENT_DIR when a camera's event rules fire
+# (per job with events=1, and full_output=0 to skip the full-length annotated copy)
+EVENT_CLIPS = os.environ.get('EVENT_CLIPS', '0') == '1'
+
+# Crowd analysis of the person detections: dense clusters, their size, area and density (per request
+# with crowd=1/0; CROWD_CLASSES, CROWD_LINK_DISTANCE, CROWD_MIN_SIZE and CROWD_MIN_DENSITY tune it)
+CROWD_ANALYSIS = os.environ.get('CROWD_ANALYSIS', '0') == '1'
+
+# Persist detections to the SQLite store (DETECTION_DB) for the /detections query API
+STORE_DETECTIONS = os.environ.get('STORE_DETECTIONS', '1') == '1'
+
+# Incremental minute/hour rollups and heatmaps for dashboards, checkpointed to a file of this app's own
+ANALYTICS = os.environ.get('ANALYTICS', '1') == '1'
+ANALYTICS_PATH = os.environ.get('ANALYTICS_PATH', f"analytics-{os.path.splitext(MODEL_PATH)[0]}.npz")
+
+# Model cascade: a small model (e.g. a YOLOv5n export of the same classes) runs on every frame and the
+# main model only where it found something below CASCADE_ESCALATE_BELOW or one of CASCADE_ALERT_CLASSES
+CASCADE_MODEL = os.environ.get('CASCADE_MODEL')
+CASCADE_ESCALATE_BELOW = float(os.environ.get('CASCADE_ESCALATE_BELOW', 0.5))
+CASCADE_FLOOR = float(os.environ.get('CASCADE_FLOOR', 0.1))
+CASCADE_ALERT_CLASSES = tuple(name for name in os.environ.get('CASCADE_ALERT_CLASSES', '').split(',') if name)
+
+# Fused multi-model inference: decode and letterbox each frame once and run these models concurrently on
+# the same tensor (comma-separated, e.g. garbage.pt,cars.pt,best.pt); class names become "model/class"
+FUSED_MODELS = tuple(path for path in os.environ.get('FUSED_MODELS', '').split(',') if path)
+
+# Modules that pull in torch, OpenCV and NumPy; imported by the warm-up thread, not at startup
+HEAVY_IMPORTS = ('inference', 'tiling', 'preprocessing', 'roi', 'analytics', 'motion_gate', 'scheduler', 'fused', 'events', 'crowd')
+
+ladder = ResolutionLadder(LATENCY_SLO)
+# The model or worker pool, the cascade and the fused models, rebuilt together by hot swaps (POST /model
+# with the ADMIN_TOKEN, or automatically every MODEL_WATCH_INTERVAL seconds; see model_swap)
+models = ServedModels(MODEL_PATH, CONF_THRESHOLD, IOU_THRESHOLD, workers=INFERENCE_WORKERS,
+                      torch_threads=TORCH_THREADS, interop_threads=TORCH_INTEROP_THREADS, optimize=OPTIMIZE,
+                      force_reload=FORCE_RELOAD, cascade_model=CASCADE_MODEL,
+                      cascade_escalate_below=CASCADE_ESCALATE_BELOW, cascade_alert_classes=CASCADE_ALERT_CLASSES,
+                      cascade_floor=CASCADE_FLOOR, fused_models=FUSED_MODELS, warm_up_size=lambda: ladder.size)
+motion_gates = {}
+scheduler = None
+cameras = {}
+
+def load_scheduler():
+    """Start the cross-stream batching scheduler on top of the model (or the worker pool)"""
+    global scheduler
+    if scheduler is None:
+        from scheduler import FrameScheduler
+        scheduler = FrameScheduler(models.load_main(), max_batch=SCHEDULER_MAX_BATCH)
+        # Live cameras switch to swapped-in weights at their next frame
+        models.on_swap.append(scheduler.swap_model)
+        print(f"Started frame scheduler with batches of up to {SCHEDULER_MAX_BATCH} frames")
+    return scheduler
+
+@bp.route('/')
 def index():
-    """Render the main page"""
-    return render_template('index.html')
+    """Serve the main page (a static file, not rendered)"""
+    return send_from_directory('templates', 'video.html')
 
-@app.route('/upload_video', methods=['POST'])
+@bp.route('/upload_video', methods=['POST'])
 def upload_video():
     """Handle video upload"""
     if 'video' not in request.files:
@@ -98,35 +167,286 @@ def upload_video():
             'error': str(e)
         }), 500
 
-@app.route('/process_video/<video_id>', methods=['GET'])
+@bp.route('/uploads', methods=['POST'])
+def start_upload():
+    """Start a chunked, resumable video upload; the upload id doubles as the video id"""
+    data = request.get_json(silent=True) or {}
+    try:
+        upload = create_upload(data.get('filename', ''), int(data.get('size', 0)))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'size must be a number of bytes'}), 400
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    
+    status = upload.status()
+    status.update({'success': True, 'video_id': upload.upload_id, 'chunk_size': CHUNK_SIZE})
+    return jsonify(status)
+
+@bp.route('/uploads/<upload_id>', methods=['PATCH'])
+def upload_chunk(upload_id):
+    """Append one chunk (the raw request body) at the offset given in the Upload-Offset header"""
+    upload = get_upload(upload_id)
+    if upload is None:
+        return jsonify({'error': 'Unknown upload'}), 404
+    try:
+        offset = int(request.headers.get('Upload-Offset', request.args.get('offset', '')))
+    except ValueError:
+        return jsonify({'error': 'Upload-Offset header is required'}), 400
+    
+    # Streamed to disk block by block; the chunk is never held in memory
+    try:
+        upload.write(request.stream, offset, request.content_length)
+    except UploadError as e:
+        return jsonify({'error': str(e), 'offset': e.offset}), e.status
+    return jsonify(upload.status())
+
+@bp.route('/uploads/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    """Report how much of an upload has arrived (the offset to resume from)"""
+    upload = get_upload(upload_id)
+    if upload is None:
+        return jsonify({'error': 'Unknown upload'}), 404
+    return jsonify(upload.status())
+
+@bp.route('/process_video/<video_id>', methods=['GET'])
 def process_video(video_id):
     """Process the uploaded video with object detection"""
-    upload_path = os.path.join('static/uploads', f"{video_id}{os.path.splitext(request.args.get('file_extension', '.mp4'))[0]}")
+    from preprocessing import get_preprocessor
+    from motion_gate import MotionGate
+    from roi import get_roi
+    from analytics import get_analytics
+    from model_swap import detector_version, acquire, release
+    from results import result_url
+    
+    upload = get_upload(video_id)
+    if upload is not None:
+        upload_path = upload.path
+    else:
+        upload_path = os.path.join('static/uploads', f"{video_id}{os.path.splitext(request.args.get('file_extension', '.mp4'))[0]}")
     output_path = os.path.join('static/results', f"output_{video_id}.mp4")
     conf_threshold = float(request.args.get('conf_threshold', CONF_THRESHOLD))
+    # A fixed inference size for the whole job, or automatic (per frame, from the ladder)
+    img_size = parse_img_size(request.args.get('img_size'))
+    tiled = request.args.get('tiled', '0').lower() in ('1', 'true', 'on')
+    # Camera the video came from, and whether to run the distortion-correction stage on each frame
+    camera_id = request.args.get('camera', DEFAULT_CAMERA)
+    preprocess = request.args.get('preprocess', '1' if PREPROCESS else '0').lower() in ('1', 'true', 'on')
+    motion_gate = request.args.get('motion_gate', '1' if MOTION_GATE else '0').lower() in ('1', 'true', 'on')
+    # Cameras with regions of interest only run inference on the regions' crop (opt out with roi=0)
+    use_roi = request.args.get('roi', '1').lower() in ('1', 'true', 'on')
+    # Split long videos into segments processed by this many worker processes
+    try:
+        segment_workers = int(request.args.get('segments', VIDEO_SEGMENT_WORKERS))
+    except ValueError:
+        return jsonify({'error': 'segments must be a whole number of worker processes'}), 400
+    # Clips around rule triggers, optionally instead of the full-length output (sequential processing only)
+    event_clips = request.args.get('events', '1' if EVENT_CLIPS else '0').lower() in ('1', 'true', 'on')
+    if event_clips and segment_workers <= 1 and request.args.get('full_output', '1').lower() in ('0', 'false', 'off'):
+        output_path = None
+    rules = None
+    if event_clips and segment_workers <= 1:
+        from events import get_rules
+        try:
+            rules = get_rules(camera_id)
+        except ValueError as e:
+            return jsonify({'error': f"Invalid event rules: {str(e)}"}), 400
+    crowd = request.args.get('crowd', '1' if CROWD_ANALYSIS else '0').lower() in ('1', 'true', 'on')
+    # Admin-only trace and stage timings of the job (profile=1 or profile=torch). The profiler is claimed
+    # here, so a busy one is a 409 rather than a failed job; tracing starts on the job's thread
+    try:
+        profile = request_profile(f"process_video/{video_id}")
+        if profile.enabled:
+            profile.reserve()
+    except PermissionError as e:
+        return jsonify({'error': str(e)}), 403
+    except RuntimeError as e:
+        return jsonify({'error': str(e)}), 409
     
+    held = None
     try:
-        # Load model
-        model = load_model()
-        model.conf = conf_threshold
+        # Load model (or the worker pool in multi-process mode)
+        if segment_workers > 1:
+            # Each segment worker loads its own model; this one only provides the class names
+            model = models.load_main()
+        elif BATCH_SCHEDULER:
+            # Share the detector fairly with other jobs and cameras instead of monopolising it. The fused and
+            # cascade detectors go through the scheduler too, batched with other jobs on the same detector
+            detector = models.load_fused() if FUSED_MODELS else models.load_cascade() if CASCADE_MODEL else None
+            load_scheduler().register(video_id, weight=float(request.args.get('weight', 1.0)),
+                                      min_fps=float(request.args.get('min_fps', 0.0)),
+                                      priority=int(request.args.get('priority', 0)))
+            model = scheduler.client(video_id, detector)
+        elif FUSED_MODELS:
+            # Every frame decoded and preprocessed once for all the models
+            model = models.load_fused()
+        elif CASCADE_MODEL:
+            # Small model on every frame, the main model only on frames it is unsure about
+            model = models.load_cascade()
+        elif INFERENCE_WORKERS > 0:
+            model = models.load_pool()
+        else:
+            model = models.load_model()
+            model.conf = conf_threshold
+        # Held until the job finishes, so a hot swap does not close the pool under a job waiting for upload data
+        held = acquire(model)
+        
+        # Track the motion gate per job so its skip ratio is visible while the video runs
+        gate = None
+        if motion_gate:
+            gate = MotionGate(MOTION_THRESHOLD, max_interval=MOTION_MAX_INTERVAL, method=MOTION_METHOD)
+            motion_gates[video_id] = gate
+            while len(motion_gates) > MAX_TRACKED_JOBS:
+                del motion_gates[next(iter(motion_gates))]
+        
+        # Publish progress for /video_events subscribers; the job runs to the end on the model it started with
+        job = create_job(video_id, output_path, detector_version(model))
+        
+        # Persist and roll up each inferred frame's detections, timestamped from the start of the recording
+        recorded_at = float(request.args.get('recorded_at', time.time()))
+        store = get_store() if STORE_DETECTIONS else None
+        rollups = get_analytics(ANALYTICS_PATH) if ANALYTICS else None
+        
+        # Ring buffer of recent frames, turned into a clip and a snapshot whenever a rule fires
+        recorder = None
+        if rules:
+            from events import EventRecorder
+            recorder = EventRecorder(camera_id, video_id, rules, time_offset=recorded_at)
         
-        # Process video with YOLOv5
-        process_status = process_video_with_yolo(upload_path, output_path, model)
+        # Crowds among the people of every inferred frame, summarised over the job
+        crowd_summary = None
+        if crowd:
+            from crowd import analyse_crowd, CrowdSummary
+            crowd_summary = CrowdSummary()
         
+        def on_detections(frame_index, fps, dets, names, frame_shape):
+            ts = recorded_at + frame_index / fps
+            if store is not None:
+                store.add(camera_id, dets, names, ts, source=video_id, frame=frame_index)
+            if rollups is not None:
+                rollups.update(camera_id, dets, names, ts, frame_shape)
+            if crowd_summary is not None:
+                crowd_summary.update(analyse_crowd(dets, names, frame_shape), ts)
+        
+        # Segment workers load the weights served when the job started
+        segments_path = models.path
+        
+        # Settings for segment workers, which build their own preprocessor and regions from the camera id
+        segment_options = {
+            'conf_threshold': conf_threshold,
+            'img_size': img_size or ladder.size,
+            'tiled': tiled,
+            'tile_size': TILE_SIZE,
+            'tile_overlap': TILE_OVERLAP,
+            'tile_full_frame': TILE_FULL_FRAME,
+            'iou_threshold': IOU_THRESHOLD,
+            'camera': camera_id,
+            'preprocess': preprocess,
+            'roi': use_roi
+        }
+        
+        def run():
+            """Process video with YOLOv5"""
+            nonlocal held
+            try:
+                if profile.enabled:
+                    profile.start()
+                if segment_workers > 1:
+                    # Segments seek into the file, so a chunked upload has to arrive completely first
+                    if upload is not None:
+                        upload.require_complete()
+                    from segments import process_video_segments
+                    process_status = process_video_segments(upload_path, output_path, segments_path, segment_workers,
+                                                            segment_options, model.names, job, on_detections,
+                                                            CONF_THRESHOLD, IOU_THRESHOLD, OPTIMIZE)
+                else:
+                    # A chunked upload that is still arriving is decoded from the prefix received so far
+                    source = upload.open_source() if upload is not None else upload_path
+                    process_status = process_video_with_yolo(source, output_path, model, conf_threshold, img_size,
+                                                             tiled, get_preprocessor(camera_id) if preprocess else None,
+                                                             gate, get_roi(camera_id) if use_roi else None, job,
+                                                             on_detections, recorder, profile)
+                    if upload is not None and upload.stalled:
+                        # The decoder reached the end of what arrived, not the end of the video
+                        raise upload.stall_error()
+            except Exception as e:
+                process_status = {'success': False, 'message': 'Error processing video', 'error': str(e)}
+            finally:
+                try:
+                    if recorder is not None:
+                        # Finish a clip still recording when the video ended
+                        recorder.close()
+                        process_status['event_clips'] = recorder.events
+                    if crowd_summary is not None:
+                        process_status['crowd'] = crowd_summary.stats()
+                    if profile.enabled and profile.running:
+                        try:
+                            process_status['profile'] = profile.stop()
+                        except Exception as e:
+                            # A trace that cannot be written costs the profile, not the job
+                            print(f"Error writing profile {profile.profile_id}: {str(e)}")
+                            process_status['profile'] = {'profile_id': profile.profile_id, 'error': str(e)}
+                    if BATCH_SCHEDULER and segment_workers <= 1:
+                        scheduler.unregister(video_id)
+                    release(held)
+                    held = None
+                finally:
+                    # Subscribers of /video_events wait for this, whatever failed above
+                    job.finish(process_status)
+            return process_status
+        
+        # With background=1 the response returns at once and progress arrives over /video_events/<video_id>
+        if request.args.get('background', '0').lower() in ('1', 'true', 'on'):
+            threading.Thread(target=run, name=f"video-job-{video_id}", daemon=True).start()
+            return jsonify({
+                'success': True,
+                'message': 'Video processing started',
+                'video_id': video_id,
+                'events': f"/video_events/{video_id}",
+                'model_version': job.model_version,
+                # Available once the job has finished
+                'profile': f"/profiles/{profile.profile_id}?format=txt" if profile.enabled else None
+            })
+        
+        process_status = run()
         return jsonify({
             'success': process_status['success'],
             'message': process_status['message'],
             'output_path': output_path if process_status['success'] else None,
+            'output_url': result_url(output_path) if process_status['success'] and output_path else None,
+            'img_sizes': process_status.get('img_sizes'),
+            'corrections': process_status.get('corrections'),
+            'motion': process_status.get('motion'),
+            'segments': process_status.get('segments'),
+            'event_clips': process_status.get('event_clips'),
+            'crowd': process_status.get('crowd'),
+            'profile': process_status.get('profile'),
+            'model_version': job.model_version,
             'error': process_status.get('error')
         })
     except Exception as e:
+        if profile.enabled:
+            # The job never started (a job that ran has stopped its profile already)
+            profile.release()
+        if held is not None:
+            release(held)
         return jsonify({
             'success': False,
             'error': str(e)
         }), 500
 
-def process_video_with_yolo(video_path, output_path, model):
-    """Process video with YOLOv5 and save output video with detections"""
+def process_video_with_yolo(video_path, output_path, model, conf_threshold=CONF_THRESHOLD, img_size=None, tiled=False,
+                            preprocessor=None, gate=None, roi=None, job=None, on_detections=None, events=None,
+                            profile=None):
+    """Process video with YOLOv5 and save output video with detections (output_path None skips the full copy)"""
+    import numpy as np
+    import cv2
+    from inference import results_to_array, draw_detections
+    from tiling import tiled_detect, batch_detector
+    from profiling import NULL_PROFILE
+    
+    # Per-stage timings when the job is profiled (laps are no-ops otherwise)
+    profile = profile or NULL_PROFILE
+    
     try:
         # Open the video file
         cap = cv2.VideoCapture(video_path)
@@ -136,36 +456,113 @@ def process_video_with_yolo(video_path, output_path, model):
         # Get video properties
         frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
         frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        fps = cap.get(cv2.CAP_PROP_FPS)
+        fps = cap.get(cv2.CAP_PROP_FPS) or 25.0
+        # Unknown (0) when decoding an upload that is still arriving
         total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
         
+        # The perspective warp may change the frame size
+        if preprocessor is not None and preprocessor.warp_size:
+            frame_width, frame_height = preprocessor.warp_size
+        
         # Create video writer
         fourcc = cv2.VideoWriter_fourcc(*'mp4v')  # or 'avc1'
-        out = cv2.VideoWriter(output_path, fourcc, fps, (frame_width, frame_height))
+        out = cv2.VideoWriter(output_path, fourcc, fps, (frame_width, frame_height)) if output_path else None
+        if events is not None:
+            events.set_fps(fps)
         
         frame_count = 0
+        img_sizes = {}
+        corrections = {}
         start_time = time.time()
+        detect_batch = batch_detector(model, conf_threshold) if tiled else None
+        last_dets = np.zeros((0, 6), dtype=np.float32)
+        if job is not None:
+            job.start(total_frames)
         
         # Process each frame
         while cap.isOpened():
             ret, frame = cap.read()
             if not ret:
                 break
+            profile.lap('decode')
             
             # Increment frame counter
             frame_count += 1
             
-            # Apply YOLOv5 detection
-            results = model(frame)
+            # Correct the frame only if its quality metrics call for it
+            if preprocessor is not None:
+                frame, _, applied = preprocessor.process(frame)
+                for name in applied:
+                    corrections[name] = corrections.get(name, 0) + 1
+                profile.lap('preprocess')
             
-            # Render detection results on the frame
-            rendered_frame = results.render()[0]
+            # Only the bounding crop of the camera's regions of interest goes through the model
+            if roi is not None:
+                crop, offset = roi.crop(frame)
+            else:
+                crop, offset = frame, (0, 0)
+            
+            # Skip the forward pass when nothing moved since the last inferred frame
+            dets = None
+            if gate is not None and not gate.should_infer(crop):
+                rendered_frame = draw_detections(frame, last_dets, model.names)
+                if roi is not None:
+                    roi.draw(rendered_frame)
+            else:
+                # Pick the inference size for this frame and count how many frames used it
+                size = ladder.select(img_size)
+                img_sizes[size] = img_sizes.get(size, 0) + 1
+                frame_start = time.time()
+                
+                # Apply YOLOv5 detection
+                if tiled:
+                    # Overlapping tiles of the full-resolution frame run as one batch
+                    dets, _ = tiled_detect(detect_batch, crop, TILE_SIZE, TILE_OVERLAP,
+                                           size if TILE_FULL_FRAME else None, IOU_THRESHOLD)
+                elif hasattr(model, 'infer'):
+                    # Worker pool or scheduler stream
+                    dets, _ = model.infer(crop, conf=conf_threshold, size=size)
+                else:
+                    dets = results_to_array(model(crop, size=size))
+                
+                # Map crop detections back to the frame and drop those outside the regions
+                if roi is not None:
+                    dets, _ = roi.apply(dets, offset)
+                last_dets = dets
+                
+                # Render the detection results on the frame, drawn the same way as frames the gate skipped
+                rendered_frame = draw_detections(frame, dets, model.names)
+                if roi is not None:
+                    roi.draw(rendered_frame)
+                
+                frame_time = time.time() - frame_start
+                ladder.observe(frame_time)
+                if gate is not None:
+                    gate.record_inference(frame_time)
+            profile.lap('inference')
+            
+            # Clip the seconds around rule triggers (the ring buffer holds the pre-roll)
+            if events is not None:
+                frame_ts = (frame_count - 1) / fps
+                if dets is not None:
+                    events.check(dets, model.names, frame_ts, rendered_frame)
+                events.add_frame(rendered_frame, frame_ts)
+                profile.lap('events')
             
             # Write frame to output video
-            out.write(rendered_frame)
+            if out is not None:
+                out.write(rendered_frame)
+                profile.lap('encode')
+            
+            # Publish progress and running detection counts to the job's subscribers
+            if job is not None:
+                job.advance(dets, model.names)
+            if on_detections is not None and dets is not None:
+                on_detections(frame_count - 1, fps, dets, model.names, frame.shape)
+            profile.lap('bookkeeping')
             
             # Print progress
-            if frame_count % 10 == 0:
+            if frame_count % 10 == 0 and total_frames > 0:
                 progress = (frame_count / total_frames) * 100
                 elapsed_time = time.time() - start_time
                 estimated_total = elapsed_time / (frame_count / total_frames)
@@ -174,7 +571,8 @@ def process_video_with_yolo(video_path, output_path, model):
         
         # Release resources
         cap.release()
-        out.release()
+        if out is not None:
+            out.release()
         
         process_time = time.time() - start_time
         
@@ -182,15 +580,23 @@ def process_video_with_yolo(video_path, output_path, model):
             'success': True, 
             'message': f'Video processed successfully in {process_time:.2f} seconds',
             'processed_frames': frame_count,
-            'process_time': process_time
+            'process_time': process_time,
+            'img_sizes': img_sizes,
+            'corrections': corrections,
+            'motion': gate.stats() if gate is not None else None
         }
     
     except Exception as e:
         return {'success': False, 'message': 'Error processing video', 'error': str(e)}
 
-@app.route('/video_status/<video_id>', methods=['GET'])
+@bp.route('/video_status/<video_id>', methods=['GET'])
 def video_status(video_id):
     """Check the status of video processing"""
+    job = get_job(video_id)
+    if job is not None:
+        return jsonify(job.snapshot())
+    
+    # Jobs from before a restart: fall back to the output file
     output_path = os.path.join('static/results', f"output_{video_id}.mp4")
     
     if os.path.exists(output_path):
@@ -210,270 +616,130 @@ def video_status(video_id):
             'status': 'processing'
         })
 
-# Create HTML template directory
-os.makedirs('templates', exist_ok=True)
-
-# Write the HTML template for the web interface
-with open('templates/index.html', 'w') as f:
-    f.write('''
-<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>YOLOv5 Video Object Detection</title>
-    <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0-alpha1/dist/css/bootstrap.min.css" rel="stylesheet">
-    <style>
-        body {
-            padding-top: 2rem;
-            padding-bottom: 2rem;
-            background-color: #f8f9fa;
-        }
-        .header {
-            text-align: center;
-            margin-bottom: 2rem;
-        }
-        .upload-container {
-            background-color: white;
-            border-radius: 10px;
-            padding: 2rem;
-            box-shadow: 0 4px 6px rgba(0, 0, 0, 0.1);
-            margin-bottom: 2rem;
-        }
-        .result-container {
-            background-color: white;
-            border-radius: 10px;
-            padding: 2rem;
-            box-shadow: 0 4px 6px rgba(0, 0, 0, 0.1);
-            display: none;
-        }
-        .video-preview {
-            width: 100%;
-            max-height: 400px;
-            margin-top: 1rem;
-            margin-bottom: 1rem;
-            border-radius: 5px;
-        }
-        .loader {
-            border: 5px solid #f3f3f3;
-            border-radius: 50%;
-            border-top: 5px solid #3498db;
-            width: 40px;
-            height: 40px;
-            animation: spin 2s linear infinite;
-            margin: 0 auto;
-        }
-        .progress-container {
-            margin-top: 20px;
-        }
-        @keyframes spin {
-            0% { transform: rotate(0deg); }
-            100% { transform: rotate(360deg); }
-        }
-    </style>
-</head>
-<body>
-    <div class="container">
-        <div class="header">
-            <h1>YOLOv5 Video Object Detection</h1>
-            <p class="lead">Upload a video to detect objects using your custom trained YOLOv5 model</p>
-        </div>
-        
-        <div class="row">
-            <div class="col-md-6 mx-auto">
-                <div class="upload-container">
-                    <h3>Upload Video</h3>
-                    <form id="upload-form" enctype="multipart/form-data">
-                        <div class="mb-3">
-                            <label for="video" class="form-label">Select Video File</label>
-                            <input class="form-control" type="file" id="video" name="video" accept="video/*" onchange="previewVideo()">
-                        </div>
-                        <div class="mb-3">
-                            <label for="confidence" class="form-label">Confidence Threshold: <span id="conf-value">0.25</span></label>
-                            <input type="range" class="form-range" min="0.1" max="1.0" step="0.05" value="0.25" id="confidence" name="confidence" onchange="updateConfValue()">
-                        </div>
-                        <div class="mb-3">
-                            <video id="preview" class="video-preview d-none" controls></video>
-                        </div>
-                        <button type="submit" class="btn btn-primary w-100">Process Video</button>
-                    </form>
-                    <div id="loading" class="text-center mt-3 d-none">
-                        <div class="loader"></div>
-                        <p class="mt-2" id="processing-text">Uploading video...</p>
-                        <div class="progress-container">
-                            <div class="progress">
-                                <div id="progress-bar" class="progress-bar progress-bar-striped progress-bar-animated" role="progressbar" style="width: 0%"></div>
-                            </div>
-                            <p class="text-center mt-1" id="progress-text">Initializing...</p>
-                        </div>
-                    </div>
-                </div>
-            </div>
-        </div>
-        
-        <div class="row">
-            <div class="col-md-10 mx-auto">
-                <div id="result-container" class="result-container">
-                    <h3>Detection Results</h3>
-                    <div class="row">
-                        <div class="col-md-12">
-                            <div class="ratio ratio-16x9">
-                                <video id="result-video" class="video-preview" controls></video>
-                            </div>
-                            <div class="d-grid gap-2 mt-3">
-                                <a id="download-btn" href="#" class="btn btn-success" download>Download Processed Video</a>
-                            </div>
-                            <div id="detection-info" class="mt-3">
-                                <p><strong>Processing Time:</strong> <span id="processing-time"></span></p>
-                            </div>
-                        </div>
-                    </div>
-                </div>
-            </div>
-        </div>
-    </div>
-
-    <script>
-        let videoId = null;
-        let statusCheckInterval = null;
-        
-        function previewVideo() {
-            const preview = document.getElementById('preview');
-            const file = document.getElementById('video').files[0];
-            
-            if (file) {
-                const videoUrl = URL.createObjectURL(file);
-                preview.src = videoUrl;
-                preview.classList.remove('d-none');
-            } else {
-                preview.src = '';
-                preview.classList.add('d-none');
-            }
-        }
-        
-        function updateConfValue() {
-            const value = document.getElementById('confidence').value;
-            document.getElementById('conf-value').textContent = value;
-        }
-        
-        function startStatusCheck() {
-            if (!videoId) return;
-            
-            statusCheckInterval = setInterval(() => {
-                fetch(`/video_status/${videoId}`)
-                    .then(response => response.json())
-                    .then(data => {
-                        if (data.status === 'complete') {
-                            clearInterval(statusCheckInterval);
-                            showResults(data.output_path, data.time_elapsed);
-                        } else {
-                            // Update progress UI (if needed)
-                            document.getElementById('processing-text').textContent = 'Processing video...';
-                            // In a real app, you'd have a way to show actual progress here
-                            const randomProgress = Math.floor(Math.random() * 30) + 50; // 50-80% as placeholder
-                            document.getElementById('progress-bar').style.width = `${randomProgress}%`;
-                            document.getElementById('progress-text').textContent = `Processing: approximately ${randomProgress}% complete`;
-                        }
-                    })
-                    .catch(error => {
-                        console.error('Error checking status:', error);
-                    });
-            }, 2000); // Check every 2 seconds
-        }
-        
-        function showResults(outputPath, processingTime) {
-            // Hide loading indicator
-            document.getElementById('loading').classList.add('d-none');
-            
-            // Set video source with cache busting
-            const resultVideo = document.getElementById('result-video');
-            resultVideo.src = `${outputPath}?${new Date().getTime()}`;
-            
-            // Set download link
-            document.getElementById('download-btn').href = outputPath;
-            
-            // Set processing time
-            document.getElementById('processing-time').textContent = processingTime;
-            
-            // Show result container
-            document.getElementById('result-container').style.display = 'block';
-        }
-        
-        function processVideo(fileExtension) {
-            fetch(`/process_video/${videoId}?file_extension=${fileExtension}&conf_threshold=${document.getElementById('confidence').value}`)
-                .then(response => response.json())
-                .then(data => {
-                    if (data.success) {
-                        document.getElementById('progress-bar').style.width = '50%';
-                        document.getElementById('progress-text').textContent = 'Video processing started...';
-                        startStatusCheck();
-                    } else {
-                        document.getElementById('loading').classList.add('d-none');
-                        alert('Error processing video: ' + data.error);
-                    }
-                })
-                .catch(error => {
-                    document.getElementById('loading').classList.add('d-none');
-                    alert('Error: ' + error);
-                });
-        }
+@bp.route('/video_events/<video_id>', methods=['GET'])
+def video_events(video_id):
+    """Stream a job's progress, fps, ETA and detection counts as Server-Sent Events"""
+    job = get_job(video_id)
+    if job is None:
+        return jsonify({'error': 'Unknown video job'}), 404
+    return Response(stream_with_context(job.events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@bp.route('/cameras', methods=['GET'])
+def list_cameras():
+    """Report per-stream achieved fps and lag for live cameras and video jobs"""
+    stats = load_scheduler().stats()
+    for camera_id, stream in list(cameras.items()):
+        stats['streams'].setdefault(camera_id, {}).update(stream.stats())
+    return jsonify(stats)
+
+@bp.route('/cameras', methods=['POST'])
+def add_camera():
+    """Start reading a live camera and schedule its frames alongside the other streams"""
+    from scheduler import CameraStream
+    from roi import get_roi
+    
+    data = request.get_json(silent=True) or {}
+    camera_id = data.get('camera_id')
+    source = data.get('source')
+    if not camera_id or not source:
+        return jsonify({'error': 'camera_id and source are required'}), 400
+    # Clips and snapshots around the camera's event rules
+    recorder = None
+    if data.get('events', EVENT_CLIPS):
+        from events import EventRecorder, get_rules
+        try:
+            rules = get_rules(camera_id)
+        except ValueError as e:
+            return jsonify({'error': f"Invalid event rules: {str(e)}"}), 400
+        if rules:
+            recorder = EventRecorder(camera_id, 'live', rules, annotate=True)
+    if camera_id in cameras:
+        cameras.pop(camera_id).stop()
+    
+    load_scheduler().register(camera_id, weight=float(data.get('weight', 1.0)),
+                              min_fps=float(data.get('min_fps', 0.0)), priority=int(data.get('priority', 0)))
+    cameras[camera_id] = CameraStream(camera_id, source, scheduler,
+                                      size=parse_img_size(data.get('img_size')) or 640,
+                                      conf=float(data.get('confidence', CONF_THRESHOLD)),
+                                      roi=get_roi(camera_id), events=recorder).start()
+    return jsonify({'success': True, 'camera_id': camera_id})
+
+@bp.route('/cameras/<camera_id>', methods=['DELETE'])
+def remove_camera(camera_id):
+    """Stop reading a live camera"""
+    stream = cameras.pop(camera_id, None)
+    if stream is None:
+        return jsonify({'error': 'Unknown camera'}), 404
+    stream.stop()
+    scheduler.unregister(camera_id)
+    return jsonify({'success': True})
+
+@bp.route('/cameras/<camera_id>/detections', methods=['GET'])
+def camera_detections(camera_id):
+    """Latest detections for a live camera"""
+    from inference import detections_to_list
+    
+    stream = cameras.get(camera_id)
+    if stream is None:
+        return jsonify({'error': 'Unknown camera'}), 404
+    latest = stream.latest
+    return jsonify({
+        'camera_id': camera_id,
+        'timestamp': latest['timestamp'],
+        'detections': detections_to_list(latest['dets'], latest['names']),
+        'model_version': latest['model_version']
+    })
+
+@bp.route('/events', methods=['GET'])
+def list_events():
+    """Recent event clips and snapshots, newest first (filter with camera and since)"""
+    from events import recent_events
+    try:
+        since = parse_time(request.args.get('since'))
+        limit = int(request.args.get('limit', 100))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'events': recent_events(request.args.get('camera') or None, since, limit)})
+
+@bp.route('/motion_stats', methods=['GET'])
+def motion_stats():
+    """Report the motion-gate skip ratio and compute saved for recent video jobs"""
+    return jsonify({video_id: gate.stats() for video_id, gate in list(motion_gates.items())})
+
+def load_detector():
+    """Load the model (or the worker pool that owns the models), the cascade, the fused models and the scheduler"""
+    detector = models.load()
+    if BATCH_SCHEDULER:
+        load_scheduler()
+    models.load_swapper()
+    return detector
+
+def warm_up_detector(detector):
+    """Run a blank frame through the model so the first request does not pay for lazy initialisation"""
+    from inference import warm_up
+    warm_up(detector, ladder.size)
+    if models.fused is not None:
+        warm_up(models.fused, ladder.size)
+
+def create_app():
+    """Create the Flask app and start loading the model in the background"""
+    with startup_timer.phase('create_app'):
+        app = Flask(__name__)
+        app.register_blueprint(bp)
+        app.register_blueprint(shared_routes(models, ladder, ANALYTICS_PATH))
         
-        document.getElementById('upload-form').addEventListener('submit', function(e) {
-            e.preventDefault();
-            
-            const formData = new FormData(this);
-            const loading = document.getElementById('loading');
-            const resultContainer = document.getElementById('result-container');
-            const file = document.getElementById('video').files[0];
-            
-            if (!file) {
-                alert('Please select a video file');
-                return;
-            }
-            
-            // Show loading indicator
-            loading.classList.remove('d-none');
-            resultContainer.style.display = 'none';
-            
-            // Reset progress
-            document.getElementById('progress-bar').style.width = '10%';
-            document.getElementById('progress-text').textContent = 'Uploading video...';
-            
-            fetch('/upload_video', {
-                method: 'POST',
-                body: formData
-            })
-            .then(response => response.json())
-            .then(data => {
-                if (data.success) {
-                    // Store the video ID for status checking
-                    videoId = data.video_id;
-                    document.getElementById('progress-bar').style.width = '30%';
-                    document.getElementById('progress-text').textContent = 'Video uploaded, preparing processing...';
-                    
-                    // Start processing the video
-                    const fileExtension = file.name.split('.').pop();
-                    processVideo(`.${fileExtension}`);
-                } else {
-                    loading.classList.add('d-none');
-                    alert('Error: ' + data.error);
-                }
-            })
-            .catch(error => {
-                loading.classList.add('d-none');
-                alert('Error: ' + error);
-            });
-        });
-    </script>
-</body>
-</html>
-    ''')
+        # Create directories for uploads and results
+        os.makedirs('static/uploads', exist_ok=True)
+        os.makedirs('static/results', exist_ok=True)
+    
+    # The server accepts requests (and answers /ready) while the model warms up
+    startup_timer.start_background(load_detector, warm_up_detector, HEAVY_IMPORTS)
+    return app
+
+startup_timer.record('imports', time.perf_counter() - startup_timer.created)
 
 if __name__ == '__main__':
-    print("Initializing YOLOv5 model...")
-    # Initialize model
-    load_model()
-    
-    # Run the Flask application
+    # Run the Flask application; the model loads in the background
     print("Starting Flask server...")
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    create_app().run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -1,59 +1,109 @@
-from flask import Flask, request, render_template, jsonify, send_file
-import torch
-import numpy as np
-import cv2
-from PIL import Image
-import io
+# Imported first so the startup timings cover the whole module
+from startup import startup_timer
+from flask import Flask, Blueprint, request, jsonify, send_from_directory
 import os
 import time
-import base64
 import uuid
-import sys
 
-app = Flask(__name__)
+# torch, OpenCV, PIL and the helpers built on them are imported where they are used
+from resolution import ResolutionLadder, parse_img_size
+from model_swap import ServedModels
+from routes import shared_routes, request_profile
+from cameras import DEFAULT_CAMERA
+from detection_store import get_store
 
-# Create directories for uploads and results
-os.makedirs('static/uploads', exist_ok=True)
-os.makedirs('static/results', exist_ok=True)
+bp = Blueprint('detector', __name__)
 
 # Model settings
 MODEL_PATH = "best.pt"
 CONF_THRESHOLD = 0.25
 IOU_THRESHOLD = 0.45
+# Classes drawn without a text label on the result image
+HIDDEN_LABELS = ("People Detection - v8 2023-09-11 7-03pm",)
 
-# Global variable for the model
-model = None
+# Refresh the YOLOv5 hub cache on startup (slow; only needed after upgrading YOLOv5)
+FORCE_RELOAD = os.environ.get('FORCE_RELOAD', '0') == '1'
 
-def load_model():
-    """Load the YOLOv5 model with path fix for Windows"""
-    global model
-    if model is None:
-        try:
-            # Fix for the PosixPath issue on Windows
-            import pathlib
-            temp = pathlib.PosixPath
-            pathlib.PosixPath = pathlib.WindowsPath
-            
-            # Force reload to avoid cache issues
-            model = torch.hub.load('ultralytics/yolov5', 'custom', path=MODEL_PATH, force_reload=True)
-            model.conf = CONF_THRESHOLD
-            model.iou = IOU_THRESHOLD
-            
-            print("Model loaded successfully!")
-            return model
-        except Exception as e:
-            print(f"Error loading model: {str(e)}")
-            sys.exit(1)
-    return model
+# Multi-process inference: number of worker processes (0 runs the model in-process)
+INFERENCE_WORKERS = int(os.environ.get('INFERENCE_WORKERS', 0))
+# Torch threads per worker or for the in-process model (workers default to an even split of the cores)
+TORCH_THREADS = int(os.environ.get('TORCH_THREADS', 0)) or None
+# Torch inter-op threads (in-process model only; workers use one)
+TORCH_INTEROP_THREADS = int(os.environ.get('TORCH_INTEROP_THREADS', 0)) or None
+
+# Optimized CPU execution: 'fuse' (Conv+BN fusion, channels_last, inference mode), 'trace' (plus
+# TorchScript graphs cached in OPTIMIZED_CACHE_DIR) or 'compile' (plus torch.compile); empty runs eager
+OPTIMIZE = os.environ.get('OPTIMIZE') or None
+
+# Latency SLO (seconds per request) for the adaptive inference resolution ladder
+LATENCY_SLO = float(os.environ.get('LATENCY_SLO', 1.0))
+
+# Tiled inference for high-resolution frames (enabled per request with tiled=1)
+TILE_SIZE = int(os.environ.get('TILE_SIZE', 640))
+TILE_OVERLAP = float(os.environ.get('TILE_OVERLAP', 0.2))
+# Also merge in a downscaled full-frame pass so objects larger than a tile are found
+TILE_FULL_FRAME = os.environ.get('TILE_FULL_FRAME', '0') == '1'
+
+# Quality-gated distortion correction before inference (per request with preprocess=1/0)
+PREPROCESS = os.environ.get('PREPROCESS', '0') == '1'
+
+# Crowd analysis of the person detections: dense clusters, their size, area and density (per request
+# with crowd=1/0; CROWD_CLASSES, CROWD_LINK_DISTANCE, CROWD_MIN_SIZE and CROWD_MIN_DENSITY tune it)
+CROWD_ANALYSIS = os.environ.get('CROWD_ANALYSIS', '0') == '1'
+
+# Downscaled previews and WebP copies of result images (per request with variants=1/0) and a base64
+# thumbnail inlined in the JSON (thumbnail=1); /results serves results with cache headers and range support
+RESULT_VARIANTS = os.environ.get('RESULT_VARIANTS', '1') == '1'
+
+# Persist detections to the SQLite store (DETECTION_DB) for the /detections query API
+STORE_DETECTIONS = os.environ.get('STORE_DETECTIONS', '1') == '1'
+
+# Incremental minute/hour rollups and heatmaps for dashboards, checkpointed to a file of this app's own
+ANALYTICS = os.environ.get('ANALYTICS', '1') == '1'
+ANALYTICS_PATH = os.environ.get('ANALYTICS_PATH', f"analytics-{os.path.splitext(MODEL_PATH)[0]}.npz")
+
+# Model cascade: a small model (e.g. a YOLOv5n export of the same classes) runs on every frame and the
+# main model only where it found something below CASCADE_ESCALATE_BELOW or one of CASCADE_ALERT_CLASSES
+CASCADE_MODEL = os.environ.get('CASCADE_MODEL')
+CASCADE_ESCALATE_BELOW = float(os.environ.get('CASCADE_ESCALATE_BELOW', 0.5))
+CASCADE_FLOOR = float(os.environ.get('CASCADE_FLOOR', 0.1))
+CASCADE_ALERT_CLASSES = tuple(name for name in os.environ.get('CASCADE_ALERT_CLASSES', '').split(',') if name)
+
+# Fused multi-model inference: decode and letterbox each frame once and run these models concurrently on
+# the same tensor (comma-separated, e.g. garbage.pt,cars.pt,best.pt); class names become "model/class"
+FUSED_MODELS = tuple(path for path in os.environ.get('FUSED_MODELS', '').split(',') if path)
 
-@app.route('/')
+# Modules that pull in torch, OpenCV and NumPy; imported by the warm-up thread, not at startup
+HEAVY_IMPORTS = ('inference', 'tiling', 'preprocessing', 'roi', 'analytics', 'fused', 'crowd')
+
+ladder = ResolutionLadder(LATENCY_SLO)
+# The model or worker pool, the cascade and the fused models, rebuilt together by hot swaps (POST /model
+# with the ADMIN_TOKEN, or automatically every MODEL_WATCH_INTERVAL seconds; see model_swap)
+models = ServedModels(MODEL_PATH, CONF_THRESHOLD, IOU_THRESHOLD, workers=INFERENCE_WORKERS,
+                      torch_threads=TORCH_THREADS, interop_threads=TORCH_INTEROP_THREADS, optimize=OPTIMIZE,
+                      force_reload=FORCE_RELOAD, cascade_model=CASCADE_MODEL,
+                      cascade_escalate_below=CASCADE_ESCALATE_BELOW, cascade_alert_classes=CASCADE_ALERT_CLASSES,
+                      cascade_floor=CASCADE_FLOOR, fused_models=FUSED_MODELS, warm_up_size=lambda: ladder.size)
+
+@bp.route('/')
 def index():
-    """Render the main page"""
-    return render_template('index.html')
+    """Serve the main page (a static file, not rendered)"""
+    return send_from_directory('templates', 'index.html')
 
-@app.route('/detect', methods=['POST'])
+@bp.route('/detect', methods=['POST'])
 def detect():
     """Handle image upload and object detection"""
+    import cv2
+    from inference import results_to_array, detections_to_list, draw_detections
+    from tiling import tiled_detect, batch_detector
+    from preprocessing import get_preprocessor
+    from roi import get_roi
+    from analytics import get_analytics
+    from model_swap import detector_version
+    from results import save_variants, thumbnail_data_uri, result_url
+    
+    request_start = time.time()
+    
     if 'image' not in request.files:
         return jsonify({'error': 'No image provided'}), 400
     
@@ -76,294 +126,211 @@ def detect():
     except ValueError:
         conf_threshold = CONF_THRESHOLD
     
+    # Use the requested inference size, or let the ladder pick one from the current load
+    img_size = ladder.select(parse_img_size(request.form.get('img_size')))
+    tiled = request.form.get('tiled', '0').lower() in ('1', 'true', 'on')
+    tile_count = 0
+    
+    # Camera the image came from, and whether to run the distortion-correction stage
+    camera_id = request.form.get('camera', DEFAULT_CAMERA)
+    preprocess = request.form.get('preprocess', '1' if PREPROCESS else '0').lower() in ('1', 'true', 'on')
+    # Cameras with regions of interest only run inference on the regions' crop (opt out with roi=0)
+    use_roi = request.form.get('roi', '1').lower() in ('1', 'true', 'on')
+    crowd = request.form.get('crowd', '1' if CROWD_ANALYSIS else '0').lower() in ('1', 'true', 'on')
+    # Smaller copies of the result image for thin links
+    make_variants = request.form.get('variants', '1' if RESULT_VARIANTS else '0').lower() in ('1', 'true', 'on')
+    inline_thumbnail = request.form.get('thumbnail', '0').lower() in ('1', 'true', 'on')
+    
+    # Admin-only trace and stage timings of this request (profile=1 or profile=torch)
+    try:
+        profile = request_profile('detect')
+        if profile.enabled:
+            profile.start()
+    except PermissionError as e:
+        return jsonify({'error': str(e)}), 403
+    except RuntimeError as e:
+        return jsonify({'error': str(e)}), 409
+    
     # Load model and run inference
     try:
-        model = load_model()
-        model.conf = conf_threshold
-        
-        # Run inference
-        start_time = time.time()
-        results = model(upload_path)
-        inference_time = time.time() - start_time
-        
-        # Custom rendering to hide confidence scores and specific labels
+        # Decode once; only frames that need it pay for the corrections
         img = cv2.imread(upload_path)
-        detections = results.pandas().xyxy[0]
-        detection_list = []
+        profile.lap('decode')
+        corrections = []
+        if preprocess:
+            img, _, corrections = get_preprocessor(camera_id).process(img)
+        rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        profile.lap('preprocess')
+        
+        # Crop to the camera's regions of interest before the forward pass
+        roi = get_roi(camera_id) if use_roi else None
+        if roi is not None:
+            crop, offset = roi.crop(rgb)
+        else:
+            crop, offset = rgb, (0, 0)
         
-        for _, det in detections.iterrows():
-            # Extract detection information
-            x1, y1, x2, y2 = int(det['xmin']), int(det['ymin']), int(det['xmax']), int(det['ymax'])
-            cls = det['name']
-            conf = float(det['confidence'])
+        if tiled:
+            # Cut the image into overlapping tiles that run as one batch
+            if FUSED_MODELS:
+                model = models.load_fused()
+            elif CASCADE_MODEL:
+                model = models.load_cascade()
+            else:
+                model = models.load_main()
             
-            # Add to detection list for JSON response
-            detection_list.append({
-                'class': cls,
-                'confidence': conf,
-                'bbox': [float(det['xmin']), float(det['ymin']), float(det['xmax']), float(det['ymax'])]
-            })
+            # Run inference
+            start_time = time.time()
+            dets, tile_count = tiled_detect(batch_detector(model, conf_threshold), crop, TILE_SIZE, TILE_OVERLAP,
+                                            img_size if TILE_FULL_FRAME else None, IOU_THRESHOLD)
+            inference_time = time.time() - start_time
+            names = model.names
+            version = detector_version(model)
+        elif FUSED_MODELS:
+            # One decoded, letterboxed input shared by all the models, which run concurrently
+            fused = models.load_fused()
             
-            # Draw bounding box
-            cv2.rectangle(img, (x1, y1), (x2, y2), (0, 255, 0), 2)
+            # Run inference
+            start_time = time.time()
+            dets, _ = fused.infer(crop, conf=conf_threshold, size=img_size)
+            inference_time = time.time() - start_time
+            names = fused.names
+            version = detector_version(fused)
+        elif CASCADE_MODEL:
+            # Small model first; the main model only runs if the small one is unsure
+            cascade = models.load_cascade()
             
-            # Only show label if it's NOT "People Detection - v8 2023-09-11 7-03pm"
-            if cls != "People Detection - v8 2023-09-11 7-03pm":
-                # Draw label without confidence score
-                cv2.putText(img, cls, (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
+            # Run inference
+            start_time = time.time()
+            dets, _ = cascade.infer(crop, conf=conf_threshold, size=img_size)
+            inference_time = time.time() - start_time
+            names = cascade.names
+            version = detector_version(cascade)
+        elif INFERENCE_WORKERS > 0:
+            # Hand the decoded image to a worker through shared memory
+            pool = models.load_pool()
+            
+            # Run inference
+            start_time = time.time()
+            dets, _ = pool.infer(crop, conf=conf_threshold, size=img_size)
+            inference_time = time.time() - start_time
+            names = pool.names
+            version = detector_version(pool)
+        else:
+            model = models.load_model()
+            model.conf = conf_threshold
+            
+            # Run inference
+            start_time = time.time()
+            results = model(crop, size=img_size)
+            inference_time = time.time() - start_time
+            dets = results_to_array(results)
+            names = model.names
+            version = detector_version(model)
+        
+        profile.lap('inference')
+        
+        # Map crop detections back to the frame and drop those outside the regions
+        regions = None
+        if roi is not None:
+            dets, regions = roi.apply(dets, offset)
+        
+        # Dense clusters of people, judged in person heights so near and far groups compare fairly
+        crowd_result = None
+        if crowd:
+            from crowd import analyse_crowd
+            crowd_result = analyse_crowd(dets, names, img.shape)
+        profile.lap('postprocess')
+        
+        # Persist the detections (queued; written in batches by a background thread)
+        if STORE_DETECTIONS:
+            get_store().add(camera_id, dets, names, request_start, source=filename, regions=regions)
+        if ANALYTICS:
+            get_analytics(ANALYTICS_PATH).update(camera_id, dets, names, request_start, img.shape)
+        profile.lap('store')
+        
+        # Feed the request latency (including time spent waiting for the model) back to the ladder
+        ladder.observe(time.time() - request_start)
+        
+        # Add to detection list for JSON response
+        detection_list = detections_to_list(dets, names)
+        if regions is not None:
+            for det, region in zip(detection_list, regions):
+                det['region'] = region
+        
+        # Custom rendering to hide confidence scores and specific labels
+        draw_detections(img, dets, names, hidden_labels=HIDDEN_LABELS)
+        if roi is not None:
+            roi.draw(img)
         
         # Save the custom rendered image
         cv2.imwrite(result_path, img)
+        result_img = img
+        profile.lap('render')
+        
+        # Preview and WebP copies next to the full image, and the inline thumbnail
+        variants = save_variants(result_path, result_img) if make_variants else {'full': result_url(result_path)}
+        thumbnail = thumbnail_data_uri(result_img) if inline_thumbnail else None
+        profile.lap('variants')
         
         # Return JSON response
+        profile_report = profile.stop() if profile.enabled else None
         return jsonify({
             'success': True,
             'upload_path': upload_path,
             'result_path': result_path,
+            'result_url': variants['full'],
+            'variants': variants,
+            'thumbnail': thumbnail,
             'detections': detection_list,
             'inference_time': f"{inference_time:.2f}s",
-            'detection_count': len(detection_list)
+            'img_size': img_size,
+            'tiles': tile_count,
+            'corrections': corrections,
+            'detection_count': len(detection_list),
+            'crowd': crowd_result,
+            'model_version': version,
+            'profile': profile_report
         })
     
     except Exception as e:
+        if profile.enabled:
+            profile.stop()
         return jsonify({
             'success': False,
             'error': str(e)
         }), 500
 
-# Create HTML template directory
-os.makedirs('templates', exist_ok=True)
+def load_detector():
+    """Load the model (or the worker pool that owns the models), the cascade and the fused models"""
+    detector = models.load()
+    models.load_swapper()
+    return detector
 
-# Write the HTML template for the web interface
-with open('templates/index.html', 'w') as f:
-    f.write('''
-<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>YOLOv5 Object Detection</title>
-    <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0-alpha1/dist/css/bootstrap.min.css" rel="stylesheet">
-    <style>
-        body {
-            padding-top: 2rem;
-            padding-bottom: 2rem;
-            background-color: #f8f9fa;
-        }
-        .header {
-            text-align: center;
-            margin-bottom: 2rem;
-        }
-        .upload-container {
-            background-color: white;
-            border-radius: 10px;
-            padding: 2rem;
-            box-shadow: 0 4px 6px rgba(0, 0, 0, 0.1);
-            margin-bottom: 2rem;
-        }
-        .result-container {
-            background-color: white;
-            border-radius: 10px;
-            padding: 2rem;
-            box-shadow: 0 4px 6px rgba(0, 0, 0, 0.1);
-            display: none;
-        }
-        .image-preview {
-            width: 100%;
-            max-height: 400px;
-            object-fit: contain;
-            margin-top: 1rem;
-            margin-bottom: 1rem;
-            border-radius: 5px;
-        }
-        .detection-item {
-            background-color: #f8f9fa;
-            border-radius: 5px;
-            padding: 1rem;
-            margin-bottom: 0.5rem;
-        }
-        .confidence-high {
-            color: green;
-            font-weight: bold;
-        }
-        .confidence-medium {
-            color: orange;
-            font-weight: bold;
-        }
-        .confidence-low {
-            color: red;
-            font-weight: bold;
-        }
-        .loader {
-            border: 5px solid #f3f3f3;
-            border-radius: 50%;
-            border-top: 5px solid #3498db;
-            width: 40px;
-            height: 40px;
-            animation: spin 2s linear infinite;
-            margin: 0 auto;
-        }
-        @keyframes spin {
-            0% { transform: rotate(0deg); }
-            100% { transform: rotate(360deg); }
-        }
-    </style>
-</head>
-<body>
-    <div class="container">
-        <div class="header">
-            <h1>YOLOv5 Object Detection</h1>
-            <p class="lead">Upload an image to detect objects using your custom trained YOLOv5 model</p>
-        </div>
-        
-        <div class="row">
-            <div class="col-md-6 mx-auto">
-                <div class="upload-container">
-                    <h3>Upload Image</h3>
-                    <form id="upload-form" enctype="multipart/form-data">
-                        <div class="mb-3">
-                            <label for="image" class="form-label">Select Image</label>
-                            <input class="form-control" type="file" id="image" name="image" accept="image/*" onchange="previewImage()">
-                        </div>
-                        <div class="mb-3">
-                            <label for="confidence" class="form-label">Confidence Threshold: <span id="conf-value">0.25</span></label>
-                            <input type="range" class="form-range" min="0.1" max="1.0" step="0.05" value="0.25" id="confidence" name="confidence" onchange="updateConfValue()">
-                        </div>
-                        <div class="mb-3">
-                            <img id="preview" class="image-preview d-none">
-                        </div>
-                        <button type="submit" class="btn btn-primary w-100">Detect Objects</button>
-                    </form>
-                    <div id="loading" class="text-center mt-3 d-none">
-                        <div class="loader"></div>
-                        <p class="mt-2">Processing image...</p>
-                    </div>
-                </div>
-            </div>
-        </div>
-        
-        <div class="row">
-            <div class="col-md-10 mx-auto">
-                <div id="result-container" class="result-container">
-                    <h3>Detection Results</h3>
-                    <div class="row">
-                        <div class="col-md-6">
-                            <img id="result-image" class="image-preview">
-                            <div class="d-grid gap-2">
-                                <a id="download-btn" href="#" class="btn btn-success" download>Download Result</a>
-                            </div>
-                        </div>
-                        <div class="col-md-6">
-                            <div id="detection-info">
-                                <p><strong>Inference Time:</strong> <span id="inference-time"></span></p>
-                                <h4>Detected Objects: <span id="detection-count">0</span></h4>
-                                <div id="detections-list"></div>
-                            </div>
-                        </div>
-                    </div>
-                </div>
-            </div>
-        </div>
-    </div>
+def warm_up_detector(detector):
+    """Run a blank frame through the model so the first request does not pay for lazy initialisation"""
+    from inference import warm_up
+    warm_up(detector, ladder.size)
+    if models.fused is not None:
+        warm_up(models.fused, ladder.size)
 
-    <script>
-        function previewImage() {
-            const preview = document.getElementById('preview');
-            const file = document.getElementById('image').files[0];
-            const reader = new FileReader();
-            
-            reader.onloadend = function() {
-                preview.src = reader.result;
-                preview.classList.remove('d-none');
-            }
-            
-            if (file) {
-                reader.readAsDataURL(file);
-            } else {
-                preview.src = '';
-                preview.classList.add('d-none');
-            }
-        }
+def create_app():
+    """Create the Flask app and start loading the model in the background"""
+    with startup_timer.phase('create_app'):
+        app = Flask(__name__)
+        app.register_blueprint(bp)
+        app.register_blueprint(shared_routes(models, ladder, ANALYTICS_PATH))
         
-        function updateConfValue() {
-            const value = document.getElementById('confidence').value;
-            document.getElementById('conf-value').textContent = value;
-        }
-        
-        function getConfidenceClass(conf) {
-            if (conf > 0.7) return 'confidence-high';
-            if (conf > 0.5) return 'confidence-medium';
-            return 'confidence-low';
-        }
-        
-        document.getElementById('upload-form').addEventListener('submit', function(e) {
-            e.preventDefault();
-            
-            const formData = new FormData(this);
-            const loading = document.getElementById('loading');
-            const resultContainer = document.getElementById('result-container');
-            
-            // Show loading indicator
-            loading.classList.remove('d-none');
-            resultContainer.style.display = 'none';
-            
-            fetch('/detect', {
-                method: 'POST',
-                body: formData
-            })
-            .then(response => response.json())
-            .then(data => {
-                // Hide loading indicator
-                loading.classList.add('d-none');
-                
-                if (data.success) {
-                    // Display results
-                    document.getElementById('result-image').src = data.result_path + '?' + new Date().getTime();
-                    document.getElementById('download-btn').href = data.result_path;
-                    document.getElementById('download-btn').download = 'detection_result.jpg';
-                    document.getElementById('inference-time').textContent = data.inference_time;
-                    document.getElementById('detection-count').textContent = data.detection_count;
-                    
-                    // Clear previous detections
-                    const detectionsList = document.getElementById('detections-list');
-                    detectionsList.innerHTML = '';
-                    
-                    // Add new detections
-                    data.detections.forEach((det, index) => {
-                        const detItem = document.createElement('div');
-                        detItem.className = 'detection-item';
-                        const confClass = getConfidenceClass(det.confidence);
-                        
-                        detItem.innerHTML = `
-                            <h5>Detection #${index+1}: ${det.class}</h5>
-                            <p>Confidence: <span class="${confClass}">${(det.confidence * 100).toFixed(1)}%</span></p>
-                            <p>Bounding Box: X: ${det.bbox[0].toFixed(1)} to ${det.bbox[2].toFixed(1)}, 
-                               Y: ${det.bbox[1].toFixed(1)} to ${det.bbox[3].toFixed(1)}</p>
-                        `;
-                        detectionsList.appendChild(detItem);
-                    });
-                    
-                    // Show result container
-                    resultContainer.style.display = 'block';
-                } else {
-                    alert('Error: ' + data.error);
-                }
-            })
-            .catch(error => {
-                loading.classList.add('d-none');
-                alert('Error: ' + error);
-            });
-        });
-    </script>
-</body>
-</html>
-    ''')
+        # Create directories for uploads and results
+        os.makedirs('static/uploads', exist_ok=True)
+        os.makedirs('static/results', exist_ok=True)
+    
+    # The server accepts requests (and answers /ready) while the model warms up
+    startup_timer.start_background(load_detector, warm_up_detector, HEAVY_IMPORTS)
+    return app
+
+startup_timer.record('imports', time.perf_counter() - startup_timer.created)
 
 if __name__ == '__main__':
-    print("Initializing YOLOv5 model...")
-    # Initialize model
-    load_model()
-    
-    # Run the Flask application
+    # Run the Flask application; the model loads in the background
     print("Starting Flask server...")
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    create_app().run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
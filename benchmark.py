@@ -0,0 +1,130 @@
+"""Benchmark each model at every step of the inference resolution ladder
+
+For every model and size the script reports latency and how far the
+detections drift from the full 640 px run on the same images (recall and
+precision of the smaller size against the 640 output, matched per class at
+IoU 0.5). This shows what each step down the ladder costs in accuracy.
+
+With --backends, every optimized CPU mode from optimized.py is measured too,
+against the same eager 640 px reference. The first-call column includes
+tracing or compiling (or loading the cached graph on later runs).
+
+Usage:
+    python benchmark.py --models best.pt garbage.pt cars.pt --images static/uploads
+    python benchmark.py --models best.pt --backends eager fuse trace compile --threads 4
+"""
+import argparse
+import glob
+import os
+import time
+
+import numpy as np
+import cv2
+
+from inference import load_yolo_model, results_to_array, match_detections
+from resolution import INFERENCE_SIZES
+from optimized import OPTIMIZE_MODES, configure_threads
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+def load_images(image_dir, limit=None):
+    """Decode the benchmark images once (RGB) so decode time is not measured"""
+    paths = sorted(p for p in glob.glob(os.path.join(image_dir, '*')) if p.lower().endswith(IMAGE_EXTENSIONS))
+    if limit:
+        paths = paths[:limit]
+    return [cv2.cvtColor(cv2.imread(p), cv2.COLOR_BGR2RGB) for p in paths]
+
+
+def run_model(model, images, size, warmup=2):
+    """Run the model over all images at one size; returns per-image detections, latencies and the first call's time"""
+    first_time = None
+    for img in images[:warmup]:
+        start_time = time.perf_counter()
+        model(img, size=size)
+        if first_time is None:
+            first_time = time.perf_counter() - start_time
+    dets, latencies = [], []
+    for img in images:
+        start_time = time.perf_counter()
+        results = model(img, size=size)
+        latencies.append(time.perf_counter() - start_time)
+        dets.append(results_to_array(results))
+    return dets, latencies, first_time
+
+
+def benchmark_model(model_path, images, sizes, conf_threshold, iou_threshold, backends=('eager',)):
+    """Benchmark one model at every size and backend against its own eager 640 px output"""
+    eager = load_yolo_model(model_path, conf_threshold, iou_threshold, force_reload=False)
+    reference, _, _ = run_model(eager, images, max(sizes))
+    rows = []
+    for backend in backends:
+        if backend == 'eager':
+            model = eager
+        else:
+            model = load_yolo_model(model_path, conf_threshold, iou_threshold, optimize=backend)
+        for size in sorted(sizes, reverse=True):
+            dets, latencies, first_time = run_model(model, images, size)
+            rows.append(compare(model_path, backend, size, dets, reference, latencies, first_time))
+    return rows
+
+
+def compare(model_path, backend, size, dets, reference, latencies, first_time):
+    """One benchmark row: latency, and recall/precision against the reference detections"""
+    matches = sum(match_detections(d, r) for d, r in zip(dets, reference))
+    n_ref = sum(len(r) for r in reference)
+    n_det = sum(len(d) for d in dets)
+    return {
+        'model': os.path.basename(model_path),
+        'backend': backend,
+        'img_size': size,
+        'first_ms': 1000 * first_time,
+        'mean_ms': 1000 * np.mean(latencies),
+        'p95_ms': 1000 * np.percentile(latencies, 95),
+        'detections': n_det,
+        'recall_vs_640': matches / n_ref if n_ref else 1.0,
+        'precision_vs_640': matches / n_det if n_det else 1.0
+    }
+
+
+def print_table(rows):
+    """Print benchmark rows as an aligned text table"""
+    print(f"{'model':<14}{'backend':<9}{'size':>6}{'first ms':>10}{'mean ms':>10}{'p95 ms':>10}"
+          f"{'dets':>7}{'recall':>9}{'precision':>11}")
+    for row in rows:
+        print(f"{row['model']:<14}{row['backend']:<9}{row['img_size']:>6}{row['first_ms']:>10.1f}"
+              f"{row['mean_ms']:>10.1f}{row['p95_ms']:>10.1f}"
+              f"{row['detections']:>7}{row['recall_vs_640']:>9.3f}{row['precision_vs_640']:>11.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--models', nargs='+', default=['best.pt', 'garbage.pt', 'cars.pt'])
+    parser.add_argument('--images', default='static/uploads')
+    parser.add_argument('--sizes', nargs='+', type=int, default=list(INFERENCE_SIZES))
+    parser.add_argument('--limit', type=int, default=None, help='benchmark only the first N images')
+    parser.add_argument('--conf', type=float, default=0.25)
+    parser.add_argument('--iou', type=float, default=0.45)
+    parser.add_argument('--backends', nargs='+', default=['eager'], choices=('eager',) + OPTIMIZE_MODES)
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+    parser.add_argument('--interop-threads', type=int, default=None, help='torch inter-op threads')
+    args = parser.parse_args()
+    threads, interop_threads = configure_threads(args.threads, args.interop_threads)
+
+    images = load_images(args.images, args.limit)
+    if not images:
+        parser.error(f"no images found in {args.images}")
+    print(f"Benchmarking on {len(images)} images from {args.images} "
+          f"({threads} intra-op, {interop_threads} inter-op threads)")
+
+    rows = []
+    for model_path in args.models:
+        if not os.path.exists(model_path):
+            print(f"Skipping {model_path}: weights not found")
+            continue
+        rows.extend(benchmark_model(model_path, images, args.sizes, args.conf, args.iou, args.backends))
+    print_table(rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+"""Per-camera settings loaded from a JSON file
+
+The file maps a camera id to its settings, e.g.
+
+    {
+        "cam7": {
+            "homography": [[1, 0, 0], [0, 1, 0], [0, 0, 1]],
+            "preprocess": {"dark_threshold": 60, "blur_threshold": 80}
+        }
+    }
+
+Requests name their camera with a `camera` field; unknown cameras get no settings.
+"""
+import json
+import os
+
+CAMERA_CONFIG_PATH = os.environ.get('CAMERA_CONFIG', 'cameras.json')
+DEFAULT_CAMERA = 'default'
+
+_cameras = None
+
+
+def load_cameras(path=CAMERA_CONFIG_PATH):
+    """Load (once) and return the per-camera settings, or an empty dict if there is no config file"""
+    global _cameras
+    if _cameras is None:
+        if os.path.exists(path):
+            with open(path) as f:
+                _cameras = json.load(f)
+        else:
+            _cameras = {}
+    return _cameras
+
+
+def get_camera(camera_id):
+    """Return the settings for one camera (empty if it is not configured)"""
+    return load_cameras().get(camera_id or DEFAULT_CAMERA, {})
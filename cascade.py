@@ -0,0 +1,111 @@
+"""Confidence-based model cascade: a small model first, the main model on demand
+
+Every frame goes through the light model (e.g. a YOLOv5n export of the same
+classes). It runs at a low confidence floor so that uncertain candidates are
+visible too. A frame is escalated to the main model when the light model
+found anything it is unsure of (confidence below escalate_below) or any
+alert-relevant class. Otherwise the light model's detections above the
+requested confidence are the answer. Easy scenes never touch the main model.
+
+ModelCascade has the same infer/infer_batch interface as InferencePool, so
+it drops into the tiled, worker and video paths unchanged.
+"""
+import threading
+import time
+
+import numpy as np
+
+from tiling import batch_detector
+
+
+def _name_items(names):
+    """(index, name) pairs of a model's class names, which may be a list or a dict"""
+    return list(names.items()) if isinstance(names, dict) else list(enumerate(names))
+
+
+class ModelCascade:
+    """Run a small model on everything and the main model only where the small one is unsure"""
+
+    def __init__(self, light, heavy, escalate_below=0.5, alert_classes=(), floor=0.1):
+        self.light = light
+        self.heavy = heavy
+        self.escalate_below = escalate_below
+        self.floor = floor
+        self.names = heavy.names
+
+        # Light-model class index -> main-model class index, matched by name
+        heavy_index = {name: index for index, name in _name_items(heavy.names)}
+        light_names = _name_items(light.names)
+        missing = [name for _, name in light_names if name not in heavy_index]
+        if missing:
+            raise ValueError(f"Cascade model has classes the main model lacks: {', '.join(missing)}")
+        self._class_map = np.zeros(max(index for index, _ in light_names) + 1, dtype=np.float32)
+        for index, name in light_names:
+            self._class_map[index] = heavy_index[name]
+        self._alert_ids = np.array([heavy_index[name] for name in alert_classes if name in heavy_index], dtype=np.float32)
+
+        self._lock = threading.Lock()
+        self.frames = 0
+        self.escalated = 0
+        self.reasons = {'low_confidence': 0, 'alert_class': 0}
+        self.light_time = 0.0
+        self.heavy_time = 0.0
+
+    def infer_batch(self, images, conf=0.25, size=640):
+        """Detections for each image: the light model's, or the main model's where it escalated"""
+        start_time = time.perf_counter()
+        light = batch_detector(self.light, min(self.floor, conf))(images, size)
+        light_time = time.perf_counter() - start_time
+
+        results, escalate = [], []
+        low_confidence = alert_class = 0
+        for index, dets in enumerate(light):
+            dets = dets.copy()
+            dets[:, 5] = self._class_map[dets[:, 5].astype(np.int64)]
+            uncertain = bool((dets[:, 4] < self.escalate_below).any())
+            alert = bool(len(self._alert_ids) and np.isin(dets[:, 5], self._alert_ids).any())
+            if uncertain or alert:
+                escalate.append(index)
+                low_confidence += uncertain
+                alert_class += alert
+            results.append(dets[dets[:, 4] >= conf])
+
+        heavy_time = 0.0
+        if escalate:
+            start_time = time.perf_counter()
+            heavy = batch_detector(self.heavy, conf)([images[index] for index in escalate], size)
+            heavy_time = time.perf_counter() - start_time
+            for index, dets in zip(escalate, heavy):
+                results[index] = dets
+
+        with self._lock:
+            self.frames += len(images)
+            self.escalated += len(escalate)
+            self.reasons['low_confidence'] += low_confidence
+            self.reasons['alert_class'] += alert_class
+            self.light_time += light_time
+            self.heavy_time += heavy_time
+        return results
+
+    def infer(self, frame, conf=0.25, size=640, render=False):
+        """Run one frame through the cascade; results are never rendered here"""
+        return self.infer_batch([frame], conf, size)[0], None
+
+    def stats(self):
+        """Escalation rate and average cost per frame, against running the main model on everything"""
+        with self._lock:
+            avg_light = self.light_time / self.frames if self.frames else None
+            avg_heavy = self.heavy_time / self.escalated if self.escalated else None
+            avg_cost = (self.light_time + self.heavy_time) / self.frames if self.frames else None
+            return {
+                'frames': self.frames,
+                'escalated': self.escalated,
+                'escalation_rate': round(self.escalated / self.frames, 4) if self.frames else 0.0,
+                'reasons': dict(self.reasons),
+                'escalate_below': self.escalate_below,
+                'avg_light_ms': round(1000 * avg_light, 2) if avg_light is not None else None,
+                'avg_heavy_ms': round(1000 * avg_heavy, 2) if avg_heavy is not None else None,
+                'avg_cost_ms': round(1000 * avg_cost, 2) if avg_cost is not None else None,
+                # Share of the main-model-only cost saved (estimated from the escalated frames)
+                'saving': round(1 - avg_cost / avg_heavy, 4) if avg_heavy else None
+            }
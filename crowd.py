@@ -0,0 +1,185 @@
+"""Crowd detection: dense clusters of people found with a spatial grid hash
+
+A pedestrian count cannot tell a mob from people spread across a plaza. This
+stage looks at where the person boxes stand instead. Each person is placed at
+the bottom-centre of their box, and distances are measured in person heights,
+so people far from the camera (small boxes) are judged by the same standard
+as people close to it. Two people are neighbours when their feet are less
+than link_distance times their average height apart. Clusters are the
+connected groups of neighbours.
+
+Neighbours are found with a grid hash: people are bucketed into square cells
+about one link distance wide, and each person is compared only with the
+people in the few cells around them. Several hundred people take a few
+milliseconds per frame instead of O(n^2) pairwise distances.
+
+For each cluster the analysis reports its size, its area (convex hull of its
+boxes, in pixels and as a fraction of the frame) and its density in people
+per square person-height. A cluster of at least min_size people at min_density
+or more is a crowd.
+"""
+import math
+import os
+
+import numpy as np
+import cv2
+
+# Comma-separated substrings (case-insensitive) of the class names counted as people
+CROWD_CLASSES = tuple(name.strip().lower() for name in
+                      os.environ.get('CROWD_CLASSES', 'person,people,pedestrian').split(',') if name.strip())
+# Two people are neighbours when their feet are closer than this many person heights
+CROWD_LINK_DISTANCE = float(os.environ.get('CROWD_LINK_DISTANCE', 1.0))
+# A crowd is a cluster of at least CROWD_MIN_SIZE people with at least CROWD_MIN_DENSITY people per
+# square person-height
+CROWD_MIN_SIZE = int(os.environ.get('CROWD_MIN_SIZE', 10))
+CROWD_MIN_DENSITY = float(os.environ.get('CROWD_MIN_DENSITY', 0.5))
+
+
+def person_mask(dets, names, classes=CROWD_CLASSES):
+    """(N,) bool array of the detections whose class name contains one of the person substrings"""
+    people = {cls for cls in np.unique(dets[:, 5]).astype(int).tolist()
+              if any(word in str(names[cls]).lower() for word in classes)}
+    return np.isin(dets[:, 5].astype(int), list(people))
+
+
+def neighbour_pairs(points, heights, link_distance=CROWD_LINK_DISTANCE):
+    """(i, j) index arrays of the neighbouring people, each pair once
+
+    Cells are link_distance median heights wide. Each pair is found from its taller person, who searches
+    every cell within link_distance of their own height, so tall (near) people in a grid sized for the
+    median still find all their neighbours.
+    """
+    count = len(points)
+    if count < 2:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    cell = max(link_distance * float(np.median(heights)), 1.0)
+    keys = np.floor(points / cell).astype(np.int64)
+    grid = {}
+    for index, key in enumerate(map(tuple, keys.tolist())):
+        grid.setdefault(key, []).append(index)
+    grid = {key: np.array(indices) for key, indices in grid.items()}
+
+    # Search order: taller first, ties by index, so each pair is kept from exactly one side
+    rank = np.empty(count, dtype=np.int64)
+    rank[np.lexsort((np.arange(count), -heights))] = np.arange(count)
+    first, second = [], []
+    for i in range(count):
+        reach = int(math.ceil(link_distance * heights[i] / cell))
+        cx, cy = keys[i]
+        candidates = [grid[(x, y)] for x in range(cx - reach, cx + reach + 1)
+                      for y in range(cy - reach, cy + reach + 1) if (x, y) in grid]
+        candidates = np.concatenate(candidates)
+        candidates = candidates[rank[candidates] > rank[i]]
+        if not len(candidates):
+            continue
+        distance = np.hypot(*(points[candidates] - points[i]).T)
+        linked = candidates[distance < link_distance * (heights[candidates] + heights[i]) / 2]
+        first.append(np.full(len(linked), i))
+        second.append(linked)
+    if not first:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(first), np.concatenate(second)
+
+
+def cluster_labels(count, first, second):
+    """Connected-component label of each person (union-find over the neighbour pairs)"""
+    parent = list(range(count))
+
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in zip(first.tolist(), second.tolist()):
+        ri, rj = root(i), root(j)
+        if ri != rj:
+            parent[max(ri, rj)] = min(ri, rj)
+    return np.array([root(i) for i in range(count)], dtype=np.int64)
+
+
+def analyse_crowd(dets, names, frame_shape=None, classes=CROWD_CLASSES, link_distance=CROWD_LINK_DISTANCE,
+                  min_size=CROWD_MIN_SIZE, min_density=CROWD_MIN_DENSITY):
+    """People count, clusters of two or more (largest first) and local density of one frame's detections
+
+    classes=None counts every detection as a person (e.g. when the caller has already filtered them).
+    """
+    people = dets if classes is None else dets[person_mask(dets, names, classes)]
+    count = len(people)
+    result = {'people': count, 'clusters': [], 'crowds': 0, 'largest_crowd': 0,
+              'max_local_density': None, 'mean_local_density': None}
+    if count == 0:
+        return result
+
+    heights = np.maximum(people[:, 3] - people[:, 1], 1.0)
+    points = np.stack([(people[:, 0] + people[:, 2]) / 2, people[:, 3]], 1)
+    first, second = neighbour_pairs(points, heights, link_distance)
+
+    # Local density: people within the link distance per square person-height
+    neighbours = np.bincount(np.concatenate([first, second]), minlength=count)
+    local = (neighbours + 1) / (math.pi * link_distance ** 2)
+    result['max_local_density'] = round(float(local.max()), 3)
+    result['mean_local_density'] = round(float(local.mean()), 3)
+
+    labels = cluster_labels(count, first, second)
+    frame_area = float(frame_shape[0] * frame_shape[1]) if frame_shape is not None else None
+    for label in np.unique(labels):
+        members = np.where(labels == label)[0]
+        if len(members) < 2:
+            continue
+        boxes = people[members]
+        corners = np.concatenate([boxes[:, [0, 1]], boxes[:, [2, 1]], boxes[:, [2, 3]], boxes[:, [0, 3]]])
+        area = float(cv2.contourArea(cv2.convexHull(corners.astype(np.float32))))
+        mean_height = float(heights[members].mean())
+        density = len(members) / max(area / mean_height ** 2, 1e-9)
+        crowd = len(members) >= min_size and density >= min_density
+        result['clusters'].append({
+            'size': int(len(members)),
+            'area': round(area, 1),
+            'area_fraction': round(area / frame_area, 4) if frame_area else None,
+            'density': round(density, 3),
+            'bbox': [float(boxes[:, 0].min()), float(boxes[:, 1].min()),
+                     float(boxes[:, 2].max()), float(boxes[:, 3].max())],
+            'crowd': crowd
+        })
+        if crowd:
+            result['crowds'] += 1
+            result['largest_crowd'] = max(result['largest_crowd'], int(len(members)))
+    result['clusters'].sort(key=lambda c: -c['size'])
+    return result
+
+
+class CrowdSummary:
+    """Running summary of per-frame crowd analyses over a video job"""
+
+    def __init__(self):
+        self.frames = 0
+        self.crowd_frames = 0
+        self.peak_people = 0
+        self.largest_crowd = 0
+        self.peak_density = 0.0
+        self.first_crowd = None
+        self.last_crowd = None
+
+    def update(self, result, ts):
+        self.frames += 1
+        self.peak_people = max(self.peak_people, result['people'])
+        if result['max_local_density'] is not None:
+            self.peak_density = max(self.peak_density, result['max_local_density'])
+        if result['crowds']:
+            self.crowd_frames += 1
+            self.largest_crowd = max(self.largest_crowd, result['largest_crowd'])
+            if self.first_crowd is None:
+                self.first_crowd = ts
+            self.last_crowd = ts
+
+    def stats(self):
+        return {
+            'frames': self.frames,
+            'crowd_frames': self.crowd_frames,
+            'peak_people': self.peak_people,
+            'largest_crowd': self.largest_crowd,
+            'peak_local_density': round(self.peak_density, 3),
+            'first_crowd': self.first_crowd,
+            'last_crowd': self.last_crowd
+        }
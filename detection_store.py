@@ -0,0 +1,259 @@
+"""Persistent detection store (SQLite) with time and spatial indexes
+
+Every frame's detections are queued by the request or video thread and
+written by a single background thread in batched transactions, so the
+pipeline never waits on disk. Rows are indexed by camera, class and time.
+Box geometry goes into an R-tree, so questions like "all garbage sightings on
+camera 7 in the last 24h", "peak vehicle count per hour" or "everything
+inside this part of the frame" are index range scans, not table scans.
+"""
+import atexit
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from cameras import DEFAULT_CAMERA
+
+DETECTION_DB = os.environ.get('DETECTION_DB', 'detections.db')
+# Rows written per transaction, and the longest a row waits before its batch is flushed
+BATCH_SIZE = 2000
+FLUSH_INTERVAL = 1.0
+# Frames waiting to be written before new ones are dropped (the pipeline never blocks on the store)
+MAX_QUEUED_FRAMES = 10000
+# Bucket sizes accepted by counts()
+BUCKETS = {'minute': 60, 'hour': 3600, 'day': 86400}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS detections (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    camera TEXT NOT NULL,
+    source TEXT,
+    frame INTEGER,
+    class TEXT NOT NULL,
+    confidence REAL NOT NULL,
+    x1 REAL NOT NULL,
+    y1 REAL NOT NULL,
+    x2 REAL NOT NULL,
+    y2 REAL NOT NULL,
+    region TEXT
+);
+CREATE INDEX IF NOT EXISTS detections_camera_class_ts ON detections (camera, class, ts);
+CREATE INDEX IF NOT EXISTS detections_camera_ts ON detections (camera, ts);
+CREATE INDEX IF NOT EXISTS detections_class_ts ON detections (class, ts);
+CREATE INDEX IF NOT EXISTS detections_ts ON detections (ts);
+"""
+RTREE_SCHEMA = "CREATE VIRTUAL TABLE IF NOT EXISTS detection_boxes USING rtree(id, min_x, max_x, min_y, max_y)"
+
+COLUMNS = ('ts', 'camera', 'source', 'frame', 'class', 'confidence', 'x1', 'y1', 'x2', 'y2', 'region')
+
+
+def parse_time(value, now=None):
+    """Epoch seconds, or a duration ago such as '30m', '24h' or '7d' (None if empty)"""
+    if value in (None, ''):
+        return None
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    if value[-1] in units:
+        return (now or time.time()) - float(value[:-1]) * units[value[-1]]
+    return float(value)
+
+
+def parse_query(args):
+    """Query filters from request arguments; raises ValueError on malformed values"""
+    classes = args.get('class')
+    bbox = args.get('bbox')
+    if bbox:
+        bbox = [float(v) for v in bbox.split(',')]
+        if len(bbox) != 4:
+            raise ValueError('bbox must be x1,y1,x2,y2')
+    return {
+        'camera': args.get('camera') or None,
+        'classes': classes.split(',') if classes else None,
+        'since': parse_time(args.get('since')),
+        'until': parse_time(args.get('until')),
+        'bbox': bbox or None
+    }
+
+
+class DetectionStore:
+    """SQLite detection table with an asynchronous batch writer and an R-tree over the boxes"""
+
+    def __init__(self, path=DETECTION_DB, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.rows_written = 0
+        self.batches = 0
+        self.dropped = 0
+        self.errors = 0
+        self.write_time = 0.0
+        self._queue = queue.Queue(maxsize=MAX_QUEUED_FRAMES)
+        self._local = threading.local()
+
+        conn = self._connect()
+        conn.executescript(SCHEMA)
+        try:
+            conn.execute(RTREE_SCHEMA)
+            self.spatial = True
+        except sqlite3.OperationalError:
+            # SQLite built without R-tree support: box filters fall back to scanning the coordinates
+            self.spatial = False
+        conn.commit()
+
+        self._writer = threading.Thread(target=self._write_loop, name='detection-store-writer', daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def _connect(self):
+        """One connection per thread (SQLite connections are not shared across threads)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def add(self, camera, dets, names, ts=None, source=None, frame=None, regions=None):
+        """Queue one frame's (N, 6) detections for writing; never blocks the caller"""
+        if len(dets) == 0:
+            return
+        ts = time.time() if ts is None else ts
+        camera = camera or DEFAULT_CAMERA
+        rows = []
+        for i, (x1, y1, x2, y2, conf, cls) in enumerate(dets.tolist()):
+            rows.append((ts, camera, source, frame, names[int(cls)], conf, x1, y1, x2, y2,
+                         regions[i] if regions else None))
+        try:
+            self._queue.put_nowait(rows)
+        except queue.Full:
+            self.dropped += len(rows)
+
+    def _write_loop(self):
+        conn = self._connect()
+        stopped = False
+        while not stopped:
+            item = self._queue.get()
+            if item is None:
+                break
+            rows = list(item)
+            # Collect more frames until the batch is full or the oldest row has waited flush_interval
+            deadline = time.time() + self.flush_interval
+            while len(rows) < self.batch_size:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopped = True
+                    break
+                rows.extend(item)
+            self._write(conn, rows)
+
+    def _write(self, conn, rows):
+        """Insert one batch of rows (and their boxes) in a single transaction
+
+        SQLite assigns the row ids, so several processes can share one database file.
+        """
+        start_time = time.perf_counter()
+        sql = f"INSERT INTO detections ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})"
+        try:
+            with conn:
+                cursor = conn.cursor()
+                boxes = []
+                for row in rows:
+                    cursor.execute(sql, row)
+                    boxes.append((cursor.lastrowid, row[6], row[8], row[7], row[9]))
+                if self.spatial:
+                    cursor.executemany("INSERT INTO detection_boxes VALUES (?, ?, ?, ?, ?)", boxes)
+            self.rows_written += len(rows)
+            self.batches += 1
+        except sqlite3.Error as e:
+            self.errors += 1
+            print(f"Error writing {len(rows)} detections: {str(e)}")
+        self.write_time += time.perf_counter() - start_time
+
+    def _where(self, camera=None, classes=None, since=None, until=None, bbox=None):
+        """WHERE clause and parameters for the common filters"""
+        clauses, params = [], []
+        if camera is not None:
+            clauses.append("camera = ?")
+            params.append(camera)
+        if classes:
+            clauses.append(f"class IN ({', '.join('?' * len(classes))})")
+            params.extend(classes)
+        if since is not None:
+            clauses.append("ts >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("ts < ?")
+            params.append(until)
+        if bbox is not None:
+            # Boxes overlapping the query rectangle
+            x1, y1, x2, y2 = bbox
+            if self.spatial:
+                clauses.append("id IN (SELECT id FROM detection_boxes "
+                               "WHERE max_x >= ? AND min_x <= ? AND max_y >= ? AND min_y <= ?)")
+            else:
+                clauses.append("x2 >= ? AND x1 <= ? AND y2 >= ? AND y1 <= ?")
+            params.extend([x1, x2, y1, y2])
+        return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+    def query(self, camera=None, classes=None, since=None, until=None, bbox=None, limit=1000):
+        """Most recent detections matching the filters"""
+        where, params = self._where(camera, classes, since, until, bbox)
+        cursor = self._connect().execute(
+            f"SELECT {', '.join(COLUMNS)} FROM detections{where} ORDER BY ts DESC LIMIT ?", params + [limit])
+        return [dict(zip(COLUMNS, row)) for row in cursor]
+
+    def counts(self, camera=None, classes=None, since=None, until=None, bbox=None, bucket='hour', peak=False):
+        """Per-class detections per time bucket, or with peak=True the most seen in any one frame"""
+        size = BUCKETS[bucket]
+        where, params = self._where(camera, classes, since, until, bbox)
+        if peak:
+            # Rows of one frame share camera, source and timestamp
+            sql = (f"SELECT bucket, class, MAX(n) FROM ("
+                   f"SELECT CAST(ts / ? AS INTEGER) * ? AS bucket, class, COUNT(*) AS n FROM detections{where} "
+                   f"GROUP BY camera, source, ts, class) GROUP BY bucket, class ORDER BY bucket")
+        else:
+            sql = (f"SELECT CAST(ts / ? AS INTEGER) * ? AS bucket, class, COUNT(*) FROM detections{where} "
+                   f"GROUP BY bucket, class ORDER BY bucket")
+        buckets = {}
+        for start, cls, count in self._connect().execute(sql, [size, size] + params):
+            buckets.setdefault(start, {})[cls] = count
+        return [{'bucket': start, 'counts': counts} for start, counts in buckets.items()]
+
+    def stats(self):
+        """Rows written, queue depth and write cost"""
+        return {
+            'path': self.path,
+            'spatial_index': self.spatial,
+            'rows_written': self.rows_written,
+            'batches': self.batches,
+            'avg_batch_ms': round(1000 * self.write_time / self.batches, 2) if self.batches else None,
+            'queued_frames': self._queue.qsize(),
+            'dropped_rows': self.dropped,
+            'errors': self.errors,
+            'size_bytes': os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        }
+
+    def close(self):
+        """Flush queued detections and stop the writer"""
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join(timeout=10)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """Return the shared detection store, opening it on first use"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = DetectionStore()
+        return _store
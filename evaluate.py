@@ -0,0 +1,249 @@
+"""Accuracy-vs-latency evaluation across backends and serving settings
+
+Runs a labelled YOLO-format dataset through the serving code path
+(tiling.batch_detector and tiled_detect, the same calls /detect makes) for
+every combination of:
+
+- backend: eager, the optimized CPU modes (fuse, trace, compile) and ONNX
+  Runtime fp32 (onnx) or dynamically quantised int8 (int8)
+- input size (the tile size when tiled), tiled or not, and frame stride
+  (with stride N only every Nth image is inferred and the others reuse its
+  detections, as a video job with a motion gate or frame skipping would)
+
+For each combination it reports mAP@0.5, mAP@0.5:0.95, recall at the
+serving confidence (overall and per class) and the average and p95
+latency per image. Rows on the Pareto front (no other row is both faster
+and more accurate) are marked; those are the settings worth choosing from.
+
+The dataset is a directory of images with YOLO labels (class cx cy w h,
+normalised) in a parallel labels/ directory, as in yolov5's datasets:
+
+    dataset/images/*.jpg
+    dataset/labels/*.txt
+
+Class ids are the model's own.
+
+Usage:
+    python evaluate.py --model garbage.pt --data datasets/garbage/valid
+    python evaluate.py --model cars.pt --data datasets/cars/valid --backends eager trace onnx int8 \\
+        --sizes 640 416 --tiled 0 1 --strides 1 3 --output cars-eval.json
+"""
+import argparse
+import glob
+import json
+import os
+import time
+
+import numpy as np
+import cv2
+
+from inference import load_yolo_model, box_iou
+from tiling import tiled_detect, batch_detector
+from optimized import OPTIMIZE_MODES
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+BACKENDS = ('eager',) + OPTIMIZE_MODES + ('onnx', 'int8')
+# IoU thresholds of mAP@0.5:0.95
+IOU_THRESHOLDS = np.linspace(0.5, 0.95, 10)
+
+
+def label_path(image_path):
+    """YOLO label file of an image: .../images/x.jpg -> .../labels/x.txt"""
+    head, sep, tail = image_path.rpartition(os.sep + 'images' + os.sep)
+    base = head + os.sep + 'labels' + os.sep + tail if sep else image_path
+    return os.path.splitext(base)[0] + '.txt'
+
+
+def load_dataset(data_dir, limit=None):
+    """Images (RGB, in sorted order) and their ground truth as (M, 5) class, x1, y1, x2, y2 arrays"""
+    paths = sorted(p for p in glob.glob(os.path.join(data_dir, '**', '*'), recursive=True)
+                   if p.lower().endswith(IMAGE_EXTENSIONS))
+    if limit:
+        paths = paths[:limit]
+    images, labels = [], []
+    for path in paths:
+        img = cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2RGB)
+        height, width = img.shape[:2]
+        boxes = np.zeros((0, 5), dtype=np.float32)
+        if os.path.exists(label_path(path)):
+            rows = np.loadtxt(label_path(path), dtype=np.float32, ndmin=2)
+            if rows.size:
+                rows = rows[:, :5]
+                boxes = np.stack([rows[:, 0],
+                                  (rows[:, 1] - rows[:, 3] / 2) * width, (rows[:, 2] - rows[:, 4] / 2) * height,
+                                  (rows[:, 1] + rows[:, 3] / 2) * width, (rows[:, 2] + rows[:, 4] / 2) * height], 1)
+        images.append(img)
+        labels.append(boxes)
+    return images, labels
+
+
+def match_correct(dets, labels, iou_thresholds=IOU_THRESHOLDS):
+    """(N, T) flags: whether each detection matches an unmatched same-class label at each IoU threshold"""
+    correct = np.zeros((len(dets), len(iou_thresholds)), dtype=bool)
+    if len(dets) == 0 or len(labels) == 0:
+        return correct
+    iou = box_iou(dets[:, :4], labels[:, 1:])
+    iou[dets[:, None, 5] != labels[None, :, 0]] = 0
+    order = np.argsort(-dets[:, 4])
+    for t, threshold in enumerate(iou_thresholds):
+        matched = np.zeros(len(labels), dtype=bool)
+        for i in order:
+            candidates = np.where(~matched & (iou[i] >= threshold))[0]
+            if len(candidates):
+                matched[candidates[np.argmax(iou[i, candidates])]] = True
+                correct[i, t] = True
+    return correct
+
+
+def average_precision(recall, precision):
+    """Area under the precision envelope, sampled at 101 recall points (COCO)"""
+    recall = np.concatenate([[0.0], recall, [1.0]])
+    precision = np.concatenate([[1.0], precision, [0.0]])
+    precision = np.flip(np.maximum.accumulate(np.flip(precision)))
+    return float(np.interp(np.linspace(0, 1, 101), recall, precision).mean())
+
+
+def score(predictions, labels, names, serving_conf):
+    """mAP@0.5, mAP@0.5:0.95 and recall at serving_conf (overall and per class) of a whole run"""
+    correct = np.concatenate([match_correct(d, l) for d, l in zip(predictions, labels)])
+    dets = np.concatenate(predictions)
+    truth = np.concatenate([l[:, 0] for l in labels]).astype(np.int64)
+    classes = np.unique(truth)
+    ap = np.zeros((len(classes), len(IOU_THRESHOLDS)))
+    per_class = {}
+    for k, cls in enumerate(classes):
+        mask = dets[:, 5] == cls
+        n_truth = int((truth == cls).sum())
+        order = np.argsort(-dets[mask, 4])
+        hits = correct[mask][order]
+        tp = np.cumsum(hits, 0)
+        fp = np.cumsum(~hits, 0)
+        for t in range(len(IOU_THRESHOLDS)):
+            if len(order):
+                ap[k, t] = average_precision(tp[:, t] / n_truth, tp[:, t] / np.maximum(tp[:, t] + fp[:, t], 1))
+        served = dets[mask][:, 4] >= serving_conf
+        per_class[names[int(cls)]] = round(float(correct[mask][served, 0].sum()) / n_truth, 4)
+    served = dets[:, 4] >= serving_conf
+    return {
+        'map50': round(float(ap[:, 0].mean()), 4) if len(classes) else None,
+        'map50_95': round(float(ap.mean()), 4) if len(classes) else None,
+        'recall': round(float(correct[served, 0].sum()) / max(len(truth), 1), 4),
+        'per_class_recall': per_class
+    }
+
+
+def load_backend(model_path, backend, conf, iou):
+    """A model (or ONNX detector) for one backend; all work with tiling.batch_detector"""
+    if backend == 'eager':
+        return load_yolo_model(model_path, conf, iou)
+    if backend in OPTIMIZE_MODES:
+        return load_yolo_model(model_path, conf, iou, optimize=backend)
+    from onnx_backend import OnnxDetector
+    return OnnxDetector(load_yolo_model(model_path, conf, iou), model_path, int8=backend == 'int8', iou_threshold=iou)
+
+
+def run(model, images, size, tiled, stride, conf, iou, tile_overlap=0.2):
+    """Detections for every image with one setting (tiled: size is the tile size), and each inference's latency"""
+    detect_batch = batch_detector(model, conf)
+
+    def detect(img):
+        if tiled:
+            return tiled_detect(detect_batch, img, size, tile_overlap, None, iou)[0]
+        return detect_batch([img], size)[0]
+
+    # Not timed: first-call tracing, compiling or export
+    detect(images[0])
+    predictions, latencies = [], []
+    last = None
+    for index, img in enumerate(images):
+        if index % stride == 0 or last is None:
+            start_time = time.perf_counter()
+            last = detect(img)
+            latencies.append(time.perf_counter() - start_time)
+        predictions.append(last)
+    return predictions, latencies
+
+
+def mark_pareto(rows):
+    """Flag rows that no other row beats on both latency and mAP@0.5:0.95"""
+    for row in rows:
+        row['pareto'] = not any(
+            other is not row and other['ms_per_image'] <= row['ms_per_image'] and other['map50_95'] >= row['map50_95']
+            and (other['ms_per_image'] < row['ms_per_image'] or other['map50_95'] > row['map50_95'])
+            for other in rows)
+    return rows
+
+
+def print_table(rows):
+    """Print evaluation rows, fastest first, with the Pareto front marked"""
+    print(f"{'':<2}{'backend':<9}{'size':>6}{'tiled':>7}{'stride':>8}{'ms/img':>9}{'p95 ms':>9}"
+          f"{'mAP50':>8}{'mAP50-95':>10}{'recall':>8}")
+    for row in sorted(rows, key=lambda r: r['ms_per_image']):
+        print(f"{'*' if row['pareto'] else '':<2}{row['backend']:<9}{row['img_size']:>6}{str(row['tiled']):>7}"
+              f"{row['stride']:>8}{row['ms_per_image']:>9.1f}{row['p95_ms']:>9.1f}"
+              f"{row['map50']:>8.3f}{row['map50_95']:>10.3f}{row['recall']:>8.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', required=True)
+    parser.add_argument('--data', required=True, help='directory with images/ and labels/')
+    parser.add_argument('--backends', nargs='+', default=['eager'], choices=BACKENDS)
+    parser.add_argument('--sizes', nargs='+', type=int, default=[640])
+    parser.add_argument('--tiled', nargs='+', type=int, default=[0], choices=(0, 1))
+    parser.add_argument('--strides', nargs='+', type=int, default=[1])
+    parser.add_argument('--limit', type=int, default=None, help='evaluate only the first N images')
+    parser.add_argument('--conf', type=float, default=0.001, help='confidence for mAP (low, as in val.py)')
+    parser.add_argument('--serving-conf', type=float, default=0.25, help='confidence the recall is reported at')
+    parser.add_argument('--iou', type=float, default=0.45)
+    parser.add_argument('--output', default=None, help='write all rows (with per-class recall) as JSON')
+    args = parser.parse_args()
+
+    images, labels = load_dataset(args.data, args.limit)
+    if not images:
+        parser.error(f"no images found in {args.data}")
+    if not any(len(l) for l in labels):
+        parser.error(f"no labels found for the images in {args.data}")
+    print(f"Evaluating {args.model} on {len(images)} images ({sum(len(l) for l in labels)} labels) from {args.data}")
+
+    rows = []
+    for backend in args.backends:
+        try:
+            model = load_backend(args.model, backend, args.conf, args.iou)
+        except ImportError as e:
+            print(f"Skipping {backend}: {str(e)}")
+            continue
+        for size in args.sizes:
+            for tiled in args.tiled:
+                for stride in args.strides:
+                    predictions, latencies = run(model, images, size, bool(tiled), stride, args.conf, args.iou)
+                    row = {
+                        'model': os.path.basename(args.model),
+                        'backend': backend,
+                        'img_size': size,
+                        'tiled': bool(tiled),
+                        'stride': stride,
+                        # Inference time spread over every image, including the ones that reused detections
+                        'ms_per_image': 1000 * sum(latencies) / len(images),
+                        'p95_ms': 1000 * float(np.percentile(latencies, 95))
+                    }
+                    row.update(score(predictions, labels, model.names, args.serving_conf))
+                    rows.append(row)
+                    print(f"{backend} size {size} tiled {bool(tiled)} stride {stride}: "
+                          f"mAP50-95 {row['map50_95']} at {row['ms_per_image']:.1f} ms/img")
+    if not rows:
+        return
+
+    mark_pareto(rows)
+    print_table(rows)
+    print("\nPer-class recall on the Pareto front:")
+    for row in sorted((r for r in rows if r['pareto']), key=lambda r: r['ms_per_image']):
+        recalls = ', '.join(f"{name} {recall:.2f}" for name, recall in row['per_class_recall'].items())
+        print(f"  {row['backend']} {row['img_size']} tiled={row['tiled']} stride={row['stride']}: {recalls}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,274 @@
+"""Event clips: short pre/post-roll clips and snapshots around detection rules
+
+Instead of keeping a full re-encoded copy of every video, an EventRecorder
+keeps the last pre_seconds of frames in a bounded ring buffer (JPEG-encoded,
+so memory stays small and fixed). When one of the camera's rules fires on a
+frame's detections, it writes the buffered frames and then every frame up
+to post_seconds after the last trigger (at most max_seconds in total) to a
+short clip, and saves a JPEG snapshot of the triggering frame.
+
+Rules come from the camera's "events" list in cameras.json, or from
+EVENT_RULES (JSON) for cameras without one, e.g.
+
+    [{"name": "garbage", "classes": ["garbage"]},
+     {"name": "traffic", "classes": ["car", "truck", "bus"], "min_count": 10}]
+
+A rule fires when at least min_count detections of its classes (any class
+if omitted) reach min_confidence. A rule with a "crowd" entry instead fires
+on a dense cluster of people (see crowd.py), e.g.
+
+    {"name": "mob", "crowd": {"min_size": 15, "min_density": 0.8}}
+
+where "classes" (default: the CROWD_CLASSES person classes) picks the people.
+Unknown crowd settings are dropped with a warning; a rule without a "name" is
+rejected with a ValueError.
+"""
+import collections
+import json
+import math
+import os
+import threading
+
+import cv2
+
+from cameras import DEFAULT_CAMERA, get_camera
+
+EVENT_DIR = os.environ.get('EVENT_DIR', 'static/events')
+EVENT_PRE_SECONDS = float(os.environ.get('EVENT_PRE_SECONDS', 5))
+EVENT_POST_SECONDS = float(os.environ.get('EVENT_POST_SECONDS', 5))
+# Longest clip; a rule that keeps firing starts a new event after this
+EVENT_MAX_SECONDS = float(os.environ.get('EVENT_MAX_SECONDS', 60))
+# Quality of the buffered frames and the snapshots
+JPEG_QUALITY = 85
+# Finished events kept in memory for /events
+MAX_TRACKED_EVENTS = 500
+# Settings a rule's "crowd" entry may set (keyword arguments of crowd.analyse_crowd) and their types
+CROWD_RULE_SETTINGS = {'min_size': int, 'min_density': float, 'link_distance': float}
+
+
+class EventRule:
+    """Fire when enough detections of some classes reach a confidence"""
+
+    def __init__(self, name, classes=None, min_count=1, min_confidence=0.0, crowd=None):
+        self.name = name
+        self.classes = set(classes) if classes else None
+        self.min_count = min_count
+        self.min_confidence = min_confidence
+        # Keyword arguments for crowd.analyse_crowd (min_size, min_density, link_distance), or None
+        self.crowd = crowd
+
+    def matches(self, dets, names):
+        """Number of matching detections if the rule fires on this frame, else 0"""
+        dets = dets[dets[:, 4] >= self.min_confidence]
+        if self.classes is not None:
+            dets = dets[[names[int(cls)] in self.classes for cls in dets[:, 5]]] if len(dets) else dets
+        if self.crowd is not None:
+            # Size of the largest crowd among the people
+            from crowd import analyse_crowd, CROWD_CLASSES
+            return analyse_crowd(dets, names, classes=None if self.classes is not None else CROWD_CLASSES,
+                                 **self.crowd)['largest_crowd']
+        return len(dets) if len(dets) >= self.min_count else 0
+
+
+def parse_crowd(name, crowd):
+    """Keyword arguments for analyse_crowd from a rule's "crowd" entry (true or a dict of settings), or None"""
+    if not isinstance(crowd, dict):
+        return {} if crowd else None
+    unknown = sorted(set(crowd) - set(CROWD_RULE_SETTINGS))
+    if unknown:
+        # A typo would otherwise raise on every frame the rule is checked against
+        print(f"Ignoring unknown crowd settings for event rule {name}: {', '.join(unknown)} "
+              f"(expected {', '.join(CROWD_RULE_SETTINGS)})")
+    try:
+        return {key: cast(crowd[key]) for key, cast in CROWD_RULE_SETTINGS.items() if key in crowd}
+    except (TypeError, ValueError):
+        raise ValueError(f"Event rule {name}: crowd settings must be numbers")
+
+
+def parse_rules(rules):
+    """EventRules from a list of dicts (cameras.json / EVENT_RULES); "crowd" is true or a dict of settings
+
+    Raises ValueError for a rule without a name or with malformed settings.
+    """
+    parsed = []
+    for rule in rules or []:
+        if not isinstance(rule, dict) or not rule.get('name'):
+            raise ValueError(f"Every event rule needs a \"name\": {json.dumps(rule)}")
+        crowd = parse_crowd(rule['name'], rule.get('crowd'))
+        parsed.append(EventRule(rule['name'], rule.get('classes'), int(rule.get('min_count', 1)),
+                                float(rule.get('min_confidence', 0.0)), crowd))
+    return parsed
+
+
+def get_rules(camera_id):
+    """The camera's rules, or the EVENT_RULES defaults (ValueError if they are malformed)"""
+    camera = get_camera(camera_id)
+    if 'events' in camera:
+        return parse_rules(camera['events'])
+    return parse_rules(json.loads(os.environ.get('EVENT_RULES', '[]')))
+
+
+class EventRecorder:
+    """Ring buffer of recent frames that turns rule triggers into short clips and snapshots
+
+    time_offset is added to every timestamp (e.g. the recording start of a video whose frames are timed
+    from 0). With annotate=True the snapshot gets the detections drawn on (for raw camera frames).
+    """
+
+    def __init__(self, camera_id, source, rules, fps=25.0, pre_seconds=EVENT_PRE_SECONDS,
+                 post_seconds=EVENT_POST_SECONDS, max_seconds=EVENT_MAX_SECONDS, out_dir=EVENT_DIR,
+                 time_offset=0.0, annotate=False):
+        self.camera_id = camera_id or DEFAULT_CAMERA
+        self.source = source
+        self.rules = rules
+        self.time_offset = time_offset
+        self.annotate = annotate
+        self.pre_seconds = pre_seconds
+        self.post_seconds = post_seconds
+        self.max_seconds = max_seconds
+        self.out_dir = out_dir
+        self.events = []
+        self.frames_buffered = 0
+        self._lock = threading.Lock()
+        # (timestamp, JPEG bytes); the length bound keeps memory fixed
+        self._buffer = collections.deque()
+        self._event = None
+        self._writer = None
+        self.set_fps(fps)
+
+    def set_fps(self, fps):
+        """Size the ring buffer (and clips) for the source's frame rate"""
+        with self._lock:
+            self.fps = fps or 25.0
+            self._buffer = collections.deque(self._buffer, maxlen=max(1, math.ceil(self.pre_seconds * self.fps)))
+
+    def add_frame(self, frame, ts):
+        """Record one frame: into the open clip during an event, else into the ring buffer"""
+        ts += self.time_offset
+        with self._lock:
+            if self._event is not None:
+                if ts <= self._event['until']:
+                    self._write(frame)
+                    return
+                self._close_event()
+            ok, jpeg = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+            if ok:
+                self._buffer.append((ts, jpeg))
+                self.frames_buffered += 1
+
+    def check(self, dets, names, ts, frame=None):
+        """Evaluate the rules on a frame's detections; start or extend an event if any fires"""
+        fired = {}
+        for rule in self.rules:
+            count = rule.matches(dets, names)
+            if count:
+                fired[rule.name] = count
+        if not fired:
+            return None
+        ts += self.time_offset
+        if frame is not None and self.annotate:
+            from inference import draw_detections
+            frame = draw_detections(frame.copy(), dets, names)
+        with self._lock:
+            event = self._event
+            if event is not None and ts - event['started'] < self.max_seconds:
+                # Still going: keep recording until post_seconds after the last trigger
+                event['until'] = min(ts + self.post_seconds, event['started'] + self.max_seconds)
+                for name, count in fired.items():
+                    event['rules'][name] = max(event['rules'].get(name, 0), count)
+                return event
+            if event is not None:
+                self._close_event()
+            return self._open_event(fired, ts, frame)
+
+    def _open_event(self, fired, ts, frame):
+        """Start a clip with the buffered pre-roll and save the snapshot (caller holds the lock)"""
+        os.makedirs(self.out_dir, exist_ok=True)
+        base = f"{self.camera_id}_{self.source}_{int(ts * 1000)}_{'-'.join(sorted(fired))}"
+        base = ''.join(c if c.isalnum() or c in '-_.' else '_' for c in base)
+        event = {
+            'event_id': base,
+            'camera': self.camera_id,
+            'source': self.source,
+            'rules': dict(fired),
+            'started': ts,
+            'until': ts + self.post_seconds,
+            'clip_path': os.path.join(self.out_dir, base + '.mp4'),
+            'snapshot_path': os.path.join(self.out_dir, base + '.jpg'),
+            'pre_roll_frames': len(self._buffer),
+            'frames': 0,
+            'status': 'recording'
+        }
+        if frame is not None:
+            cv2.imwrite(event['snapshot_path'], frame, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+        elif self._buffer:
+            with open(event['snapshot_path'], 'wb') as f:
+                f.write(self._buffer[-1][1].tobytes())
+        else:
+            event['snapshot_path'] = None
+        self._event = event
+        # Pre-roll: everything still in the ring buffer
+        for _, jpeg in self._buffer:
+            self._write(cv2.imdecode(jpeg, cv2.IMREAD_COLOR))
+        self._buffer.clear()
+        return event
+
+    def _write(self, frame):
+        if self._writer is None:
+            self._writer = cv2.VideoWriter(self._event['clip_path'], cv2.VideoWriter_fourcc(*'mp4v'), self.fps,
+                                           (frame.shape[1], frame.shape[0]))
+        self._writer.write(frame)
+        self._event['frames'] += 1
+
+    def _close_event(self):
+        """Finish the open clip and record the event (caller holds the lock)"""
+        event, self._event = self._event, None
+        if self._writer is not None:
+            self._writer.release()
+            self._writer = None
+        else:
+            event['clip_path'] = None
+        event['status'] = 'complete'
+        event['duration'] = round(event['frames'] / self.fps, 2)
+        self.events.append(event)
+        _record(event)
+
+    def close(self):
+        """Finish an event that is still recording (end of the video or stream)"""
+        with self._lock:
+            if self._event is not None:
+                self._close_event()
+            self._buffer.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'events': len(self.events),
+                'recording': self._event is not None,
+                'buffered_frames': len(self._buffer),
+                'buffered_bytes': sum(len(jpeg) for _, jpeg in self._buffer)
+            }
+
+
+_events = collections.deque(maxlen=MAX_TRACKED_EVENTS)
+_events_lock = threading.Lock()
+
+
+def _record(event):
+    """Keep a finished event for /events and write its metadata next to the clip"""
+    with _events_lock:
+        _events.append(event)
+    try:
+        with open(os.path.join(os.path.dirname(event['clip_path'] or event['snapshot_path'] or EVENT_DIR),
+                               event['event_id'] + '.json'), 'w') as f:
+            json.dump(event, f)
+    except (OSError, TypeError) as e:
+        print(f"Error writing event metadata: {str(e)}")
+
+
+def recent_events(camera=None, since=None, limit=100):
+    """Most recent finished events, newest first"""
+    with _events_lock:
+        events = [event for event in reversed(_events)
+                  if (camera is None or event['camera'] == camera) and (since is None or event['started'] >= since)]
+    return events[:limit]
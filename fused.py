@@ -0,0 +1,194 @@
+"""Fused inference: several YOLOv5 models on one shared input tensor
+
+Running garbage.pt, cars.pt and best.pt through their own AutoShape wrappers
+letterboxes, normalises and copies every frame three times. FusedDetector
+does it once: it letterboxes the frame the way AutoShape does (long side
+scaled to size, each side padded up to a multiple of the stride, so a 16:9
+frame is not padded to a square), builds a single normalised tensor, and
+runs each model's network on that tensor concurrently on a thread pool
+(torch releases the GIL during the forward pass). Each model's output goes
+through confidence filtering and class-aware NMS, is mapped back to frame
+coordinates, and is merged into one detection array.
+Class names are namespaced by model ("cars/car", "garbage/bottle").
+"""
+import concurrent.futures
+import math
+import os
+import threading
+import time
+
+import numpy as np
+import cv2
+import torch
+
+from inference import class_nms
+
+# Candidates kept per model before NMS (highest confidence first)
+MAX_CANDIDATES = 3000
+# Detections kept per model after NMS
+MAX_DETECTIONS = 1000
+
+
+def model_stride(model):
+    """Largest stride of a hub model's network (at least 32, like AutoShape)"""
+    stride = getattr(model, 'stride', None)
+    return max(int(torch.as_tensor(stride).max()), 32) if stride is not None else 32
+
+
+def letterbox_shape(shapes, size, stride=32):
+    """(height, width) a batch of image shapes is letterboxed to: long side size, sides rounded up to the stride"""
+    height = max(shape[0] / max(shape[:2]) for shape in shapes) * size
+    width = max(shape[1] / max(shape[:2]) for shape in shapes) * size
+    return math.ceil(height / stride) * stride, math.ceil(width / stride) * stride
+
+
+def letterbox(img, shape, color=114):
+    """Resize keeping the aspect ratio and pad to shape (height, width); returns (image, scale, (pad_x, pad_y))"""
+    height, width = img.shape[:2]
+    scale = min(shape[0] / height, shape[1] / width)
+    new_width, new_height = round(width * scale), round(height * scale)
+    if (new_width, new_height) != (width, height):
+        img = cv2.resize(img, (new_width, new_height), interpolation=cv2.INTER_LINEAR)
+    pad_x, pad_y = (shape[1] - new_width) // 2, (shape[0] - new_height) // 2
+    padded = np.full((shape[0], shape[1], 3), color, dtype=np.uint8)
+    padded[pad_y:pad_y + new_height, pad_x:pad_x + new_width] = img
+    return padded, scale, (pad_x, pad_y)
+
+
+def unletterbox(dets, scale, pad, shape):
+    """Map (N, 6) detections on a letterboxed image back to the original image, in place"""
+    pad_x, pad_y = pad
+    dets[:, [0, 2]] = np.clip((dets[:, [0, 2]] - pad_x) / scale, 0, shape[1])
+    dets[:, [1, 3]] = np.clip((dets[:, [1, 3]] - pad_y) / scale, 0, shape[0])
+    return dets
+
+
+def decode_predictions(pred, conf_threshold, iou_threshold):
+    """Turn one image's raw (N, 5 + classes) YOLOv5 output into an (N, 6) x1, y1, x2, y2, conf, cls array"""
+    pred = pred[pred[:, 4] > conf_threshold]
+    scores = pred[:, 5:] * pred[:, 4:5]
+    cls = scores.argmax(1)
+    conf = scores[np.arange(len(pred)), cls]
+    keep = conf > conf_threshold
+    pred, cls, conf = pred[keep], cls[keep], conf[keep]
+    if len(pred) > MAX_CANDIDATES:
+        top = np.argsort(-conf)[:MAX_CANDIDATES]
+        pred, cls, conf = pred[top], cls[top], conf[top]
+
+    xy, half_wh = pred[:, :2], pred[:, 2:4] / 2
+    dets = np.concatenate([xy - half_wh, xy + half_wh, conf[:, None], cls[:, None]], axis=1).astype(np.float32)
+    return class_nms(dets, iou_threshold)[:MAX_DETECTIONS]
+
+
+class FusedDetector:
+    """Run several models on one preprocessed frame and merge their detections"""
+
+    def __init__(self, models, iou_threshold=0.45):
+        # models: {model path: loaded AutoShape model}
+        self.models = {os.path.splitext(os.path.basename(path))[0]: model for path, model in models.items()}
+        self.iou_threshold = iou_threshold
+        # The shared input is padded to a multiple of every model's stride
+        self.stride = max(model_stride(model) for model in self.models.values())
+        self.names = []
+        self._offsets = {}
+        for key, model in self.models.items():
+            names = model.names
+            names = [names[i] for i in sorted(names)] if isinstance(names, dict) else list(names)
+            self._offsets[key] = len(self.names)
+            self.names.extend(f"{key}/{name}" for name in names)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(self.models),
+                                                               thread_name_prefix='fused-model')
+        self._lock = threading.Lock()
+        self.frames = 0
+        self.stage_time = {'preprocess': 0.0, 'forward': 0.0, 'postprocess': 0.0}
+        self.model_time = {key: 0.0 for key in self.models}
+
+    def _forward(self, key, tensor):
+        """One model's raw predictions for every image of the shared tensor, and how long its forward pass took"""
+        start_time = time.perf_counter()
+        with torch.inference_mode():
+            # AutoShape.model is the bare network; it skips AutoShape's own preprocessing
+            pred = self.models[key].model(tensor)
+        if isinstance(pred, (list, tuple)):
+            pred = pred[0]
+        return pred.float().cpu().numpy(), time.perf_counter() - start_time
+
+    def _forward_all(self, tensor):
+        """Every model's output for the tensor: concurrently, or one after another once closed"""
+        try:
+            futures = {key: self._executor.submit(self._forward, key, tensor) for key in self.models}
+        except RuntimeError:
+            # Closed by a hot swap while a job still holds this detector
+            return {key: self._forward(key, tensor) for key in self.models}
+        return {key: future.result() for key, future in futures.items()}
+
+    def detect_batch(self, images, conf=0.25, size=640):
+        """Merged (N, 6) detections of all models per RGB image, with class ids into self.names
+
+        The images are letterboxed to one shape and stacked, so each model runs one forward pass per batch.
+        """
+        start_time = time.perf_counter()
+        shape = letterbox_shape([img.shape for img in images], size, self.stride)
+        boxed = [letterbox(img, shape) for img in images]
+        tensor = torch.from_numpy(np.ascontiguousarray(np.stack([padded for padded, _, _ in boxed])
+                                                       .transpose(0, 3, 1, 2))).float().div_(255.0)
+        preprocess_time = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        outputs = self._forward_all(tensor)
+        forward_time = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        results = []
+        for index, (img, (_, scale, pad)) in enumerate(zip(images, boxed)):
+            merged = []
+            for key, (pred, _) in outputs.items():
+                dets = decode_predictions(pred[index], conf, self.iou_threshold)
+                dets[:, 5] += self._offsets[key]
+                merged.append(dets)
+            results.append(unletterbox(np.concatenate(merged), scale, pad, img.shape))
+        postprocess_time = time.perf_counter() - start_time
+
+        with self._lock:
+            self.frames += len(images)
+            self.stage_time['preprocess'] += preprocess_time
+            self.stage_time['forward'] += forward_time
+            self.stage_time['postprocess'] += postprocess_time
+            for key, (_, seconds) in outputs.items():
+                self.model_time[key] += seconds
+        return results
+
+    def detect(self, img, conf=0.25, size=640):
+        """Merged (N, 6) detections of all models on an RGB image, with class ids into self.names"""
+        return self.detect_batch([img], conf, size)[0]
+
+    def infer(self, frame, conf=0.25, size=640, render=False):
+        """Run one frame through all models; results are never rendered here"""
+        return self.detect(frame, conf, size), None
+
+    def infer_batch(self, images, conf=0.25, size=640):
+        """Detections per image, from one forward pass per model for the whole batch"""
+        if not images:
+            return []
+        return self.detect_batch(images, conf, size)
+
+    def close(self):
+        """Stop the model threads (e.g. once a hot swap has replaced this detector)"""
+        self._executor.shutdown(wait=False)
+
+    def stats(self):
+        """Average time per stage and per model; forward runs the models concurrently"""
+        with self._lock:
+            frames = self.frames
+            avg_ms = {stage: round(1000 * total / frames, 2) if frames else None
+                      for stage, total in self.stage_time.items()}
+            model_ms = {key: round(1000 * total / frames, 2) if frames else None
+                        for key, total in self.model_time.items()}
+        return {
+            'models': list(self.models),
+            'frames': frames,
+            'avg_ms': avg_ms,
+            'model_forward_ms': model_ms,
+            # What running the models one after another would have cost for the forward passes
+            'sequential_forward_ms': round(sum(model_ms.values()), 2) if frames else None
+        }
@@ -0,0 +1,111 @@
+"""Shared YOLOv5 loading and detection helpers used by the apps and workers"""
+import os
+
+import numpy as np
+import cv2
+import torch
+
+
+def load_yolo_model(model_path, conf_threshold, iou_threshold, force_reload=False, optimize=None,
+                    threads=None, interop_threads=None):
+    """Load a custom YOLOv5 model from the hub with path fix for Windows
+
+    optimize ('fuse', 'trace' or 'compile') swaps in the optimized CPU network from optimized.py.
+    threads and interop_threads size torch's thread pools whether or not the model is optimized.
+    """
+    from optimized import configure_threads, optimize_model
+
+    if os.name == 'nt':
+        # Fix for the PosixPath issue on Windows
+        import pathlib
+        pathlib.PosixPath = pathlib.WindowsPath
+
+    # Before loading, as inter-op threads can only be set before the first parallel work
+    configure_threads(threads, interop_threads)
+    model = torch.hub.load('ultralytics/yolov5', 'custom', path=model_path, force_reload=force_reload)
+    model.conf = conf_threshold
+    model.iou = iou_threshold
+    if optimize:
+        model = optimize_model(model, model_path, optimize)
+    return model
+
+
+def warm_up(detector, size=640):
+    """Run one blank frame through a model (or worker pool) so the first real request is not slow"""
+    blank = np.zeros((size, size, 3), dtype=np.uint8)
+    if hasattr(detector, 'infer'):
+        detector.infer(blank, size=size)
+    else:
+        detector(blank, size=size)
+
+
+def results_to_array(results, index=0):
+    """Return the detections of one image as an (N, 6) float32 array of x1, y1, x2, y2, conf, cls"""
+    return results.xyxy[index].cpu().numpy().astype(np.float32)
+
+
+def detections_to_list(dets, names):
+    """Convert an (N, 6) detection array into the JSON list returned by the API"""
+    detection_list = []
+    for x1, y1, x2, y2, conf, cls in dets.tolist():
+        detection_list.append({
+            'class': names[int(cls)],
+            'confidence': float(conf),
+            'bbox': [float(x1), float(y1), float(x2), float(y2)]
+        })
+    return detection_list
+
+
+def draw_detections(img, dets, names, hidden_labels=(), color=(0, 255, 0)):
+    """Draw boxes and class labels (without confidence) onto a BGR image in place"""
+    for x1, y1, x2, y2, conf, cls in dets.tolist():
+        x1, y1, x2, y2 = int(x1), int(y1), int(x2), int(y2)
+        cls_name = names[int(cls)]
+        cv2.rectangle(img, (x1, y1), (x2, y2), color, 2)
+        if cls_name not in hidden_labels:
+            cv2.putText(img, cls_name, (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 2)
+    return img
+
+
+def box_iou(boxes1, boxes2):
+    """Pairwise IoU between two sets of x1, y1, x2, y2 boxes, as an (N, M) array"""
+    boxes1 = np.asarray(boxes1, dtype=np.float32)[:, None, :4]
+    boxes2 = np.asarray(boxes2, dtype=np.float32)[None, :, :4]
+    inter_w = np.clip(np.minimum(boxes1[..., 2], boxes2[..., 2]) - np.maximum(boxes1[..., 0], boxes2[..., 0]), 0, None)
+    inter_h = np.clip(np.minimum(boxes1[..., 3], boxes2[..., 3]) - np.maximum(boxes1[..., 1], boxes2[..., 1]), 0, None)
+    inter = inter_w * inter_h
+    area1 = (boxes1[..., 2] - boxes1[..., 0]) * (boxes1[..., 3] - boxes1[..., 1])
+    area2 = (boxes2[..., 2] - boxes2[..., 0]) * (boxes2[..., 3] - boxes2[..., 1])
+    return inter / np.maximum(area1 + area2 - inter, 1e-9)
+
+
+def match_detections(dets, reference, iou_threshold=0.5):
+    """Greedily match detections to same-class reference boxes; returns the number of matches"""
+    if len(dets) == 0 or len(reference) == 0:
+        return 0
+    iou = box_iou(dets, reference)
+    iou[dets[:, None, 5] != reference[None, :, 5]] = 0
+    matched = np.zeros(len(reference), dtype=bool)
+    matches = 0
+    for i in np.argsort(-dets[:, 4]):
+        candidates = np.where(~matched & (iou[i] >= iou_threshold))[0]
+        if len(candidates):
+            matched[candidates[np.argmax(iou[i, candidates])]] = True
+            matches += 1
+    return matches
+
+
+def class_nms(dets, iou_threshold=0.45):
+    """Class-aware non-maximum suppression over an (N, 6) detection array"""
+    if len(dets) == 0:
+        return dets
+    # Shift each class into its own coordinate range so boxes of different classes never overlap
+    boxes = dets[:, :4] + dets[:, 5:6] * (dets[:, :4].max() + 1)
+    order = np.argsort(-dets[:, 4])
+    keep = []
+    while len(order):
+        i = order[0]
+        keep.append(i)
+        iou = box_iou(boxes[i:i + 1], boxes[order[1:]])[0]
+        order = order[1:][iou <= iou_threshold]
+    return dets[keep]
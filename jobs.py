@@ -0,0 +1,170 @@
+"""Live progress of video jobs, pushed to subscribers over Server-Sent Events
+
+The video pipeline reports each frame to its Job. At most every
+PUBLISH_INTERVAL seconds (and on every status change), the job serialises
+one snapshot: progress, fps, ETA and running detection counts. It then wakes
+everything waiting on it. Each subscriber only waits on a condition variable
+and re-sends the shared message, so a job costs the same however many
+clients watch it, and nothing touches the filesystem.
+"""
+import json
+import threading
+import time
+
+from results import result_url
+
+# Minimum seconds between two progress messages of one job
+PUBLISH_INTERVAL = 0.25
+# Seconds between keep-alive comments on an idle event stream
+HEARTBEAT_INTERVAL = 15.0
+# Number of finished jobs kept for late subscribers and status requests
+MAX_TRACKED_JOBS = 100
+
+FINISHED = ('complete', 'error')
+
+
+class Job:
+    """Progress of one video job, published to any number of subscribers"""
+
+    def __init__(self, job_id, output_path=None, model_version=None):
+        self.job_id = job_id
+        self.output_path = output_path
+        self.model_version = model_version
+        self.status = 'queued'
+        self.frames = 0
+        self.total_frames = 0
+        self.inferred = 0
+        self.detections = 0
+        self.classes = {}
+        self.last_detections = 0
+        self.started = None
+        self.finished = None
+        self.message = None
+        self.error = None
+        self.version = 0
+        self._message = None
+        self._published = 0.0
+        self._cond = threading.Condition()
+        with self._cond:
+            self._publish()
+
+    def start(self, total_frames=0):
+        """Mark the job as running; total_frames is 0 when the length is not known yet"""
+        with self._cond:
+            self.status = 'processing'
+            self.total_frames = total_frames
+            self.started = time.time()
+            self._publish()
+
+    def advance(self, dets=None, names=None):
+        """Count one processed frame, with its fresh detections if the model ran on it"""
+        with self._cond:
+            self.frames += 1
+            if dets is not None:
+                self.inferred += 1
+                self.last_detections = len(dets)
+                self.detections += len(dets)
+                for cls in dets[:, 5].astype(int).tolist():
+                    name = names[cls] if names is not None else str(cls)
+                    self.classes[name] = self.classes.get(name, 0) + 1
+            if time.time() - self._published >= PUBLISH_INTERVAL:
+                self._publish()
+
+    def add_frames(self, frames, classes=None):
+        """Count frames inferred elsewhere (e.g. by segment worker processes), with their per-class detections"""
+        with self._cond:
+            self.frames += frames
+            self.inferred += frames
+            for name, count in (classes or {}).items():
+                self.detections += count
+                self.classes[name] = self.classes.get(name, 0) + count
+            if time.time() - self._published >= PUBLISH_INTERVAL:
+                self._publish()
+
+    def finish(self, process_status):
+        """Record the pipeline's result dict and publish the final message"""
+        with self._cond:
+            self.status = 'complete' if process_status.get('success') else 'error'
+            self.message = process_status.get('message')
+            self.error = process_status.get('error')
+            self.finished = time.time()
+            self._publish()
+
+    def snapshot(self):
+        """Current progress as a JSON-serialisable dict"""
+        with self._cond:
+            return json.loads(self._message)
+
+    def _snapshot(self):
+        end = self.finished or time.time()
+        elapsed = end - self.started if self.started else 0.0
+        fps = self.frames / elapsed if elapsed > 0 else None
+        remaining = self.total_frames - self.frames if self.total_frames else None
+        return {
+            'job_id': self.job_id,
+            'status': self.status,
+            'frames': self.frames,
+            'total_frames': self.total_frames or None,
+            'progress': round(100.0 * min(self.frames / self.total_frames, 1.0), 1) if self.total_frames else None,
+            'fps': round(fps, 2) if fps else None,
+            'eta': round(remaining / fps, 1) if fps and remaining is not None and self.status == 'processing' else None,
+            'elapsed': round(elapsed, 2),
+            'inferred_frames': self.inferred,
+            'detections': self.detections,
+            'last_frame_detections': self.last_detections,
+            'classes': dict(self.classes),
+            'model_version': self.model_version,
+            'output_path': self.output_path if self.status == 'complete' else None,
+            'output_url': result_url(self.output_path) if self.status == 'complete' and self.output_path else None,
+            'message': self.message,
+            'error': self.error
+        }
+
+    def _publish(self):
+        """Serialise the snapshot once and wake every subscriber (caller holds the lock)"""
+        self._message = json.dumps(self._snapshot())
+        self._published = time.time()
+        self.version += 1
+        self._cond.notify_all()
+
+    def events(self, heartbeat=HEARTBEAT_INTERVAL):
+        """Server-Sent Events stream of progress messages, ending after the final one"""
+        version = 0
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self.version != version, heartbeat)
+                if self.version == version:
+                    message = None
+                else:
+                    version, message, status = self.version, self._message, self.status
+            if message is None:
+                # Comment line keeps proxies from closing an idle connection
+                yield ': keep-alive\n\n'
+                continue
+            yield f"data: {message}\n\n"
+            if status in FINISHED:
+                return
+
+
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+
+def create_job(job_id, output_path=None, model_version=None):
+    """Start tracking a job (replacing an earlier run with the same id)"""
+    job = Job(job_id, output_path, model_version)
+    with _jobs_lock:
+        _jobs.pop(job_id, None)
+        _jobs[job_id] = job
+        # Forget the oldest finished jobs beyond the limit
+        for old_id in [old_id for old_id, old in _jobs.items() if old.status in FINISHED]:
+            if len(_jobs) <= MAX_TRACKED_JOBS:
+                break
+            del _jobs[old_id]
+    return job
+
+
+def get_job(job_id):
+    """Return a tracked job, or None"""
+    with _jobs_lock:
+        return _jobs.get(job_id)
@@ -0,0 +1,413 @@
+"""Soak and load test for the serving apps, with leak and decay detection
+
+Replays the sample images and videos in static/uploads against a running
+app at fixed rates (open loop: requests are issued on schedule whether or
+not earlier ones finished, and latency counts from the scheduled time).
+Images go to /detect. Videos go to /upload_video and then /process_video/<id>.
+Every sample interval it records, for that window, throughput, latency
+percentiles and error rate. It also records the RSS, open file descriptors
+and threads (from /proc) of each server process under test (the --url and
+--video-url apps), and the files and bytes under the upload, result, event
+and temp directories.
+
+At the end (or on Ctrl-C) it fits a line through each resource series after
+the warm-up. It flags a leak when a series keeps growing with a good fit,
+and throughput decay when the last third of the run is slower than the
+first. The exit status is 1 if anything was flagged, and 2 if the run was too
+short to analyse (fewer than MIN_SAMPLES samples after the warm-up).
+
+Usage:
+    python app-photo.py &   # and/or python app-photo-copy.py on another port
+    python loadtest.py --url http://localhost:5000 --detect-rate 5 --duration 4h
+    python loadtest.py --video-url http://localhost:5001 --video-rate 0.05 --duration 8h --report soak.jsonl
+"""
+import argparse
+import glob
+import itertools
+import json
+import mimetypes
+import os
+import random
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv')
+# Directories whose growth is tracked (files the apps write per request)
+WATCHED_DIRS = ('static/uploads', 'static/results', 'static/events')
+# Prefixes of the apps' own temporary directories (FIFO uploads, video segments)
+TEMP_PREFIXES = ('upload-', 'segments-')
+# Samples needed after the warm-up before leaks and decay are analysed
+MIN_SAMPLES = 3
+
+
+def parse_duration(value):
+    """Seconds from '90', '30m', '4h' or '1d'"""
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    if value[-1] in units:
+        return float(value[:-1]) * units[value[-1]]
+    return float(value)
+
+
+def percentile(values, q):
+    """q-th percentile (0-100) of a list, by linear interpolation; None if empty"""
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * q / 100
+    lower = int(k)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (k - lower)
+
+
+def fit_line(xs, ys):
+    """Least-squares slope and r^2 of ys against xs"""
+    n = len(xs)
+    if n < 3:
+        return 0.0, 0.0
+    mean_x, mean_y = sum(xs) / n, sum(ys) / n
+    sxx = sum((x - mean_x) ** 2 for x in xs)
+    syy = sum((y - mean_y) ** 2 for y in ys)
+    sxy = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys))
+    if sxx == 0:
+        return 0.0, 0.0
+    slope = sxy / sxx
+    r2 = sxy * sxy / (sxx * syy) if syy else 0.0
+    return slope, r2
+
+
+def multipart(fields, files):
+    """Encode form fields and (name, path) files as multipart/form-data; returns (body, content type)"""
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, path in files.items():
+        content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        with open(path, 'rb') as f:
+            data = f.read()
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; '
+                     f'filename="{os.path.basename(path)}"\r\nContent-Type: {content_type}\r\n\r\n'.encode()
+                     + data + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+def http(method, url, body=None, content_type=None, timeout=600):
+    """One request; returns (status, parsed JSON or None)"""
+    request = urllib.request.Request(url, data=body, method=method)
+    if content_type:
+        request.add_header('Content-Type', content_type)
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            status, payload = response.status, response.read()
+    except urllib.error.HTTPError as e:
+        status, payload = e.code, e.read()
+    try:
+        return status, json.loads(payload)
+    except ValueError:
+        return status, None
+
+
+def detect(base_url, path):
+    """POST an image to /detect"""
+    body, content_type = multipart({}, {'image': path})
+    status, payload = http('POST', f"{base_url}/detect", body, content_type)
+    return status == 200 and bool(payload and payload.get('success')), status
+
+
+def process_video(base_url, path):
+    """Upload a video and process it (synchronously, so the latency covers the whole job)"""
+    body, content_type = multipart({}, {'video': path})
+    status, payload = http('POST', f"{base_url}/upload_video", body, content_type)
+    if status != 200 or not payload or not payload.get('success'):
+        return False, status
+    extension = os.path.splitext(path)[1]
+    status, payload = http('GET', f"{base_url}/process_video/{payload['video_id']}?file_extension={extension}")
+    return status == 200 and bool(payload and payload.get('success')), status
+
+
+def find_pid(port):
+    """PID of the local process listening on a TCP port (from /proc), or None"""
+    inodes = set()
+    for table in ('/proc/net/tcp', '/proc/net/tcp6'):
+        try:
+            with open(table) as f:
+                next(f)
+                for line in f:
+                    fields = line.split()
+                    # State 0A is LISTEN
+                    if int(fields[1].rsplit(':', 1)[1], 16) == port and fields[3] == '0A':
+                        inodes.add(fields[9])
+        except OSError:
+            continue
+    targets = {f"socket:[{inode}]" for inode in inodes}
+    for fd_dir in glob.glob('/proc/[0-9]*/fd'):
+        try:
+            if any(os.readlink(os.path.join(fd_dir, fd)) in targets for fd in os.listdir(fd_dir)):
+                return int(fd_dir.split('/')[2])
+        except OSError:
+            continue
+    return None
+
+
+def process_resources(pid):
+    """RSS (MB), open file descriptors and threads of a process, from /proc"""
+    if pid is None:
+        return {}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            status = dict(line.split(':', 1) for line in f if ':' in line)
+        return {
+            'rss_mb': int(status['VmRSS'].split()[0]) / 1024,
+            'fds': len(os.listdir(f"/proc/{pid}/fd")),
+            'threads': int(status['Threads'])
+        }
+    except (OSError, KeyError, ValueError):
+        return {}
+
+
+def disk_usage(dirs=WATCHED_DIRS, temp_prefixes=TEMP_PREFIXES):
+    """Files and bytes under the watched directories and the apps' temporary directories"""
+    files = size = 0
+    roots = list(dirs) + [entry.path for entry in os.scandir(tempfile.gettempdir())
+                          if entry.is_dir() and entry.name.startswith(temp_prefixes)]
+    for root in roots:
+        for dirpath, _, filenames in os.walk(root):
+            for name in filenames:
+                try:
+                    size += os.path.getsize(os.path.join(dirpath, name))
+                    files += 1
+                except OSError:
+                    continue
+    return {'files': files, 'disk_mb': size / 2 ** 20}
+
+
+class LoadTest:
+    """Open-loop traffic at fixed rates, with periodic latency and resource samples"""
+
+    def __init__(self, targets, concurrency, pids=None, poisson=False):
+        # targets: [(name, rate per second, request function, samples)]
+        self.targets = targets
+        # Server processes to watch, by label (host:port)
+        self.pids = pids or {}
+        self.poisson = poisson
+        self.samples = []
+        self._results = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='loadtest')
+        self.in_flight = 0
+
+    def _call(self, name, func, path, scheduled):
+        try:
+            ok, status = func(path)
+        except Exception as e:
+            ok, status = False, type(e).__name__
+        with self._lock:
+            self.in_flight -= 1
+            self._results.append((name, time.time() - scheduled, ok, status))
+
+    def _generate(self, name, rate, func, paths):
+        """Issue requests on a fixed (or Poisson) schedule, cycling through the sample files"""
+        cycle = itertools.cycle(paths)
+        next_time = time.time()
+        while not self._stopped.is_set():
+            next_time += random.expovariate(rate) if self.poisson else 1.0 / rate
+            if self._stopped.wait(max(0.0, next_time - time.time())):
+                break
+            with self._lock:
+                self.in_flight += 1
+            self._executor.submit(self._call, name, func, next(cycle), next_time)
+
+    def sample(self, elapsed, interval):
+        """Summarise the window since the last sample and record the server's resources"""
+        with self._lock:
+            results, self._results = self._results, []
+            in_flight = self.in_flight
+        sample = {'elapsed': round(elapsed, 1), 'in_flight': in_flight}
+        for name, *_ in self.targets:
+            latencies = [latency for n, latency, _, _ in results if n == name]
+            errors = [status for n, _, ok, status in results if n == name and not ok]
+            sample[name] = {
+                'requests': len(latencies),
+                'throughput': round(len(latencies) / interval, 3),
+                'error_rate': round(len(errors) / len(latencies), 4) if latencies else None,
+                'p50_ms': round(1000 * percentile(latencies, 50), 1) if latencies else None,
+                'p95_ms': round(1000 * percentile(latencies, 95), 1) if latencies else None,
+                'p99_ms': round(1000 * percentile(latencies, 99), 1) if latencies else None,
+                'errors': sorted({str(status) for status in errors})
+            }
+        sample['servers'] = {label: process_resources(pid) for label, pid in self.pids.items()}
+        sample.update(disk_usage())
+        self.samples.append(sample)
+        return sample
+
+    def run(self, duration, interval, report=None):
+        generators = [threading.Thread(target=self._generate, args=(name, rate, func, paths), daemon=True)
+                      for name, rate, func, paths in self.targets]
+        start = time.time()
+        for thread in generators:
+            thread.start()
+        try:
+            while time.time() - start < duration:
+                time.sleep(min(interval, max(0.0, duration - (time.time() - start))))
+                sample = self.sample(time.time() - start, interval)
+                print_sample(sample, self.targets)
+                if report:
+                    with open(report, 'a') as f:
+                        f.write(json.dumps(sample) + '\n')
+        except KeyboardInterrupt:
+            print("Stopping early")
+        finally:
+            self._stopped.set()
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def print_sample(sample, targets):
+    """One progress line per sample"""
+    line = f"[{sample['elapsed']:>8.0f}s]"
+    for name, *_ in targets:
+        s = sample[name]
+        p95 = f"{s['p95_ms']:.0f}" if s['p95_ms'] is not None else '-'
+        error_rate = f"{100 * s['error_rate']:.1f}%" if s['error_rate'] is not None else '-'
+        line += f" {name}: {s['throughput']:.2f}/s p95 {p95} ms err {error_rate} |"
+    for label, resources in sample['servers'].items():
+        if resources:
+            line += (f" {label} rss {resources['rss_mb']:.0f} MB fds {resources['fds']} "
+                     f"threads {resources['threads']} |")
+    line += f" files {sample['files']} ({sample['disk_mb']:.0f} MB) in flight {sample['in_flight']}"
+    print(line)
+
+
+def after_warmup(samples, warmup):
+    """The samples taken after the warm-up, which the analysis looks at"""
+    return [s for s in samples if s['elapsed'] >= warmup]
+
+
+def analyse(samples, targets, warmup, rss_mb_per_hour=50.0, fds_per_hour=10.0, disk_mb_per_hour=500.0,
+            min_r2=0.6, max_decay=0.2):
+    """Findings: resource series that keep growing after the warm-up, and throughput/latency decay
+
+    Returns None when fewer than MIN_SAMPLES samples were taken after the warm-up.
+    """
+    samples = after_warmup(samples, warmup)
+    findings = []
+    if len(samples) < MIN_SAMPLES:
+        return None
+    hours = [s['elapsed'] / 3600 for s in samples]
+    # (name, values, growth rate limit, smallest total growth worth reporting, unit)
+    series = [('disk_mb', [s['disk_mb'] for s in samples], disk_mb_per_hour, 100, 'MB on disk'),
+              ('in_flight', [s['in_flight'] for s in samples], fds_per_hour, 8, 'requests in flight')]
+    process_series = (('rss_mb', rss_mb_per_hour, 32, 'MB'), ('fds', fds_per_hour, 8, 'fds'),
+                      ('threads', fds_per_hour, 4, 'threads'))
+    for label in samples[0]['servers']:
+        for key, limit, min_growth, unit in process_series:
+            if all(key in s['servers'].get(label, {}) for s in samples):
+                series.append((f"{key} of {label}", [s['servers'][label][key] for s in samples], limit,
+                               min_growth, unit))
+    for name, values, limit, min_growth, unit in series:
+        slope, r2 = fit_line(hours, values)
+        if slope > limit and r2 >= min_r2 and values[-1] - values[0] >= min_growth:
+            findings.append(f"Possible leak: {name} grows {slope:.1f} {unit}/h (r^2 {r2:.2f}), "
+                            f"{values[0]:.0f} -> {values[-1]:.0f}")
+
+    third = max(1, len(samples) // 3)
+    for name, *_ in targets:
+        first, last = samples[:third], samples[-third:]
+        first_rate = sum(s[name]['throughput'] for s in first) / len(first)
+        last_rate = sum(s[name]['throughput'] for s in last) / len(last)
+        if first_rate > 0 and last_rate < (1 - max_decay) * first_rate:
+            findings.append(f"Throughput decay on {name}: {first_rate:.2f}/s -> {last_rate:.2f}/s")
+        first_p95 = [s[name]['p95_ms'] for s in first if s[name]['p95_ms'] is not None]
+        last_p95 = [s[name]['p95_ms'] for s in last if s[name]['p95_ms'] is not None]
+        if first_p95 and last_p95:
+            before, after = sum(first_p95) / len(first_p95), sum(last_p95) / len(last_p95)
+            if after > (1 + 2 * max_decay) * before:
+                findings.append(f"Latency decay on {name}: p95 {before:.0f} ms -> {after:.0f} ms")
+        errors = [s[name]['error_rate'] for s in last if s[name]['error_rate'] is not None]
+        if errors and sum(errors) / len(errors) > 0.01:
+            findings.append(f"Errors on {name}: {100 * sum(errors) / len(errors):.1f}% in the last third")
+    return findings
+
+
+def sample_files(sample_dir, extensions):
+    """The sample files present before the run (the apps add their own uploads to the same directory)"""
+    return sorted(p for p in glob.glob(os.path.join(sample_dir, '*')) if p.lower().endswith(extensions))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:5000', help='photo app (for /detect)')
+    parser.add_argument('--video-url', default=None, help='video app (for /upload_video and /process_video)')
+    parser.add_argument('--detect-rate', type=float, default=2.0, help='images per second (0 disables)')
+    parser.add_argument('--video-rate', type=float, default=0.0, help='videos per second (0 disables)')
+    parser.add_argument('--samples', default='static/uploads', help='directory with sample images and videos')
+    parser.add_argument('--duration', default='1h', help="e.g. 600, 30m, 4h")
+    parser.add_argument('--interval', default='30s', help='seconds between samples')
+    parser.add_argument('--warmup', default='5m', help='ignored by the leak and decay analysis')
+    parser.add_argument('--concurrency', type=int, default=16, help='requests in flight at most')
+    parser.add_argument('--poisson', action='store_true', help='exponential inter-arrival times')
+    parser.add_argument('--pid', type=int, default=None, help='--url server process (default: found from the port)')
+    parser.add_argument('--video-pid', type=int, default=None,
+                        help='--video-url server process (default: found from the port)')
+    parser.add_argument('--report', default=None, help='append every sample to this JSON lines file')
+    args = parser.parse_args()
+
+    targets = []
+    if args.detect_rate > 0:
+        images = sample_files(args.samples, IMAGE_EXTENSIONS)
+        if not images:
+            parser.error(f"no images found in {args.samples}")
+        targets.append(('detect', args.detect_rate, lambda path: detect(args.url, path), images))
+    if args.video_rate > 0:
+        if not args.video_url:
+            parser.error('--video-rate needs --video-url')
+        videos = sample_files(args.samples, VIDEO_EXTENSIONS)
+        if not videos:
+            parser.error(f"no videos found in {args.samples}")
+        targets.append(('video', args.video_rate, lambda path: process_video(args.video_url, path), videos))
+    if not targets:
+        parser.error('nothing to do: set --detect-rate and/or --video-rate')
+
+    # One server process per app under test (both targets may point at the same one)
+    servers = []
+    if args.detect_rate > 0:
+        servers.append((args.url, args.pid))
+    if args.video_rate > 0:
+        servers.append((args.video_url, args.video_pid))
+    pids = {}
+    for url, pid in servers:
+        parts = urllib.parse.urlsplit(url)
+        label = f"{parts.hostname}:{parts.port or 80}"
+        if label in pids:
+            continue
+        pid = pid if pid is not None else find_pid(parts.port or 80)
+        print(f"Server process for {label}: {pid if pid is not None else 'not found (resources not tracked)'}")
+        if pid is not None:
+            pids[label] = pid
+
+    test = LoadTest(targets, args.concurrency, pids, args.poisson)
+    test.run(parse_duration(args.duration), parse_duration(args.interval), args.report)
+
+    warmup = parse_duration(args.warmup)
+    findings = analyse(test.samples, targets, warmup)
+    if findings is None:
+        # Inconclusive rather than a finding: nothing was measured long enough to judge
+        print(f"Not enough samples after the warm-up to analyse ({len(after_warmup(test.samples, warmup))} of "
+              f"{MIN_SAMPLES}); run longer or shorten --warmup")
+        raise SystemExit(2)
+    print("Findings:" if findings else "No leaks or decay detected")
+    for finding in findings:
+        print(f"  - {finding}")
+    raise SystemExit(1 if findings else 0)
+
+
+if __name__ == '__main__':
+    main()
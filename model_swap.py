@@ -0,0 +1,394 @@
+"""Hot model swap: load new weights in the background and switch over between requests
+
+Each app keeps the detectors it serves in a ServedModels: the main model
+(in-process or as a worker pool) and the cascade and fused detectors built on
+it. A swap is started by POST /model (admin only) or by a WeightsWatcher that
+notices the served weights file has been replaced. ServedModels builds a
+complete new set of detectors on the new weights while the old ones keep
+serving, warms them up, and then replaces them in one step under its load
+lock. Requests and video jobs that already hold the old detectors finish on
+them. Video jobs acquire() their detector for as long as they run; a
+replaced worker pool or fused detector is closed once no job holds it and
+it has been idle for RETIRE_IDLE_SECONDS.
+
+Every detector the apps build carries a version tag (weights stem and
+content hash), which the apps include in their responses.
+"""
+import collections
+import hmac
+import os
+import threading
+import time
+
+# Admin token (X-Admin-Token header) for POST /model and profiling; the admin endpoints are off without one
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+# Seconds between checks of the served weights file for a new version (0 disables the watcher)
+MODEL_WATCH_INTERVAL = float(os.environ.get('MODEL_WATCH_INTERVAL', 0))
+# A replaced worker pool or fused detector is closed after serving nothing for this long (and no job holds it)
+RETIRE_IDLE_SECONDS = float(os.environ.get('RETIRE_IDLE_SECONDS', 30))
+# Finished swaps kept for GET /model
+MAX_SWAP_HISTORY = 20
+
+
+def model_version(path):
+    """Version tag of a weights file: its stem and a short content hash, e.g. cars-3f2a9c01d4e5"""
+    from optimized import weights_hash
+    return f"{os.path.splitext(os.path.basename(path))[0]}-{weights_hash(path)}"
+
+
+def detector_version(detector):
+    """Version tag of a model, worker pool, cascade, fused detector or scheduler client (None if untagged)"""
+    return getattr(detector, 'version', None)
+
+
+def is_admin(token, admin_token=ADMIN_TOKEN):
+    """Whether a request's X-Admin-Token matches ADMIN_TOKEN (always False while it is unset)"""
+    return bool(admin_token) and hmac.compare_digest(token or '', admin_token)
+
+
+class ModelSwapper:
+    """Run hot swaps one at a time on a background thread and keep their history"""
+
+    def __init__(self, swap, path):
+        # swap(path) builds, warms up and installs detectors on the weights at path and returns their version
+        self._swap = swap
+        self._lock = threading.Lock()
+        self.current = None
+        self.history = collections.deque(maxlen=MAX_SWAP_HISTORY)
+        # Path and file signature of the weights being served, updated only when a swap completes
+        self.served = (path, _signature(path))
+
+    def start(self, path, trigger='api'):
+        """Begin swapping to the weights at path; returns the swap, or None while another one is running"""
+        with self._lock:
+            if self.current is not None:
+                return None
+            self.current = {
+                'path': path,
+                'trigger': trigger,
+                'status': 'loading',
+                'started': time.time(),
+                'version': None,
+                'error': None
+            }
+            swap = dict(self.current)
+            # The file as it was when loading began (a later rewrite is picked up as another change)
+            self._loading = _signature(path)
+        threading.Thread(target=self._run, name='model-swap', daemon=True).start()
+        return swap
+
+    def _run(self):
+        swap = self.current
+        try:
+            swap['version'] = self._swap(swap['path'])
+            swap['status'] = 'complete'
+        except Exception as e:
+            swap['status'] = 'error'
+            swap['error'] = str(e)
+            print(f"Error swapping model: {str(e)}")
+        swap['duration'] = round(time.time() - swap['started'], 2)
+        with self._lock:
+            if swap['status'] == 'complete':
+                self.served = (swap['path'], self._loading)
+            self.history.append(swap)
+            self.current = None
+
+    def busy(self):
+        """Whether a swap is running"""
+        with self._lock:
+            return self.current is not None
+
+    def stats(self):
+        """The swap in progress (if any) and recent swaps, newest first"""
+        with self._lock:
+            return {
+                'swapping': dict(self.current) if self.current is not None else None,
+                'history': [dict(swap) for swap in reversed(self.history)]
+            }
+
+
+def _signature(path):
+    try:
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+    except OSError:
+        return None
+
+
+class WeightsWatcher:
+    """Poll the served weights file and start a swap once a new version has been written
+
+    The served file and its signature come from the swapper, so swaps started through the API count as
+    well, and a swap that fails is tried again on the next change check.
+    """
+
+    def __init__(self, swapper, interval=10.0):
+        self.swapper = swapper
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, name='weights-watcher', daemon=True)
+        self._thread.start()
+        return self
+
+    def _loop(self):
+        pending = None
+        while not self._stopped.wait(self.interval):
+            if self.swapper.busy():
+                continue
+            path, served = self.swapper.served
+            signature = _signature(path)
+            if signature is None or signature == served:
+                pending = None
+            elif signature != pending:
+                # Changed since the last check: wait one more interval in case it is still being written
+                pending = signature
+            else:
+                self.swapper.start(path, 'watch')
+                pending = None
+
+    def stop(self):
+        self._stopped.set()
+
+
+# Number of running jobs holding each detector; retire() closes a detector only once it is no longer held
+_holders = collections.Counter()
+_holders_cond = threading.Condition()
+
+
+def _parts(detector, depth=3):
+    """The detector and the detectors it wraps (a scheduler client's model, a cascade's main model)"""
+    parts = [detector]
+    if depth > 0:
+        for name in ('model', 'heavy'):
+            inner = getattr(detector, name, None)
+            if inner is not None:
+                parts.extend(_parts(inner, depth - 1))
+    return parts
+
+
+def acquire(detector):
+    """Mark a detector (and whatever it wraps) as held by a job until release(); returns the detector"""
+    with _holders_cond:
+        for part in _parts(detector):
+            _holders[part] += 1
+    return detector
+
+
+def release(detector):
+    """Drop a job's hold on a detector taken with acquire()"""
+    with _holders_cond:
+        for part in _parts(detector):
+            _holders[part] -= 1
+            if _holders[part] <= 0:
+                del _holders[part]
+        _holders_cond.notify_all()
+
+
+def retire(detector, idle_seconds=RETIRE_IDLE_SECONDS):
+    """Close a replaced worker pool or fused detector once no job holds it and it has been idle for idle_seconds
+
+    Short requests do not acquire their detector; the idle time covers them.
+    """
+    retired_at = time.time()
+
+    def idle_time():
+        return detector.idle_time() if hasattr(detector, 'idle_time') else time.time() - retired_at
+
+    def run():
+        while True:
+            with _holders_cond:
+                # A job may stay idle for long (e.g. waiting for upload chunks) while it still holds the detector
+                _holders_cond.wait_for(lambda: not _holders[detector])
+                idle = idle_time()
+                if idle >= idle_seconds:
+                    detector.close()
+                    break
+            time.sleep(min(idle_seconds - idle, 5.0))
+        print(f"Closed replaced detector ({detector_version(detector)})")
+
+    threading.Thread(target=run, name='model-retire', daemon=True).start()
+
+
+class ServedModels:
+    """The detectors an app serves on one weights file (model or worker pool, cascade, fused) and their swaps"""
+
+    def __init__(self, path, conf=0.25, iou=0.45, workers=0, torch_threads=None, interop_threads=None,
+                 optimize=None, force_reload=False, cascade_model=None, cascade_escalate_below=0.5,
+                 cascade_alert_classes=(), cascade_floor=0.1, fused_models=(), warm_up_size=lambda: 640):
+        # Weights file the app was configured with; path is the one being served (changes with swaps)
+        self.configured_path = path
+        self.path = path
+        self.conf = conf
+        self.iou = iou
+        self.workers = workers
+        self.torch_threads = torch_threads
+        self.interop_threads = interop_threads
+        self.optimize = optimize
+        self.force_reload = force_reload
+        self.cascade_model = cascade_model
+        self.cascade_escalate_below = cascade_escalate_below
+        self.cascade_alert_classes = cascade_alert_classes
+        self.cascade_floor = cascade_floor
+        self.fused_models = fused_models
+        # Inference size used to warm up new detectors before they serve
+        self.warm_up_size = warm_up_size
+        # Called with the new main detector after each swap (e.g. FrameScheduler.swap_model)
+        self.on_swap = []
+        self.model = None
+        self.pool = None
+        self.cascade = None
+        self.fused = None
+        self.swapper = None
+        # Serialises model loading between the warm-up thread and early requests
+        self._load_lock = threading.Lock()
+        self._cascade_lock = threading.Lock()
+        self._fused_lock = threading.Lock()
+
+    def build_model(self, path, force_reload=False):
+        """Load the YOLOv5 model for a weights file, optimized if requested and tagged with its version"""
+        from inference import load_yolo_model
+        detector = load_yolo_model(path, self.conf, self.iou, force_reload=force_reload, optimize=self.optimize,
+                                   threads=self.torch_threads, interop_threads=self.interop_threads)
+        detector.version = model_version(path)
+        return detector
+
+    def build_pool(self, path, force_reload=False):
+        """Start the worker processes on a weights file, tagged with its version"""
+        from worker_pool import InferencePool
+        detector = InferencePool(path, self.workers, self.conf, self.iou, torch_threads=self.torch_threads,
+                                 force_reload=force_reload, optimize=self.optimize)
+        detector.version = model_version(path)
+        return detector
+
+    def build_cascade(self, heavy, light=None):
+        """Put the small cascade model (loaded unless given) in front of the main model or worker pool"""
+        from cascade import ModelCascade
+        light = light or self.build_model(self.cascade_model)
+        detector = ModelCascade(light, heavy, self.cascade_escalate_below, self.cascade_alert_classes,
+                                self.cascade_floor)
+        detector.version = f"{light.version}+{heavy.version}"
+        return detector
+
+    def build_fused(self, main, previous=None):
+        """FusedDetector over the fused models with main in the configured model's place
+
+        The other models are reused from previous when given.
+        """
+        from fused import FusedDetector
+        models = {}
+        for path in self.fused_models:
+            if path == self.configured_path:
+                models[path] = main
+            elif previous is not None:
+                models[path] = previous.models[os.path.splitext(os.path.basename(path))[0]]
+            else:
+                models[path] = self.build_model(path)
+        detector = FusedDetector(models, self.iou)
+        detector.version = '+'.join(loaded.version for loaded in models.values())
+        return detector
+
+    def load_model(self):
+        """Load the YOLOv5 model (from the hub cache unless force_reload is set)"""
+        with self._load_lock:
+            if self.model is None:
+                try:
+                    self.model = self.build_model(self.path, self.force_reload)
+                    print("Model loaded successfully!")
+                except Exception as e:
+                    print(f"Error loading model: {str(e)}")
+                    raise
+        return self.model
+
+    def load_pool(self):
+        """Start the inference worker pool when multi-process mode is enabled"""
+        with self._load_lock:
+            if self.pool is None and self.workers > 0:
+                try:
+                    self.pool = self.build_pool(self.path, self.force_reload)
+                    print(f"Started {self.workers} inference workers with {self.pool.torch_threads} torch threads each")
+                except Exception as e:
+                    print(f"Error starting inference workers: {str(e)}")
+                    raise
+        return self.pool
+
+    def load_main(self):
+        """The worker pool in multi-process mode, else the in-process model"""
+        return self.load_pool() if self.workers > 0 else self.load_model()
+
+    def load_cascade(self):
+        """Put the small cascade model in front of the main model (or the worker pool)"""
+        heavy = self.load_main()
+        with self._cascade_lock:
+            if self.cascade is None:
+                self.cascade = self.build_cascade(heavy)
+                print(f"Cascade: {self.cascade_model} first, {self.path} below {self.cascade_escalate_below} "
+                      f"confidence")
+        return self.cascade
+
+    def load_fused(self):
+        """Load the fused models (reusing the main model) behind one shared preprocessing step"""
+        main = self.load_model() if self.configured_path in self.fused_models else None
+        with self._fused_lock:
+            if self.fused is None:
+                self.fused = self.build_fused(main)
+                print(f"Fused inference: {', '.join(self.fused_models)} on one shared input")
+        return self.fused
+
+    def load(self):
+        """Load the main detector and whichever of the cascade and fused models are configured"""
+        detector = self.load_main()
+        if self.cascade_model:
+            self.load_cascade()
+        if self.fused_models:
+            self.load_fused()
+        return detector
+
+    def version(self):
+        """Version tag of the main detector being served"""
+        return detector_version(self.pool if self.pool is not None else self.model)
+
+    def swap(self, path):
+        """Build and warm up detectors on new weights while the old ones serve, then switch over in one step"""
+        from inference import warm_up
+
+        # Everything built on the main model is rebuilt around the new one; the other models are reused
+        new_pool = self.build_pool(path) if self.pool is not None else None
+        new_model = self.build_model(path) if self.model is not None else None
+        heavy = new_pool if new_pool is not None else new_model
+        new_cascade = self.build_cascade(heavy, self.cascade.light) if self.cascade is not None else None
+        new_fused = None
+        if self.fused is not None and self.configured_path in self.fused_models:
+            new_fused = self.build_fused(new_model, self.fused)
+        warm_up(heavy, self.warm_up_size())
+        if new_fused is not None:
+            warm_up(new_fused, self.warm_up_size())
+
+        # Requests and scheduled video jobs that already picked up the old detectors finish on them
+        with self._load_lock:
+            old_pool, old_fused = self.pool, None
+            self.model, self.pool, self.path = new_model, new_pool, path
+            if new_cascade is not None:
+                self.cascade = new_cascade
+            if new_fused is not None:
+                old_fused, self.fused = self.fused, new_fused
+        for callback in self.on_swap:
+            callback(heavy)
+        if old_pool is not None:
+            retire(old_pool)
+        if old_fused is not None:
+            retire(old_fused)
+        print(f"Swapped model to {heavy.version}")
+        return heavy.version
+
+    def load_swapper(self, watch_interval=MODEL_WATCH_INTERVAL):
+        """Start the hot-swap runner, and the weights watcher when watch_interval is set"""
+        with self._load_lock:
+            if self.swapper is None:
+                self.swapper = ModelSwapper(self.swap, self.path)
+                if watch_interval > 0:
+                    WeightsWatcher(self.swapper, watch_interval).start()
+                    print(f"Watching {self.path} for new weights every {watch_interval:g}s")
+        return self.swapper
@@ -0,0 +1,90 @@
+"""Motion-gated inference for fixed cameras
+
+A fixed camera watching an empty street produces long runs of near-identical
+frames. The gate compares a small blurred grayscale copy of each frame with
+the last frame that was actually inferred (frame differencing) or feeds it
+to a MOG2 background subtractor. When the changed-pixel fraction is under
+the threshold, inference is skipped and the previous detections are reused.
+Re-detection is still forced every max_interval frames.
+"""
+import time
+
+import numpy as np
+import cv2
+
+# Width of the downscaled copy the gate compares
+GATE_WIDTH = 160
+
+
+class MotionGate:
+    """Decide per frame whether anything changed enough to run the model"""
+
+    def __init__(self, threshold=0.01, pixel_threshold=25, max_interval=30, method='diff'):
+        self.threshold = threshold
+        self.pixel_threshold = pixel_threshold
+        self.max_interval = max_interval
+        self.method = method
+        self._reference = None
+        self._since_inference = 0
+        self._subtractor = cv2.createBackgroundSubtractorMOG2(detectShadows=False) if method == 'mog2' else None
+        self.frames = 0
+        self.inferred = 0
+        self.forced = 0
+        self.gate_time = 0.0
+        self.inference_time = 0.0
+
+    def _small_gray(self, frame):
+        """Downscaled, lightly blurred grayscale copy used for the comparison"""
+        height, width = frame.shape[:2]
+        scale = GATE_WIDTH / width
+        small = cv2.resize(frame, (GATE_WIDTH, max(1, int(height * scale))), interpolation=cv2.INTER_AREA)
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        return cv2.GaussianBlur(gray, (5, 5), 0)
+
+    def motion(self, small):
+        """Fraction of pixels that changed against the reference (or the background model)"""
+        if self._subtractor is not None:
+            mask = self._subtractor.apply(small)
+            return float(np.count_nonzero(mask)) / mask.size
+        if self._reference is None:
+            return 1.0
+        diff = cv2.absdiff(small, self._reference)
+        return float(np.count_nonzero(diff > self.pixel_threshold)) / diff.size
+
+    def should_infer(self, frame):
+        """Return True if this frame needs a fresh forward pass"""
+        start_time = time.perf_counter()
+        small = self._small_gray(frame)
+        moved = self.motion(small) > self.threshold
+        forced = not moved and self._since_inference + 1 >= self.max_interval
+        self.frames += 1
+        if moved or forced:
+            # Compare later frames with this one so slow drift still adds up to a trigger
+            self._reference = small
+            self._since_inference = 0
+            self.inferred += 1
+            self.forced += forced
+        else:
+            self._since_inference += 1
+        self.gate_time += time.perf_counter() - start_time
+        return moved or forced
+
+    def record_inference(self, seconds):
+        """Record how long an inferred frame took, to estimate the compute saved by skips"""
+        self.inference_time += seconds
+
+    def stats(self):
+        """Skip ratio and estimated compute saved for this stream"""
+        skipped = self.frames - self.inferred
+        avg_inference = self.inference_time / self.inferred if self.inferred else 0.0
+        return {
+            'frames': self.frames,
+            'inferred': self.inferred,
+            'forced': self.forced,
+            'skipped': skipped,
+            'skip_ratio': round(skipped / self.frames, 4) if self.frames else 0.0,
+            'avg_gate_ms': round(1000 * self.gate_time / self.frames, 3) if self.frames else None,
+            'avg_inference_ms': round(1000 * avg_inference, 2) if self.inferred else None,
+            # Inference time the skipped frames would have cost, minus what the gate itself cost
+            'saved_seconds': round(skipped * avg_inference - self.gate_time, 3)
+        }
@@ -0,0 +1,85 @@
+"""ONNX Runtime backend (fp32 or dynamically quantised int8) for the hub models
+
+The network inside a hub model is exported once per input shape (the
+rectangular, stride-aligned letterbox shape of fused.letterbox_shape) and
+cached next to the TorchScript graphs (OPTIMIZED_CACHE_DIR, keyed by the
+weights' hash). The int8 variant is ONNX Runtime's dynamic quantisation of
+that export. OnnxDetector letterboxes, runs the session and decodes with the
+same helpers as fused.py. It has the infer/infer_batch interface of the
+worker pool, so tiling and the evaluation harness use it unchanged.
+
+onnxruntime is optional; it is imported only when an OnnxDetector is built.
+"""
+import os
+import threading
+
+import numpy as np
+import torch
+
+from fused import letterbox, letterbox_shape, model_stride, unletterbox, decode_predictions
+from optimized import OPTIMIZED_CACHE_DIR, weights_hash
+
+
+def export_onnx(model, model_path, shape, int8=False, cache_dir=OPTIMIZED_CACHE_DIR):
+    """Path of the (cached) ONNX export of a hub model's network for a (height, width) input"""
+    stem = os.path.splitext(os.path.basename(model_path))[0]
+    prefix = os.path.join(cache_dir, f"{stem}-{weights_hash(model_path)}-{shape[0]}x{shape[1]}")
+    path = prefix + '.onnx'
+    if not os.path.exists(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with torch.no_grad():
+            torch.onnx.export(model.model.model, torch.zeros(1, 3, *shape), tmp_path, opset_version=12,
+                              input_names=['images'], output_names=['output'], do_constant_folding=True)
+        os.replace(tmp_path, path)
+    if not int8:
+        return path
+
+    int8_path = prefix + '.int8.onnx'
+    if not os.path.exists(int8_path):
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        tmp_path = f"{int8_path}.{os.getpid()}.tmp"
+        quantize_dynamic(path, tmp_path, weight_type=QuantType.QUInt8)
+        os.replace(tmp_path, int8_path)
+    return int8_path
+
+
+class OnnxDetector:
+    """Run a hub model's exported network with ONNX Runtime"""
+
+    def __init__(self, model, model_path, int8=False, iou_threshold=0.45, threads=None):
+        import onnxruntime
+        self._onnxruntime = onnxruntime
+        self.model = model
+        self.model_path = model_path
+        self.int8 = int8
+        self.iou_threshold = iou_threshold
+        self.threads = threads
+        self.names = model.names
+        self.stride = model_stride(model)
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def _session(self, shape):
+        """One inference session per input shape, exported on first use"""
+        with self._lock:
+            if shape not in self._sessions:
+                options = self._onnxruntime.SessionOptions()
+                if self.threads:
+                    options.intra_op_num_threads = self.threads
+                path = export_onnx(self.model, self.model_path, shape, self.int8)
+                self._sessions[shape] = self._onnxruntime.InferenceSession(path, options,
+                                                                           providers=['CPUExecutionProvider'])
+            return self._sessions[shape]
+
+    def infer(self, frame, conf=0.25, size=640, render=False):
+        """Detections for one image; results are never rendered here"""
+        shape = letterbox_shape([frame.shape], size, self.stride)
+        padded, scale, pad = letterbox(frame, shape)
+        tensor = np.ascontiguousarray(padded.transpose(2, 0, 1)[None], dtype=np.float32) / 255.0
+        pred = self._session(shape).run(None, {'images': tensor})[0][0]
+        dets = decode_predictions(pred, conf, self.iou_threshold)
+        return unletterbox(dets, scale, pad, frame.shape), None
+
+    def infer_batch(self, images, conf=0.25, size=640):
+        return [self.infer(img, conf, size)[0] for img in images]
@@ -0,0 +1,145 @@
+"""Optimized CPU execution of the YOLOv5 hub models
+
+optimize_model() keeps the AutoShape wrapper (so letterboxing, NMS and
+results.render() behave exactly as before) and replaces the network inside
+it with an optimized one:
+
+- Conv+BN layers fused, weights and inputs in channels_last memory format,
+  every forward pass under torch.inference_mode()
+- 'trace': the network is traced with TorchScript and frozen, one graph per
+  input shape (the detect head bakes its grid into the trace). Traced graphs
+  are cached on disk, keyed by the weights' hash, the torch version and the
+  shape, so later starts load them instead of tracing again.
+- 'compile': the network goes through torch.compile (dynamic shapes). The
+  compiled kernels are cached by inductor under the same cache directory.
+- 'fuse': only the eager-mode optimizations above
+
+configure_threads() sets torch's intra- and inter-op thread pools explicitly.
+"""
+import hashlib
+import os
+import threading
+
+import torch
+
+OPTIMIZE_MODES = ('fuse', 'trace', 'compile')
+OPTIMIZED_CACHE_DIR = os.environ.get('OPTIMIZED_CACHE_DIR', '.model_cache')
+# Input shapes traced per model; further shapes run the eager (fused) network
+MAX_TRACED_SHAPES = 8
+
+
+def configure_threads(threads=None, interop_threads=None):
+    """Set torch's intra-op and inter-op thread counts (None keeps torch's default)"""
+    if threads:
+        torch.set_num_threads(threads)
+    if interop_threads:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError as e:
+            # Only allowed before the first parallel work in the process
+            print(f"Could not set inter-op threads: {str(e)}")
+    return torch.get_num_threads(), torch.get_num_interop_threads()
+
+
+def weights_hash(path):
+    """Short content hash of a weights file, so cached graphs are rebuilt when the weights change"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()[:12]
+
+
+class OptimizedNetwork(torch.nn.Module):
+    """Drop-in replacement for the DetectionModel inside a hub model's DetectMultiBackend"""
+
+    def __init__(self, net, mode, cache_prefix):
+        super().__init__()
+        # The eager network stays registered, so the wrapper still has parameters, stride and names
+        self.net = net
+        self.mode = mode
+        self.cache_prefix = cache_prefix
+        self.traced_shapes = 0
+        self.cached_shapes = 0
+        self._traced = {}
+        self._trace_lock = threading.Lock()
+        self._compiled = torch.compile(net, dynamic=True) if mode == 'compile' else None
+
+    def _graph(self, x):
+        """Frozen TorchScript graph for this input shape: loaded from disk, traced, or None past the limit"""
+        shape = tuple(x.shape)
+        graph = self._traced.get(shape)
+        if graph is not None or len(self._traced) >= MAX_TRACED_SHAPES:
+            return graph
+        with self._trace_lock:
+            if shape in self._traced:
+                return self._traced[shape]
+            path = f"{self.cache_prefix}-{'x'.join(str(n) for n in shape)}.torchscript"
+            if os.path.exists(path):
+                traced = torch.jit.load(path)
+                self.cached_shapes += 1
+            else:
+                # Traced outside inference mode (the caller's input is an inference tensor)
+                with torch.inference_mode(False), torch.no_grad():
+                    example = torch.zeros(shape, dtype=x.dtype).contiguous(memory_format=torch.channels_last)
+                    traced = torch.jit.trace(_FirstOutput(self.net), example, check_trace=False)
+                # Atomic, so workers tracing the same shape never read a half-written file
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                torch.jit.save(traced, tmp_path)
+                os.replace(tmp_path, path)
+                self.traced_shapes += 1
+            graph = torch.jit.freeze(traced.eval())
+            self._traced[shape] = graph
+            return graph
+
+    def forward(self, x, *args, **kwargs):
+        if args or kwargs:
+            # augment/visualize runs only exist in eager mode
+            return self.net(x, *args, **kwargs)
+        x = x.contiguous(memory_format=torch.channels_last)
+        graph = self._graph(x) if self.mode == 'trace' else None
+        with torch.inference_mode():
+            if self._compiled is not None:
+                y = self._compiled(x)
+            else:
+                y = graph(x) if graph is not None else self.net(x)
+        return y[0] if isinstance(y, (list, tuple)) else y
+
+
+class _FirstOutput(torch.nn.Module):
+    """Only the decoded predictions, which is all AutoShape's NMS reads (tracing needs a plain tensor)"""
+
+    def __init__(self, net):
+        super().__init__()
+        self.net = net
+
+    def forward(self, x):
+        y = self.net(x)
+        return y[0] if isinstance(y, (list, tuple)) else y
+
+
+def optimize_model(model, model_path, mode='trace', threads=None, interop_threads=None,
+                   cache_dir=OPTIMIZED_CACHE_DIR):
+    """Swap the network inside a hub (AutoShape) model for an optimized one; returns the same model"""
+    if mode not in OPTIMIZE_MODES:
+        raise ValueError(f"Unknown optimize mode {mode!r} (expected one of {', '.join(OPTIMIZE_MODES)})")
+    configure_threads(threads, interop_threads)
+    backend = model.model
+    if not getattr(backend, 'pt', False):
+        print(f"{model_path} is not a PyTorch checkpoint; running it unoptimized")
+        return model
+
+    os.makedirs(cache_dir, exist_ok=True)
+    if mode == 'compile':
+        # Inductor keeps its compiled kernels here, so they survive restarts
+        os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.join(os.path.abspath(cache_dir), 'inductor'))
+
+    net = backend.model
+    if hasattr(net, 'fuse'):
+        # A no-op for layers the hub loader already fused
+        net = net.fuse()
+    net = net.eval().to(memory_format=torch.channels_last)
+    stem = os.path.splitext(os.path.basename(model_path))[0]
+    cache_prefix = os.path.join(cache_dir, f"{stem}-{weights_hash(model_path)}-torch{torch.__version__.split('+')[0]}")
+    backend.model = OptimizedNetwork(net, mode, cache_prefix)
+    return model
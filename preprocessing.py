@@ -0,0 +1,158 @@
+"""Quality-gated distortion correction applied before inference
+
+Cheap quality metrics run on a small grayscale copy of every frame
+(brightness histogram, contrast spread, Laplacian-variance blur score). The
+expensive fixes only run on frames that need them:
+
+- low light: gamma correction through a precomputed lookup table
+- low contrast: CLAHE on the lightness channel
+- motion blur: unsharp-mask sharpening
+- perspective: warp with the camera's homography (when one is configured)
+
+Good frames only pay for the metrics.
+"""
+import threading
+import time
+
+import numpy as np
+import cv2
+
+from cameras import get_camera, DEFAULT_CAMERA
+
+# Width of the downscaled copy the quality metrics run on
+METRIC_WIDTH = 320
+# Gamma values are quantised to this step so the LUTs can be built once
+GAMMA_STEP = 0.1
+# Thresholds a camera's "preprocess" settings may override
+PREPROCESS_SETTINGS = ('dark_threshold', 'target_brightness', 'contrast_threshold', 'blur_threshold')
+
+
+def _gamma_lut(gamma):
+    """256-entry lookup table applying the given gamma"""
+    return np.clip(((np.arange(256) / 255.0) ** gamma) * 255.0, 0, 255).astype(np.uint8)
+
+
+class Preprocessor:
+    """Measure frame quality and apply only the corrections a frame needs"""
+
+    def __init__(self, dark_threshold=80, target_brightness=115, contrast_threshold=60, blur_threshold=100,
+                 homography=None, warp_size=None):
+        self.dark_threshold = dark_threshold
+        self.target_brightness = target_brightness
+        self.contrast_threshold = contrast_threshold
+        self.blur_threshold = blur_threshold
+        self.homography = np.asarray(homography, dtype=np.float64) if homography is not None else None
+        self.warp_size = tuple(warp_size) if warp_size else None
+        # Precompute gamma LUTs for every quantised gamma a dark frame can ask for
+        self._luts = {round(g, 1): _gamma_lut(g) for g in np.arange(0.3, 1.0, GAMMA_STEP)}
+        self._clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+        self._lock = threading.Lock()
+        self.frames = 0
+        self.fired = {'gamma': 0, 'clahe': 0, 'deblur': 0, 'warp': 0}
+        self.stage_time = {'metrics': 0.0, 'gamma': 0.0, 'clahe': 0.0, 'deblur': 0.0, 'warp': 0.0}
+
+    def assess(self, img):
+        """Quality metrics of a BGR frame: mean brightness, contrast spread (p5-p95) and blur score"""
+        height, width = img.shape[:2]
+        scale = METRIC_WIDTH / width if width > METRIC_WIDTH else 1.0
+        small = cv2.resize(img, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA) if scale < 1 else img
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+
+        hist = np.bincount(gray.ravel(), minlength=256)
+        cdf = np.cumsum(hist) / gray.size
+        brightness = float(np.dot(hist, np.arange(256)) / gray.size)
+        contrast = float(np.searchsorted(cdf, 0.95) - np.searchsorted(cdf, 0.05))
+        blur = float(cv2.Laplacian(gray, cv2.CV_64F).var())
+        return {'brightness': brightness, 'contrast': contrast, 'blur': blur}
+
+    def process(self, img):
+        """Return (corrected frame, quality metrics, list of corrections applied)"""
+        timings = {}
+        start_time = time.perf_counter()
+        quality = self.assess(img)
+        timings['metrics'] = time.perf_counter() - start_time
+        applied = []
+
+        if quality['brightness'] < self.dark_threshold:
+            start_time = time.perf_counter()
+            # Gamma that maps the mean brightness to the target, quantised onto a precomputed LUT
+            gamma = np.log(self.target_brightness / 255.0) / np.log(max(quality['brightness'], 1.0) / 255.0)
+            gamma = min(max(round(gamma, 1), 0.3), 0.9)
+            img = cv2.LUT(img, self._luts[gamma])
+            timings['gamma'] = time.perf_counter() - start_time
+            applied.append('gamma')
+
+        if quality['contrast'] < self.contrast_threshold:
+            start_time = time.perf_counter()
+            lab = cv2.cvtColor(img, cv2.COLOR_BGR2LAB)
+            lab[..., 0] = self._clahe.apply(lab[..., 0])
+            img = cv2.cvtColor(lab, cv2.COLOR_LAB2BGR)
+            timings['clahe'] = time.perf_counter() - start_time
+            applied.append('clahe')
+
+        if quality['blur'] < self.blur_threshold:
+            start_time = time.perf_counter()
+            blurred = cv2.GaussianBlur(img, (0, 0), 3)
+            img = cv2.addWeighted(img, 1.5, blurred, -0.5, 0)
+            timings['deblur'] = time.perf_counter() - start_time
+            applied.append('deblur')
+
+        if self.homography is not None:
+            start_time = time.perf_counter()
+            size = self.warp_size or (img.shape[1], img.shape[0])
+            img = cv2.warpPerspective(img, self.homography, size)
+            timings['warp'] = time.perf_counter() - start_time
+            applied.append('warp')
+
+        with self._lock:
+            self.frames += 1
+            for name in applied:
+                self.fired[name] += 1
+            for stage, elapsed in timings.items():
+                self.stage_time[stage] += elapsed
+        return img, quality, applied
+
+    def stats(self):
+        """How often each correction fired and the average time spent per stage"""
+        with self._lock:
+            avg_ms = {}
+            for stage, total in self.stage_time.items():
+                # Metrics run on every frame; each correction is averaged over the frames it ran on
+                runs = self.frames if stage == 'metrics' else self.fired[stage]
+                avg_ms[stage] = round(1000 * total / runs, 3) if runs else None
+            return {
+                'frames': self.frames,
+                'fired': dict(self.fired),
+                'fire_rate': {name: round(count / self.frames, 4) if self.frames else 0.0
+                              for name, count in self.fired.items()},
+                'avg_ms': avg_ms
+            }
+
+
+_preprocessors = {}
+_preprocessors_lock = threading.Lock()
+
+
+def get_preprocessor(camera_id):
+    """Return the preprocessor for a camera, built from its settings on first use"""
+    camera_id = camera_id or DEFAULT_CAMERA
+    with _preprocessors_lock:
+        if camera_id not in _preprocessors:
+            camera = get_camera(camera_id)
+            settings = dict(camera.get('preprocess') or {})
+            unknown = sorted(set(settings) - set(PREPROCESS_SETTINGS))
+            if unknown:
+                # A typo in cameras.json should not take every request for the camera down
+                print(f"Ignoring unknown preprocess settings for camera {camera_id}: {', '.join(unknown)} "
+                      f"(expected {', '.join(PREPROCESS_SETTINGS)})")
+                for name in unknown:
+                    del settings[name]
+            _preprocessors[camera_id] = Preprocessor(homography=camera.get('homography'),
+                                                     warp_size=camera.get('warp_size'), **settings)
+        return _preprocessors[camera_id]
+
+
+def preprocess_stats():
+    """Preprocessing stats for every camera seen so far"""
+    with _preprocessors_lock:
+        return {camera_id: p.stats() for camera_id, p in _preprocessors.items()}
@@ -0,0 +1,211 @@
+"""Opt-in profiling of single requests and video jobs
+
+An admin request with profile=1 (cProfile) or profile=torch (torch.profiler)
+runs under a RequestProfile. It records the time of each pipeline stage (the
+pipeline calls lap(stage) after each one) and a trace of the request's own
+thread. One request is profiled at a time. The trace is stored in PROFILE_DIR
+for download:
+
+- <id>.prof: cProfile stats (load with pstats or snakeviz)
+- <id>.json: torch.profiler Chrome trace (chrome://tracing or Perfetto)
+- <id>.txt: the top functions or operators as a text table
+
+Requests without the flag get NULL_PROFILE, whose lap() does nothing, so
+they pay one empty method call per stage.
+
+Inference in worker processes (INFERENCE_WORKERS) shows up only as waiting
+time in the request's profile; the stage timings still cover it.
+"""
+import contextlib
+import cProfile
+import io
+import json
+import os
+import pstats
+import threading
+import time
+import uuid
+
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+# Stored profiles beyond this many are deleted, oldest first
+MAX_PROFILES = int(os.environ.get('MAX_PROFILES', 50))
+# Rows of the top-functions table in the response and the .txt file
+TOP_FUNCTIONS = 25
+PROFILERS = ('cprofile', 'torch')
+
+
+# Only one profiler can trace at a time (cProfile hooks are process-wide on recent Pythons)
+_active_lock = threading.Lock()
+
+
+class _NullProfile:
+    """Profile of a request that did not ask for one: laps are no-ops"""
+
+    enabled = False
+
+    def lap(self, name):
+        pass
+
+
+NULL_PROFILE = _NullProfile()
+
+
+class RequestProfile:
+    """Stage timings and a cProfile or torch.profiler trace of one request"""
+
+    enabled = True
+
+    def __init__(self, label, profiler='cprofile', out_dir=PROFILE_DIR):
+        if profiler not in PROFILERS:
+            raise ValueError(f"profiler must be one of {', '.join(PROFILERS)}")
+        self.profile_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        self.label = label
+        self.profiler = profiler
+        self.out_dir = out_dir
+        self.stages = {}
+        self._profile = None
+        self._started = None
+        self._last = None
+        self._reserved = False
+        self.running = False
+        self.duration = None
+
+    def lap(self, name):
+        """Charge the time since the previous lap (or the start) to a stage"""
+        now = time.perf_counter()
+        total, count = self.stages.get(name, (0.0, 0))
+        self.stages[name] = (total + now - self._last, count + 1)
+        self._last = now
+
+    def reserve(self):
+        """Claim the profiler ahead of start(), e.g. before handing the work to another thread
+
+        Raises RuntimeError while another request is being profiled.
+        """
+        if not _active_lock.acquire(blocking=False):
+            raise RuntimeError('Another request is being profiled')
+        self._reserved = True
+        return self
+
+    def release(self):
+        """Give up a reservation whose work never started"""
+        if self._reserved and not self.running:
+            self._reserved = False
+            _active_lock.release()
+
+    def start(self):
+        """Start tracing the calling thread (cProfile) or torch operators (torch.profiler)
+
+        Raises RuntimeError while another request is being profiled.
+        """
+        if not self._reserved:
+            self.reserve()
+        try:
+            if self.profiler == 'torch':
+                import torch
+                self._profile = torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU],
+                                                       record_shapes=True)
+                self._profile.__enter__()
+            else:
+                self._profile = cProfile.Profile()
+                self._profile.enable()
+        except Exception:
+            self.release()
+            raise
+        self._started = self._last = time.perf_counter()
+        self.running = True
+        return self
+
+    def stop(self):
+        """Stop tracing, write the trace files and return the report (None if it is not running)
+
+        Safe to call again, e.g. from an error handler after the export itself failed.
+        """
+        if not self.running:
+            return None
+        self.duration = time.perf_counter() - self._started
+        os.makedirs(self.out_dir, exist_ok=True)
+        base = os.path.join(self.out_dir, self.profile_id)
+        try:
+            if self.profiler == 'torch':
+                self._profile.__exit__(None, None, None)
+            else:
+                self._profile.disable()
+        finally:
+            self.running = False
+            self._reserved = False
+            _active_lock.release()
+        if self.profiler == 'torch':
+            self._profile.export_chrome_trace(base + '.json')
+            averages = self._profile.key_averages()
+            table = averages.table(sort_by='cpu_time_total', row_limit=TOP_FUNCTIONS)
+            top = [{'function': event.key, 'calls': event.count, 'total_ms': round(event.cpu_time_total / 1000, 3),
+                    'self_ms': round(event.self_cpu_time_total / 1000, 3)}
+                   for event in sorted(averages, key=lambda e: -e.cpu_time_total)[:TOP_FUNCTIONS]]
+            files = ['json', 'txt']
+        else:
+            self._profile.dump_stats(base + '.prof')
+            stream = io.StringIO()
+            stats = pstats.Stats(self._profile, stream=stream).sort_stats('cumulative')
+            stats.print_stats(TOP_FUNCTIONS)
+            table = stream.getvalue()
+            top = [{'function': f"{os.path.basename(filename)}:{line}({function})", 'calls': calls,
+                    'total_ms': round(1000 * cumulative, 3), 'self_ms': round(1000 * internal, 3)}
+                   for (filename, line, function), (_, calls, internal, cumulative, _)
+                   in sorted(stats.stats.items(), key=lambda item: -item[1][3])[:TOP_FUNCTIONS]]
+            files = ['prof', 'txt']
+        self._profile = None
+        with open(base + '.txt', 'w') as f:
+            f.write(table)
+
+        report = self.report()
+        report['top'] = top
+        report['files'] = {ext: f"/profiles/{self.profile_id}?format={ext}" for ext in files}
+        with open(base + '.meta.json', 'w') as f:
+            json.dump(report, f)
+        _prune(self.out_dir)
+        return report
+
+    def report(self):
+        """Per-stage total, count and average time so far"""
+        stages = {name: {'total_ms': round(1000 * total, 3), 'count': count, 'avg_ms': round(1000 * total / count, 3)}
+                  for name, (total, count) in list(self.stages.items())}
+        return {
+            'profile_id': self.profile_id,
+            'label': self.label,
+            'profiler': self.profiler,
+            'duration_ms': round(1000 * self.duration, 3) if self.duration is not None else None,
+            'stages': stages
+        }
+
+
+def _prune(out_dir, keep=MAX_PROFILES):
+    """Delete the oldest stored profiles beyond keep"""
+    metas = sorted((name for name in os.listdir(out_dir) if name.endswith('.meta.json')),
+                   key=lambda name: os.path.getmtime(os.path.join(out_dir, name)))
+    for name in metas[:max(0, len(metas) - keep)]:
+        profile_id = name[:-len('.meta.json')]
+        for ext in ('.meta.json', '.prof', '.json', '.txt'):
+            with contextlib.suppress(OSError):
+                os.remove(os.path.join(out_dir, profile_id + ext))
+
+
+def list_profiles(out_dir=PROFILE_DIR):
+    """Reports of the stored profiles, newest first"""
+    if not os.path.isdir(out_dir):
+        return []
+    reports = []
+    for name in os.listdir(out_dir):
+        if name.endswith('.meta.json'):
+            with contextlib.suppress(OSError, ValueError):
+                with open(os.path.join(out_dir, name)) as f:
+                    reports.append(json.load(f))
+    return sorted(reports, key=lambda report: report['profile_id'], reverse=True)
+
+
+def profile_file(profile_id, fmt, out_dir=PROFILE_DIR):
+    """(directory, filename) of a stored trace file, or None"""
+    if fmt not in ('prof', 'json', 'txt') or not all(c.isalnum() or c == '-' for c in profile_id):
+        return None
+    filename = f"{profile_id}.{fmt}"
+    return (out_dir, filename) if os.path.exists(os.path.join(out_dir, filename)) else None
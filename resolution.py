@@ -0,0 +1,86 @@
+"""Load-adaptive inference resolution ladder
+
+YOLOv5 AutoShape letterboxes every input to a fixed size (640 by default).
+Under bursty load it is cheaper to degrade resolution than to drop requests,
+so the ladder steps the inference size down while the smoothed request
+latency is above the SLO and back up once it has fallen well below it.
+"""
+import threading
+import time
+
+# Supported inference sizes, largest first (multiples of the 32 px model stride)
+INFERENCE_SIZES = (640, 512, 416, 320)
+
+
+def parse_img_size(value, sizes=INFERENCE_SIZES):
+    """Return the requested inference size if it is on the ladder, else None (automatic)"""
+    try:
+        size = int(value)
+    except (TypeError, ValueError):
+        return None
+    return size if size in sizes else None
+
+
+class ResolutionLadder:
+    """Pick the inference size from request latency measured against an SLO"""
+
+    def __init__(self, slo, sizes=INFERENCE_SIZES, recover_ratio=0.5, smoothing=0.2, cooldown=5.0):
+        self.sizes = sorted(sizes, reverse=True)
+        self.slo = slo
+        self.recover_ratio = recover_ratio
+        self.smoothing = smoothing
+        self.cooldown = cooldown
+        self.level = 0
+        self.latency = None
+        self.step_downs = 0
+        self.step_ups = 0
+        self.served = {size: 0 for size in self.sizes}
+        self._last_change = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        """Inference size currently chosen by the automatic policy"""
+        return self.sizes[self.level]
+
+    def select(self, requested=None):
+        """Return the size for one request: the requested size if given, else the current step"""
+        with self._lock:
+            size = requested if requested in self.served else self.sizes[self.level]
+            self.served[size] += 1
+            return size
+
+    def observe(self, latency):
+        """Feed one request latency (seconds) into the policy"""
+        with self._lock:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += self.smoothing * (latency - self.latency)
+
+            # Hold each step for a while so a single slow request doesn't make the ladder thrash
+            now = time.time()
+            if now - self._last_change < self.cooldown:
+                return
+            if self.latency > self.slo and self.level < len(self.sizes) - 1:
+                self.level += 1
+                self.step_downs += 1
+                self._last_change = now
+                print(f"Latency {self.latency:.2f}s over SLO {self.slo:.2f}s, inference size -> {self.size}")
+            elif self.latency < self.slo * self.recover_ratio and self.level > 0:
+                self.level -= 1
+                self.step_ups += 1
+                self._last_change = now
+                print(f"Latency {self.latency:.2f}s back under SLO, inference size -> {self.size}")
+
+    def stats(self):
+        """Current step, smoothed latency and how many requests were served at each size"""
+        with self._lock:
+            return {
+                'img_size': self.sizes[self.level],
+                'slo': self.slo,
+                'latency': round(self.latency, 4) if self.latency is not None else None,
+                'step_downs': self.step_downs,
+                'step_ups': self.step_ups,
+                'served': dict(self.served)
+            }
@@ -0,0 +1,86 @@
+"""Bandwidth-efficient delivery of result images and videos
+
+Control rooms on thin links should not have to pull every full-resolution
+annotated JPEG. Next to each result image this writes a downscaled preview
+and WebP copies of both (a fraction of the JPEG's size at the same visual
+quality). Optionally it also builds a small base64 thumbnail that fits in
+the JSON response itself.
+
+/results serves them with validators and cache headers. Result images have
+unique names and never change, so they are cached as immutable. Videos may
+be rewritten when a job is re-run with the same id, so they are revalidated
+with their ETag (a 304 costs no body). They also answer HTTP range
+requests, so players seek and resume without downloading the whole file.
+"""
+import base64
+import os
+
+from flask import send_from_directory
+
+RESULT_DIR = 'static/results'
+# Width of the downscaled preview (images narrower than this only get WebP copies)
+PREVIEW_WIDTH = int(os.environ.get('PREVIEW_WIDTH', 640))
+# Width of the inline base64 thumbnail
+THUMBNAIL_WIDTH = int(os.environ.get('THUMBNAIL_WIDTH', 160))
+JPEG_QUALITY = 80
+WEBP_QUALITY = 80
+# Cache lifetime of immutable results (one year)
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+
+def result_url(path):
+    """URL of a file in RESULT_DIR under /results"""
+    return f"/results/{os.path.basename(path)}"
+
+
+def _resized(img, width):
+    import cv2
+    height = max(1, round(img.shape[0] * width / img.shape[1]))
+    return cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA)
+
+
+def save_variants(result_path, img):
+    """Write the preview and WebP variants of a saved BGR result image; returns their URLs by name"""
+    import cv2
+    stem, ext = os.path.splitext(result_path)
+    variants = {'full': result_url(result_path)}
+    targets = []
+    if ext.lower() == '.webp':
+        # The full result is already WebP; writing stem + '.webp' would overwrite it
+        variants['webp'] = variants['full']
+    else:
+        targets.append(('webp', img, stem + '.webp'))
+    if img.shape[1] > PREVIEW_WIDTH:
+        preview = _resized(img, PREVIEW_WIDTH)
+        targets += [('preview', preview, stem + '_preview.jpg'), ('preview_webp', preview, stem + '_preview.webp')]
+    for name, image, path in targets:
+        if path.endswith('.webp'):
+            ok = cv2.imwrite(path, image, [cv2.IMWRITE_WEBP_QUALITY, WEBP_QUALITY])
+        else:
+            ok = cv2.imwrite(path, image, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+        if ok:
+            variants[name] = result_url(path)
+    return variants
+
+
+def thumbnail_data_uri(img, width=THUMBNAIL_WIDTH):
+    """Small JPEG thumbnail of a BGR image as a data: URI for inlining in JSON"""
+    import cv2
+    if img.shape[1] > width:
+        img = _resized(img, width)
+    ok, jpeg = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+    if not ok:
+        return None
+    return 'data:image/jpeg;base64,' + base64.b64encode(jpeg.tobytes()).decode('ascii')
+
+
+def send_result(filename, directory=RESULT_DIR):
+    """Serve a result with ETag, Last-Modified and range support; images are cached as immutable"""
+    response = send_from_directory(directory, filename, conditional=True, etag=True)
+    if os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS:
+        response.headers['Cache-Control'] = f"public, max-age={IMMUTABLE_MAX_AGE}, immutable"
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+    response.headers['Accept-Ranges'] = 'bytes'
+    return response
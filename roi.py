@@ -0,0 +1,96 @@
+"""Per-camera regions of interest with cropped inference
+
+Each camera can list named polygons (in frame pixels) in cameras.json:
+
+    "cam7": {"roi": {"crossing": [[100, 700], [1800, 700], [1900, 1000], [0, 1000]]}}
+
+Inference runs only on the bounding crop of all the camera's polygons, so the
+model letterboxes a smaller area at higher effective resolution. Detections
+are mapped back to frame coordinates and dropped unless their anchor point
+(bottom-centre of the box by default) lies inside one of the polygons.
+"""
+import threading
+
+import numpy as np
+import cv2
+
+from cameras import get_camera, DEFAULT_CAMERA
+
+
+def points_in_polygon(points, polygon):
+    """Vectorised even-odd test of (N, 2) points against one (E, 2) polygon; returns an (N,) bool array"""
+    x = points[:, 0:1]
+    y = points[:, 1:2]
+    x1, y1 = polygon[:, 0], polygon[:, 1]
+    x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+    # Edges that straddle the horizontal line through each point
+    straddles = (y1 > y) != (y2 > y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_cross = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+    crossings = straddles & (x < x_cross)
+    return np.count_nonzero(crossings, axis=1) % 2 == 1
+
+
+class RegionOfInterest:
+    """Named polygons for one camera: crop before inference, filter after"""
+
+    def __init__(self, regions, anchor='bottom', padding=16):
+        self.names = list(regions)
+        self.polygons = [np.asarray(regions[name], dtype=np.float32) for name in self.names]
+        self.anchor = anchor
+        self.padding = padding
+        points = np.concatenate(self.polygons)
+        self.bounds = (points[:, 0].min() - padding, points[:, 1].min() - padding,
+                       points[:, 0].max() + padding, points[:, 1].max() + padding)
+
+    def crop(self, img):
+        """Return the bounding crop of all regions (a view) and its (x, y) offset in the frame"""
+        height, width = img.shape[:2]
+        x1 = int(max(self.bounds[0], 0))
+        y1 = int(max(self.bounds[1], 0))
+        x2 = int(min(self.bounds[2], width))
+        y2 = int(min(self.bounds[3], height))
+        return img[y1:y2, x1:x2], (x1, y1)
+
+    def apply(self, dets, offset=(0, 0)):
+        """Map crop detections to frame coordinates and keep those anchored inside a region
+
+        Returns (dets, region_names) where region_names[i] is the first region containing dets[i].
+        """
+        if len(dets) == 0:
+            return dets, []
+        dets = dets.copy()
+        dets[:, [0, 2]] += offset[0]
+        dets[:, [1, 3]] += offset[1]
+
+        centre_x = (dets[:, 0] + dets[:, 2]) / 2
+        anchor_y = dets[:, 3] if self.anchor == 'bottom' else (dets[:, 1] + dets[:, 3]) / 2
+        points = np.stack([centre_x, anchor_y], axis=1)
+
+        region = np.full(len(dets), -1)
+        for index, polygon in enumerate(self.polygons):
+            inside = (region < 0) & points_in_polygon(points, polygon)
+            region[inside] = index
+        keep = region >= 0
+        return dets[keep], [self.names[i] for i in region[keep]]
+
+    def draw(self, img, color=(255, 200, 0)):
+        """Outline the regions on a BGR image in place"""
+        for polygon in self.polygons:
+            cv2.polylines(img, [polygon.astype(np.int32)], True, color, 2)
+        return img
+
+
+_rois = {}
+_rois_lock = threading.Lock()
+
+
+def get_roi(camera_id):
+    """Return the regions of interest for a camera, or None if it has none configured"""
+    camera_id = camera_id or DEFAULT_CAMERA
+    with _rois_lock:
+        if camera_id not in _rois:
+            camera = get_camera(camera_id)
+            regions = camera.get('roi')
+            _rois[camera_id] = RegionOfInterest(regions, anchor=camera.get('roi_anchor', 'bottom')) if regions else None
+        return _rois[camera_id]
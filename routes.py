@@ -0,0 +1,228 @@
+"""Routes every app serves the same way, on one blueprint
+
+shared_routes(models, ladder, analytics_path) builds the blueprint each app
+registers next to its own: result files, the detection store and analytics
+queries, request profiles, hot model swaps, and the worker, resolution,
+cascade, fused, preprocessing and readiness reports. models is the app's
+model_swap.ServedModels, ladder its resolution.ResolutionLadder and
+analytics_path its analytics checkpoint.
+"""
+import os
+import time
+
+from flask import Blueprint, Response, request, jsonify, send_from_directory
+
+from startup import startup_timer
+from cameras import DEFAULT_CAMERA
+from detection_store import get_store, parse_query, parse_time, BUCKETS
+from model_swap import is_admin
+
+
+def admin_request():
+    """Whether the current request carries the admin token"""
+    return is_admin(request.headers.get('X-Admin-Token', ''))
+
+
+def request_profile(label):
+    """A RequestProfile (not started yet) if the request asks for one with profile=1 or torch, else NULL_PROFILE
+
+    Raises PermissionError for requests without the admin token.
+    """
+    from profiling import RequestProfile, NULL_PROFILE
+    profiler = request.values.get('profile', '0').lower()
+    if profiler in ('0', 'false', 'off', ''):
+        return NULL_PROFILE
+    if not admin_request():
+        raise PermissionError('Profiling requires the admin token')
+    return RequestProfile(label, 'torch' if profiler == 'torch' else 'cprofile')
+
+
+def shared_routes(models, ladder, analytics_path):
+    """Blueprint with the routes shared by all apps, bound to the app's detectors, ladder and analytics"""
+    bp = Blueprint('shared', __name__)
+
+    @bp.route('/results/<path:filename>', methods=['GET'])
+    def serve_result(filename):
+        """Serve a result file with ETag and range support (images cached as immutable, videos revalidated)"""
+        from results import send_result
+        return send_result(filename)
+
+    @bp.route('/workers', methods=['GET'])
+    def workers():
+        """Report per-worker utilisation in multi-process mode"""
+        return jsonify({
+            'mode': 'workers' if models.workers > 0 else 'in-process',
+            'workers': models.pool.stats() if models.pool is not None else []
+        })
+
+    @bp.route('/resolution', methods=['GET'])
+    def resolution():
+        """Report the adaptive inference size and how often each size was used"""
+        return jsonify(ladder.stats())
+
+    @bp.route('/detections', methods=['GET'])
+    def query_detections():
+        """Stored detections filtered by camera, class (comma-separated), time range (since/until) and bbox overlap"""
+        try:
+            filters = parse_query(request.args)
+            limit = int(request.args.get('limit', 1000))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        start_time = time.time()
+        rows = get_store().query(limit=limit, **filters)
+        return jsonify({
+            'detections': rows,
+            'count': len(rows),
+            'query_time': f"{time.time() - start_time:.3f}s"
+        })
+
+    @bp.route('/detections/counts', methods=['GET'])
+    def detection_counts():
+        """Per-class detection counts per minute, hour or day (peak=1 for the most seen in one frame)"""
+        bucket = request.args.get('bucket', 'hour')
+        if bucket not in BUCKETS:
+            return jsonify({'error': f"bucket must be one of {', '.join(BUCKETS)}"}), 400
+        try:
+            filters = parse_query(request.args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        peak = request.args.get('peak', '0').lower() in ('1', 'true', 'on')
+
+        start_time = time.time()
+        buckets = get_store().counts(bucket=bucket, peak=peak, **filters)
+        return jsonify({
+            'bucket': bucket,
+            'peak': peak,
+            'buckets': buckets,
+            'query_time': f"{time.time() - start_time:.3f}s"
+        })
+
+    @bp.route('/detections/stats', methods=['GET'])
+    def detection_store_stats():
+        """Report rows written, writer queue depth and batch write times of the detection store"""
+        return jsonify(get_store().stats())
+
+    @bp.route('/analytics/rollups', methods=['GET'])
+    def analytics_rollups():
+        """Per-camera, per-class minute or hour buckets: detections, per-frame peak and frames processed"""
+        from analytics import get_analytics, GRANULARITIES
+
+        granularity = request.args.get('granularity', 'minute')
+        if granularity not in GRANULARITIES:
+            return jsonify({'error': f"granularity must be one of {', '.join(GRANULARITIES)}"}), 400
+        try:
+            since = parse_time(request.args.get('since'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        return jsonify({
+            'granularity': granularity,
+            'series': get_analytics(analytics_path).rollup(request.args.get('camera'), request.args.get('class'),
+                                                           granularity, since)
+        })
+
+    @bp.route('/analytics/heatmap', methods=['GET'])
+    def analytics_heatmap():
+        """Detection density grid for a camera (optionally one class), as JSON or a colour-mapped PNG (format=png)"""
+        from analytics import get_analytics
+
+        camera_id = request.args.get('camera', DEFAULT_CAMERA)
+        heatmap = get_analytics(analytics_path).heatmap(camera_id, request.args.get('class'))
+        if heatmap is None:
+            return jsonify({'error': 'No detections recorded for this camera'}), 404
+
+        if request.args.get('format') == 'png':
+            import cv2
+            scaled = (255 * heatmap / max(float(heatmap.max()), 1.0)).astype('uint8')
+            colored = cv2.applyColorMap(cv2.resize(scaled, (640, 360), interpolation=cv2.INTER_NEAREST),
+                                        cv2.COLORMAP_JET)
+            return Response(cv2.imencode('.png', colored)[1].tobytes(), mimetype='image/png')
+        return jsonify({
+            'camera': camera_id,
+            'class': request.args.get('class'),
+            'total': float(heatmap.sum()),
+            'grid': heatmap.tolist()
+        })
+
+    @bp.route('/analytics/stats', methods=['GET'])
+    def analytics_stats():
+        """Report rollup series, heatmaps and checkpoint cost"""
+        from analytics import get_analytics
+        return jsonify(get_analytics(analytics_path).stats())
+
+    @bp.route('/cascade', methods=['GET'])
+    def cascade_stats():
+        """Report the cascade's escalation rate and average cost per frame"""
+        if not models.cascade_model:
+            return jsonify({'enabled': False})
+        stats = models.load_cascade().stats()
+        stats['enabled'] = True
+        return jsonify(stats)
+
+    @bp.route('/fused', methods=['GET'])
+    def fused_stats():
+        """Report the fused models' average preprocessing, forward and postprocessing time per frame"""
+        if not models.fused_models:
+            return jsonify({'enabled': False})
+        stats = models.load_fused().stats()
+        stats['enabled'] = True
+        return jsonify(stats)
+
+    @bp.route('/preprocess_stats', methods=['GET'])
+    def preprocess_stats_route():
+        """Report per-camera correction rates and per-stage preprocessing times"""
+        from preprocessing import preprocess_stats
+        return jsonify(preprocess_stats())
+
+    @bp.route('/profiles', methods=['GET'])
+    def list_request_profiles():
+        """Stored request profiles with their stage timings, newest first (admin only)"""
+        from profiling import list_profiles
+        if not admin_request():
+            return jsonify({'error': 'Admin token required'}), 403
+        return jsonify({'profiles': list_profiles()})
+
+    @bp.route('/profiles/<profile_id>', methods=['GET'])
+    def download_request_profile(profile_id):
+        """Download a stored trace: format=prof (cProfile), json (torch Chrome trace) or txt (admin only)"""
+        from profiling import profile_file
+        if not admin_request():
+            return jsonify({'error': 'Admin token required'}), 403
+        found = profile_file(profile_id, request.args.get('format', 'txt'))
+        if found is None:
+            return jsonify({'error': 'Unknown profile or format'}), 404
+        return send_from_directory(*found, as_attachment=True)
+
+    @bp.route('/model', methods=['GET'])
+    def model_info():
+        """Report the weights being served and the hot swap in progress, if any, with recent ones"""
+        stats = models.load_swapper().stats()
+        stats['model_path'] = models.path
+        stats['version'] = models.version()
+        return jsonify(stats)
+
+    @bp.route('/model', methods=['POST'])
+    def start_model_swap():
+        """Hot-swap to new weights (admin only): load and warm them up in the background, then switch over"""
+        if not admin_request():
+            return jsonify({'error': 'Admin token required'}), 403
+        if not startup_timer.ready.is_set():
+            return jsonify({'error': 'Model is still loading'}), 503
+
+        # Reload the served file (e.g. overwritten by retraining) unless another weights file is given
+        data = request.get_json(silent=True) or {}
+        path = data.get('path') or models.path
+        if not path.endswith('.pt') or not os.path.isfile(path):
+            return jsonify({'error': f"No weights file at {path}"}), 400
+        swap = models.load_swapper().start(path, 'api')
+        if swap is None:
+            return jsonify({'error': 'A model swap is already in progress'}), 409
+        return jsonify({'success': True, 'swap': swap}), 202
+
+    @bp.route('/ready', methods=['GET'])
+    def ready():
+        """Readiness probe: 503 until the model has loaded and warmed up, with startup time by phase"""
+        report = startup_timer.report()
+        return jsonify(report), 200 if report['ready'] else 503
+
+    return bp
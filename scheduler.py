@@ -0,0 +1,415 @@
+"""Fair multi-camera scheduler that batches frames across streams
+
+One model serves many cameras and video jobs. Each stream submits a frame
+and waits for its detections. A single scheduler thread collects pending
+frames from all streams and runs them together in one forward pass. When
+there are more streams than batch slots, slots are handed out in this order:
+
+1. priority streams (e.g. the intersection feeding traffic alerts) preempt the rest
+2. streams behind their guaranteed minimum fps, most overdue first
+3. everything else by weighted round-robin (deficit credits proportional to weight)
+
+CameraStream reads a live source on its own thread, keeping only the newest
+frame, so a slow camera drops frames instead of building a backlog. A live
+source that fails is reopened with exponential backoff.
+"""
+import collections
+import os
+import threading
+import time
+
+import numpy as np
+import cv2
+
+from tiling import batch_detector
+
+# Number of recent frames per stream used to compute achieved fps
+FPS_WINDOW = 30
+# Pause of a live camera's detect loop after a failed forward pass
+ERROR_RETRY_SECONDS = 1.0
+# Delay before reopening a live camera that failed, doubled after every failed attempt up to the maximum
+RECONNECT_MIN_SECONDS = 1.0
+RECONNECT_MAX_SECONDS = 30.0
+
+
+class _Request:
+    """One image (a frame, or one tile of a frame) waiting for detections"""
+
+    def __init__(self, frame, size, conf, model, first=True, last=True):
+        self.frame = frame
+        self.size = size
+        self.conf = conf
+        self.model = model
+        # First and last image of one submission: the whole submission counts as one served frame
+        self.first = first
+        self.last = last
+        self.submitted = time.time()
+        self.done = threading.Event()
+        self.dets = None
+        self.error = None
+
+
+class _Stream:
+    """Scheduling state and stats of one camera or video job"""
+
+    def __init__(self, stream_id, weight, min_fps, priority):
+        self.stream_id = stream_id
+        self.weight = weight
+        self.min_fps = min_fps
+        self.priority = priority
+        self.pending = collections.deque()
+        self.credit = 0.0
+        self.next_due = time.time()
+        self.served = 0
+        self.served_times = collections.deque(maxlen=FPS_WINDOW)
+        self.lag = None
+
+    def fps(self, now):
+        """Frames per second achieved over the recent window"""
+        if len(self.served_times) < 2 or now - self.served_times[-1] > 5.0:
+            return 0.0
+        return (len(self.served_times) - 1) / max(self.served_times[-1] - self.served_times[0], 1e-9)
+
+
+class FrameScheduler:
+    """Batch frames from many streams into shared forward passes, fairly"""
+
+    def __init__(self, model, max_batch=8, max_wait=0.01):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.batches = 0
+        self.batched_frames = 0
+        self._streams = {}
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._loop, name='frame-scheduler', daemon=True)
+        self._thread.start()
+
+    def register(self, stream_id, weight=1.0, min_fps=0.0, priority=0):
+        """Add (or update) a stream with its weight, guaranteed minimum fps and priority"""
+        with self._cond:
+            stream = self._streams.get(stream_id)
+            if stream is None:
+                self._streams[stream_id] = _Stream(stream_id, weight, min_fps, priority)
+            else:
+                stream.weight, stream.min_fps, stream.priority = weight, min_fps, priority
+
+    def registered(self, stream_id):
+        """Whether a stream is currently registered"""
+        with self._cond:
+            return stream_id in self._streams
+
+    def unregister(self, stream_id):
+        """Remove a stream, failing any frames it still has queued"""
+        with self._cond:
+            stream = self._streams.pop(stream_id, None)
+        if stream is not None:
+            for req in stream.pending:
+                req.error = f"Stream {stream_id} was removed"
+                req.done.set()
+
+    def infer_many(self, stream_id, frames, size=640, conf=0.25, model=None):
+        """Submit the images of one frame (e.g. its tiles) for a stream and block until their detections are ready
+
+        They count as one served frame for the stream's fps and minimum fps. model pins the images to one
+        model; by default they run on the model served when they are submitted. Raises RuntimeError for a
+        stream that is not registered (e.g. a camera that was just removed).
+        """
+        with self._cond:
+            stream = self._streams.get(stream_id)
+            if stream is None:
+                raise RuntimeError(f"Stream {stream_id} is not registered")
+            reqs = [_Request(frame, size, conf, model or self.model, i == 0, i == len(frames) - 1)
+                    for i, frame in enumerate(frames)]
+            stream.pending.extend(reqs)
+            self._cond.notify()
+        for req in reqs:
+            req.done.wait()
+            if req.error is not None:
+                raise RuntimeError(req.error)
+        return [req.dets for req in reqs]
+
+    def infer(self, stream_id, frame, size=640, conf=0.25, model=None):
+        """Submit one frame for a stream and block until its detections are ready"""
+        return self.infer_many(stream_id, [frame], size, conf, model)[0]
+
+    def client(self, stream_id, model=None):
+        """A detector bound to one stream and one model (default: the one served now), usable like an InferencePool"""
+        return StreamClient(self, stream_id, model)
+
+    def swap_model(self, model):
+        """Serve frames submitted from now on with another model (hot swap)
+
+        Frames already queued and clients created earlier stay on the model they started with, so a video
+        job's detections, class names and version never change halfway through.
+        """
+        with self._cond:
+            self.model = model
+
+    def _ready(self):
+        return [stream for stream in self._streams.values() if stream.pending]
+
+    def _select(self):
+        """Pick up to max_batch requests: priority first, then overdue min-fps streams, then by credit"""
+        now = time.time()
+        ready = self._ready()
+        for stream in ready:
+            stream.credit += stream.weight
+
+        def order(stream):
+            overdue = stream.min_fps > 0 and now >= stream.next_due
+            return (-stream.priority, not overdue, stream.next_due if overdue else -stream.credit)
+
+        ready.sort(key=order)
+        batch = []
+        for stream in ready[:self.max_batch]:
+            # A frame split over several batches (e.g. its tiles) is due once
+            if stream.min_fps > 0 and stream.pending[0].first:
+                stream.next_due = max(stream.next_due, now - 1.0 / stream.min_fps) + 1.0 / stream.min_fps
+            batch.append((stream, stream.pending.popleft()))
+        # Fill leftover slots with further frames from streams that queued several (e.g. tiles)
+        for stream in ready:
+            while len(batch) < self.max_batch and stream.pending:
+                batch.append((stream, stream.pending.popleft()))
+
+        # Deficit round-robin: spend a credit per frame, forget the deficit once the queue drains
+        for stream, _ in batch:
+            stream.credit = stream.credit - 1.0 if stream.pending else 0.0
+        return batch
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._stopped and not self._ready():
+                    self._cond.wait(0.5)
+                if self._stopped:
+                    return
+                # Give other streams a moment to join the batch unless a priority stream is waiting
+                ready = self._ready()
+                if len(ready) < self.max_batch and not any(stream.priority > 0 for stream in ready):
+                    self._cond.wait(self.max_wait)
+                batch = self._select()
+            if batch:
+                self._run(batch)
+
+    def _run(self, batch):
+        """Run one forward pass per (model, size, conf) group and hand the detections back"""
+        groups = {}
+        for stream, req in batch:
+            groups.setdefault((req.model, req.size, req.conf), []).append((stream, req))
+        for (model, size, conf), items in groups.items():
+            try:
+                dets = batch_detector(model, conf)([req.frame for _, req in items], size)
+            except Exception as e:
+                dets = None
+                error = str(e)
+            now = time.time()
+            with self._cond:
+                for i, (stream, req) in enumerate(items):
+                    if dets is None:
+                        req.error = error
+                    else:
+                        req.dets = dets[i]
+                    # Frames, not tiles: a submission is served once its last image is
+                    if req.last:
+                        stream.served += 1
+                        stream.served_times.append(now)
+                        lag = now - req.submitted
+                        stream.lag = lag if stream.lag is None else stream.lag + 0.2 * (lag - stream.lag)
+                    req.done.set()
+        self.batches += 1
+        self.batched_frames += len(batch)
+
+    def stats(self):
+        """Per-stream achieved fps, lag and queue state"""
+        now = time.time()
+        with self._cond:
+            streams = {}
+            for stream in self._streams.values():
+                fps = stream.fps(now)
+                streams[stream.stream_id] = {
+                    'weight': stream.weight,
+                    'priority': stream.priority,
+                    'min_fps': stream.min_fps,
+                    'fps': round(fps, 2),
+                    'meets_min_fps': fps >= stream.min_fps if stream.min_fps else True,
+                    'lag_ms': round(1000 * stream.lag, 1) if stream.lag is not None else None,
+                    'served': stream.served,
+                    'pending': len(stream.pending)
+                }
+        return {
+            'batches': self.batches,
+            'avg_batch_size': round(self.batched_frames / self.batches, 2) if self.batches else None,
+            'streams': streams
+        }
+
+    def close(self):
+        """Stop the scheduler thread"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._thread.join(timeout=5)
+
+
+class StreamClient:
+    """Detector bound to one scheduler stream, with the same infer interface as InferencePool
+
+    The client keeps its model (given, e.g. a cascade or fused detector, or the one the scheduler served when
+    it was created) even across hot swaps.
+    """
+
+    def __init__(self, scheduler, stream_id, model=None):
+        self.scheduler = scheduler
+        self.stream_id = stream_id
+        self.model = model or scheduler.model
+        self.names = self.model.names
+        self.version = getattr(self.model, 'version', None)
+
+    def infer(self, frame, conf=0.25, size=640, render=False):
+        """Run one frame through the scheduler; results are never rendered here"""
+        return self.scheduler.infer(self.stream_id, frame, size, conf, self.model), None
+
+    def infer_batch(self, images, conf=0.25, size=640):
+        return self.scheduler.infer_many(self.stream_id, images, size, conf, self.model)
+
+
+class CameraStream:
+    """Read a live camera on its own thread and feed its newest frame to the scheduler"""
+
+    def __init__(self, camera_id, source, scheduler, size=640, conf=0.25, roi=None, events=None):
+        self.camera_id = camera_id
+        self.source = source
+        self.scheduler = scheduler
+        self.size = size
+        self.conf = conf
+        self.roi = roi
+        # Optional events.EventRecorder fed with every frame read and every frame's detections
+        self.events = events
+        self.frames_read = 0
+        self.frames_dropped = 0
+        self.lag = None
+        self.errors = 0
+        self.last_error = None
+        self.reconnects = 0
+        self.latest = {'dets': np.zeros((0, 6), dtype=np.float32), 'timestamp': None, 'names': None,
+                       'model_version': None}
+        self._frame = None
+        self._frame_time = None
+        self._new_frame = threading.Condition()
+        self._stopped = False
+        self._reader = threading.Thread(target=self._read_loop, name=f"camera-reader-{camera_id}", daemon=True)
+        self._detector = threading.Thread(target=self._detect_loop, name=f"camera-detect-{camera_id}", daemon=True)
+
+    def start(self):
+        self._reader.start()
+        self._detector.start()
+        return self
+
+    def _read_loop(self):
+        """Keep only the newest frame; anything not picked up in time counts as dropped
+
+        A live source that cannot be opened or read is reopened with backoff; a video file ends the stream.
+        """
+        reopen = not os.path.isfile(str(self.source))
+        delay = RECONNECT_MIN_SECONDS
+        cap = None
+        while not self._stopped:
+            if cap is None:
+                cap = cv2.VideoCapture(self.source)
+                if cap.isOpened() and self.events is not None:
+                    self.events.set_fps(cap.get(cv2.CAP_PROP_FPS))
+            ret, frame = cap.read() if cap.isOpened() else (False, None)
+            if not ret:
+                cap.release()
+                cap = None
+                if not reopen:
+                    break
+                # A network glitch or a restarting camera should not end the stream
+                self.reconnects += 1
+                print(f"Camera {self.camera_id} failed, reopening in {delay:g}s")
+                with self._new_frame:
+                    if not self._stopped:
+                        self._new_frame.wait(delay)
+                delay = min(2 * delay, RECONNECT_MAX_SECONDS)
+                continue
+            delay = RECONNECT_MIN_SECONDS
+            if self.events is not None:
+                self.events.add_frame(frame, time.time())
+            with self._new_frame:
+                if self._frame is not None:
+                    self.frames_dropped += 1
+                self._frame = frame
+                self._frame_time = time.time()
+                self.frames_read += 1
+                self._new_frame.notify()
+        if cap is not None:
+            cap.release()
+        if self.events is not None:
+            self.events.close()
+        with self._new_frame:
+            self._stopped = True
+            self._new_frame.notify()
+
+    def _detect_loop(self):
+        while True:
+            with self._new_frame:
+                while self._frame is None and not self._stopped:
+                    self._new_frame.wait()
+                if self._frame is None:
+                    return
+                frame, captured = self._frame, self._frame_time
+                self._frame = None
+
+            if self.roi is not None:
+                crop, offset = self.roi.crop(frame)
+            else:
+                crop, offset = frame, (0, 0)
+            # Detections, class names and version all come from the same model, even across a hot swap
+            model = self.scheduler.model
+            try:
+                dets = self.scheduler.infer(self.camera_id, crop, self.size, self.conf, model)
+            except RuntimeError as e:
+                # Only a stopped or removed camera ends the loop; a failed batch is skipped
+                if self._stopped or not self.scheduler.registered(self.camera_id):
+                    return
+                self.errors += 1
+                self.last_error = str(e)
+                print(f"Error detecting on camera {self.camera_id}: {str(e)}")
+                time.sleep(ERROR_RETRY_SECONDS)
+                continue
+            if self.roi is not None:
+                dets, _ = self.roi.apply(dets, offset)
+            now = time.time()
+            self.latest = {'dets': dets, 'timestamp': now, 'names': model.names,
+                           'model_version': getattr(model, 'version', None)}
+            if self.events is not None:
+                try:
+                    self.events.check(dets, model.names, captured, frame)
+                except Exception as e:
+                    # A broken rule or a failed clip write costs the event, not the camera
+                    self.errors += 1
+                    self.last_error = str(e)
+                    print(f"Error checking event rules on camera {self.camera_id}: {str(e)}")
+            # Lag from frame capture to detections being available
+            lag = now - captured
+            self.lag = lag if self.lag is None else self.lag + 0.2 * (lag - self.lag)
+
+    def stop(self):
+        with self._new_frame:
+            self._stopped = True
+            # Wakes the detect loop and a reader waiting to reconnect
+            self._new_frame.notify_all()
+
+    def stats(self):
+        return {
+            'source': self.source,
+            'running': not self._stopped,
+            'frames_read': self.frames_read,
+            'frames_dropped': self.frames_dropped,
+            'capture_lag_ms': round(1000 * self.lag, 1) if self.lag is not None else None,
+            'errors': self.errors,
+            'last_error': self.last_error,
+            'reconnects': self.reconnects,
+            'events': self.events.stats() if self.events is not None else None
+        }
@@ -0,0 +1,419 @@
+"""Segment-parallel processing of long videos across worker processes
+
+A long recording is split into contiguous frame ranges whose boundaries are
+moved to the nearest keyframe (from ffprobe, when it is installed), so each
+worker's seek lands on a frame it can decode without replaying the previous
+segment. Every worker process loads its own model and decodes, detects and
+encodes its segments independently. It writes an annotated segment and a
+detection sidecar (.npz). The parent stitches the segments back in order:
+a stream copy with ffmpeg when available, else a re-encode with OpenCV.
+It then merges the sidecars and replays them, in frame order, to the
+detection store and analytics.
+
+A failed segment is retried up to SEGMENT_RETRIES times. A worker that dies
+breaks the whole pool: only the segment it was running is charged an attempt,
+and the others are resubmitted to a fresh pool. When several segments were
+running, they are retried each in its own process to find the one at fault.
+
+The speedup is measured against a calibration run: before the segments start,
+one worker with all CPU threads (the sequential path's configuration)
+processes the first SEGMENT_CALIBRATION_FRAMES frames alone. Its per-frame
+time times the frame count estimates the sequential time, and the speedup is
+that estimate over the wall-clock time of the segments and stitching.
+"""
+import concurrent.futures
+import multiprocessing as mp
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+import numpy as np
+import cv2
+
+SEGMENT_RETRIES = int(os.environ.get('SEGMENT_RETRIES', 2))
+# Frames timed on one worker to estimate the sequential time (0 skips the calibration and the speedup)
+SEGMENT_CALIBRATION_FRAMES = int(os.environ.get('SEGMENT_CALIBRATION_FRAMES', 50))
+# Videos are not split into segments shorter than this
+MIN_SEGMENT_FRAMES = 300
+# Frames a worker processes between two progress messages
+PROGRESS_EVERY = 25
+
+# Set in each worker process by _init_worker
+_model = None
+_progress = None
+_running = None
+
+
+def keyframes(path, fps):
+    """Frame indices of the video's keyframes (from ffprobe's packet list), or None without ffprobe"""
+    ffprobe = shutil.which('ffprobe')
+    if ffprobe is None:
+        return None
+    try:
+        output = subprocess.run([ffprobe, '-v', 'error', '-select_streams', 'v:0',
+                                 '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', path],
+                                capture_output=True, text=True, timeout=300, check=True).stdout
+    except (OSError, subprocess.SubprocessError) as e:
+        print(f"Error reading keyframes: {str(e)}")
+        return None
+    times, key_times = [], []
+    for line in output.splitlines():
+        pts, _, flags = line.partition(',')
+        if pts in ('', 'N/A'):
+            continue
+        times.append(float(pts))
+        if 'K' in flags:
+            key_times.append(float(pts))
+    if not times:
+        return None
+    # Timestamps may not start at zero
+    first = min(times)
+    return sorted({round((t - first) * fps) for t in key_times})
+
+
+def plan_segments(total_frames, count, keyframe_indices=None, min_frames=MIN_SEGMENT_FRAMES):
+    """Split [0, total_frames) into at most count (start, end) ranges, boundaries snapped to keyframes"""
+    count = max(1, min(count, total_frames // min_frames))
+    bounds = [round(total_frames * i / count) for i in range(count + 1)]
+    if keyframe_indices:
+        candidates = np.asarray([k for k in keyframe_indices if 0 < k < total_frames])
+        if len(candidates):
+            for i in range(1, count):
+                bounds[i] = int(candidates[np.abs(candidates - bounds[i]).argmin()])
+    bounds = sorted(set(bounds))
+    return list(zip(bounds, bounds[1:]))
+
+
+def _init_worker(model_path, conf_threshold, iou_threshold, torch_threads, optimize, progress, running=None):
+    """Worker process setup: pin the thread pools and load the model once for all its segments"""
+    global _model, _progress, _running
+    os.environ['OMP_NUM_THREADS'] = str(torch_threads)
+    os.environ['MKL_NUM_THREADS'] = str(torch_threads)
+    import torch
+    from inference import load_yolo_model
+
+    torch.set_num_threads(torch_threads)
+    torch.set_num_interop_threads(1)
+    _model = load_yolo_model(model_path, conf_threshold, iou_threshold, optimize=optimize)
+    _progress = progress
+    _running = running
+
+
+def _process_segment(video_path, start, end, out_path, sidecar_path, options, last=False, index=None, report=True):
+    """Detect on frames [start, end) and write the annotated segment and its detection sidecar
+
+    index flags the segment as running in the shared array, so a pool broken by
+    a dead worker can be blamed on it; report=False sends no job progress.
+    """
+    from inference import results_to_array, draw_detections
+    from tiling import tiled_detect, batch_detector
+    from preprocessing import get_preprocessor
+    from roi import get_roi
+
+    started = time.perf_counter()
+    if index is not None:
+        _running[index] = 1
+    model = _model
+    conf_threshold, size = options['conf_threshold'], options['img_size']
+    model.conf = conf_threshold
+    preprocessor = get_preprocessor(options['camera']) if options['preprocess'] else None
+    roi = get_roi(options['camera']) if options['roi'] else None
+    detect_batch = batch_detector(model, conf_threshold) if options['tiled'] else None
+
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise RuntimeError(f"Could not open {video_path}")
+    cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+    fps = cap.get(cv2.CAP_PROP_FPS) or 25.0
+    writer = None
+    frame_indices, all_dets = [], []
+    corrections = {}
+    classes = {}
+    frames = reported = 0
+    shape = None
+    try:
+        for frame_index in range(start, end):
+            ret, frame = cap.read()
+            if not ret:
+                # The container's frame count may overshoot; only the last segment may end early
+                if last:
+                    break
+                raise RuntimeError(f"Decoding stopped at frame {frame_index} of segment {start}-{end}")
+
+            if preprocessor is not None:
+                frame, _, applied = preprocessor.process(frame)
+                for name in applied:
+                    corrections[name] = corrections.get(name, 0) + 1
+            crop, offset = roi.crop(frame) if roi is not None else (frame, (0, 0))
+
+            if detect_batch is not None:
+                dets, _ = tiled_detect(detect_batch, crop, options['tile_size'], options['tile_overlap'],
+                                       size if options['tile_full_frame'] else None, options['iou_threshold'])
+            else:
+                dets = results_to_array(model(crop, size=size))
+            if roi is not None:
+                dets, _ = roi.apply(dets, offset)
+
+            rendered = draw_detections(frame, dets, model.names)
+            if roi is not None:
+                roi.draw(rendered)
+            if writer is None:
+                shape = frame.shape
+                writer = cv2.VideoWriter(out_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (shape[1], shape[0]))
+            writer.write(rendered)
+
+            frame_indices.append(np.full(len(dets), frame_index, dtype=np.int64))
+            all_dets.append(dets)
+            for cls in dets[:, 5].astype(int).tolist():
+                name = model.names[cls]
+                classes[name] = classes.get(name, 0) + 1
+            frames += 1
+            if report and frames - reported >= PROGRESS_EVERY:
+                _progress.put((frames - reported, classes))
+                reported, classes = frames, {}
+    finally:
+        cap.release()
+        if writer is not None:
+            writer.release()
+    if report and frames > reported:
+        _progress.put((frames - reported, classes))
+
+    np.savez(sidecar_path,
+             frame=np.concatenate(frame_indices) if frame_indices else np.zeros(0, dtype=np.int64),
+             dets=np.concatenate(all_dets) if all_dets else np.zeros((0, 6), dtype=np.float32),
+             processed=np.array([start, start + frames]),
+             shape=np.array(shape or (0, 0, 3)))
+    return {'start': start, 'end': start + frames, 'frames': frames,
+            'seconds': time.perf_counter() - started, 'corrections': corrections}
+
+
+def concat_segments(paths, output_path, fps):
+    """Join the annotated segments in order: stream copy with ffmpeg, else re-encode with OpenCV"""
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg is not None:
+        list_path = output_path + '.segments.txt'
+        with open(list_path, 'w') as f:
+            for path in paths:
+                f.write(f"file '{os.path.abspath(path)}'\n")
+        try:
+            result = subprocess.run([ffmpeg, '-y', '-v', 'error', '-f', 'concat', '-safe', '0', '-i', list_path,
+                                     '-c', 'copy', output_path], capture_output=True, text=True)
+            if result.returncode == 0:
+                return 'ffmpeg'
+            print(f"Error joining segments with ffmpeg: {result.stderr.strip()}")
+        finally:
+            os.remove(list_path)
+
+    writer = None
+    for path in paths:
+        cap = cv2.VideoCapture(path)
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            if writer is None:
+                writer = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*'mp4v'), fps,
+                                         (frame.shape[1], frame.shape[0]))
+            writer.write(frame)
+        cap.release()
+    if writer is not None:
+        writer.release()
+    return 'opencv'
+
+
+def calibrate(video_path, total_frames, work_dir, model_path, options, ctx, progress, conf_threshold, iou_threshold,
+              optimize, frames=SEGMENT_CALIBRATION_FRAMES):
+    """Seconds per frame of one worker with all CPU threads processing the first frames alone, or None"""
+    frames = min(frames, total_frames)
+    if frames <= 0:
+        return None
+    executor = concurrent.futures.ProcessPoolExecutor(
+        max_workers=1, mp_context=ctx, initializer=_init_worker,
+        initargs=(model_path, conf_threshold, iou_threshold, os.cpu_count() or 1, optimize, progress))
+    try:
+        result = executor.submit(_process_segment, video_path, 0, frames, os.path.join(work_dir, 'calibration.mp4'),
+                                 os.path.join(work_dir, 'calibration.npz'), options, True, None, False).result()
+    except Exception as e:
+        print(f"Error calibrating the sequential time: {str(e) or type(e).__name__}")
+        return None
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+    return result['seconds'] / result['frames'] if result['frames'] else None
+
+
+def process_video_segments(video_path, output_path, model_path, workers, options, names=None, job=None,
+                           on_detections=None, conf_threshold=0.25, iou_threshold=0.45, optimize=None,
+                           retries=SEGMENT_RETRIES):
+    """Process a complete video file as parallel segments; returns the same status dict as the sequential path"""
+    start_time = time.time()
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        return {'success': False, 'message': 'Error opening video file', 'error': 'Could not open video file'}
+    fps = cap.get(cv2.CAP_PROP_FPS) or 25.0
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    if total_frames <= 0:
+        return {'success': False, 'message': 'Error processing video',
+                'error': 'Segment mode needs a video with a known frame count'}
+
+    segments = plan_segments(total_frames, workers, keyframes(video_path, fps))
+    work_dir = tempfile.mkdtemp(prefix='segments-', dir=os.path.dirname(os.path.abspath(output_path)))
+    paths = [os.path.join(work_dir, f"segment_{i:04d}.mp4") for i in range(len(segments))]
+    sidecars = [os.path.join(work_dir, f"segment_{i:04d}.npz") for i in range(len(segments))]
+    torch_threads = max(1, (os.cpu_count() or 1) // min(workers, len(segments)))
+
+    # Workers report frames and per-class counts; one thread turns them into job progress
+    ctx = mp.get_context('spawn')
+    progress = ctx.Queue()
+
+    def relay():
+        while True:
+            msg = progress.get()
+            if msg is None:
+                break
+            if job is not None:
+                job.add_frames(*msg)
+
+    relay_thread = threading.Thread(target=relay, name='segment-progress', daemon=True)
+    relay_thread.start()
+    if job is not None:
+        job.start(total_frames)
+
+    attempts = {i: 0 for i in range(len(segments))}
+    results = {}
+    failures = []
+    # Set by each worker when it starts a segment, to tell which segments a dead worker took down with it
+    running = ctx.Array('b', len(segments), lock=False)
+    isolate = set()
+    broken_starts = 0
+    calibration_frames = min(SEGMENT_CALIBRATION_FRAMES, total_frames)
+    calibration_start = time.time()
+    frame_seconds = calibrate(video_path, total_frames, work_dir, model_path, options, ctx, progress, conf_threshold,
+                              iou_threshold, optimize, calibration_frames)
+    calibration_time = time.time() - calibration_start
+
+    def fail(i, error, charged=True):
+        if charged:
+            attempts[i] += 1
+        failures.append({'segment': i, 'attempt': attempts[i], 'charged': charged, 'error': error})
+        print(f"Segment {i} failed (attempt {attempts[i]}{'' if charged else ', not charged'}): {error}")
+        if attempts[i] > retries:
+            raise RuntimeError(f"Segment {i} failed {attempts[i]} times: {error}")
+
+    def pool(size):
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=size, mp_context=ctx, initializer=_init_worker,
+            initargs=(model_path, conf_threshold, iou_threshold, torch_threads, optimize, progress, running))
+
+    parallel_start = time.time()
+    try:
+        while len(results) < len(segments):
+            pending = [i for i in range(len(segments)) if i not in results]
+            for i in pending:
+                running[i] = 0
+            # Suspects of an unexplained worker death run alone, one pool each; everything else shares one pool
+            if isolate:
+                executors = {i: pool(1) for i in pending if i in isolate}
+            else:
+                shared = pool(min(workers, len(pending)))
+                executors = {i: shared for i in pending}
+            isolate = set()
+            broken = {}
+            try:
+                futures = {executors[i].submit(_process_segment, video_path, *segments[i], paths[i], sidecars[i],
+                                               options, i == len(segments) - 1, i): i for i in executors}
+                for future in concurrent.futures.as_completed(futures):
+                    i = futures[future]
+                    try:
+                        results[i] = future.result()
+                    except concurrent.futures.process.BrokenProcessPool as e:
+                        broken.setdefault(id(executors[i]), []).append(i)
+                        error = str(e)
+                    except Exception as e:
+                        fail(i, str(e) or type(e).__name__)
+            finally:
+                for executor in set(executors.values()):
+                    executor.shutdown(wait=True, cancel_futures=True)
+
+            # A dead worker fails every segment of its pool: blame only the ones that had started, and
+            # resubmit the others without an attempt; if several had started, retry each alone to find it
+            for lost in broken.values():
+                started = [i for i in lost if running[i]]
+                if len(started) == 1:
+                    fail(started[0], f"Worker died: {error}")
+                elif started:
+                    isolate.update(started)
+                    for i in started:
+                        fail(i, f"Worker died while {len(started)} segments were running: {error}", charged=False)
+                else:
+                    broken_starts += 1
+                    print(f"Worker pool failed before starting a segment: {error}")
+                    if broken_starts > retries:
+                        raise RuntimeError(f"Worker pool failed {broken_starts} times before starting: {error}")
+
+        stitch_start = time.time()
+        method = concat_segments(paths, output_path, fps)
+
+        # Merge the sidecars and replay them in frame order
+        merged_frames, merged_dets = [], []
+        for sidecar in sidecars:
+            with np.load(sidecar) as data:
+                frame, dets, processed, shape = data['frame'], data['dets'], data['processed'], tuple(data['shape'])
+            merged_frames.append(frame)
+            merged_dets.append(dets)
+            if on_detections is not None:
+                bounds = np.searchsorted(frame, np.arange(processed[0], processed[1] + 1))
+                for frame_index in range(processed[0], processed[1]):
+                    k = frame_index - processed[0]
+                    on_detections(frame_index, fps, dets[bounds[k]:bounds[k + 1]], names, shape)
+        np.savez(os.path.splitext(output_path)[0] + '.detections.npz',
+                 frame=np.concatenate(merged_frames), dets=np.concatenate(merged_dets),
+                 names=np.array([names[i] for i in sorted(names)] if isinstance(names, dict) else list(names or [])))
+        stitch_time = time.time() - stitch_start
+    except Exception as e:
+        return {'success': False, 'message': 'Error processing video', 'error': str(e), 'failures': failures}
+    finally:
+        progress.put(None)
+        relay_thread.join(timeout=5)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    process_time = time.time() - start_time
+    parallel_time = time.time() - parallel_start
+    ordered = [results[i] for i in range(len(segments))]
+    worker_time = sum(r['seconds'] for r in ordered)
+    processed_frames = sum(r['frames'] for r in ordered)
+    sequential_time = frame_seconds * processed_frames if frame_seconds is not None else None
+    corrections = {}
+    for r in ordered:
+        for name, count in r['corrections'].items():
+            corrections[name] = corrections.get(name, 0) + count
+    return {
+        'success': True,
+        'message': f'Video processed successfully in {process_time:.2f} seconds ({len(segments)} segments)',
+        'processed_frames': processed_frames,
+        'process_time': process_time,
+        'img_sizes': {options['img_size']: processed_frames},
+        'corrections': corrections,
+        'segments': {
+            'count': len(segments),
+            'workers': min(workers, len(segments)),
+            'ranges': [[r['start'], r['end']] for r in ordered],
+            'segment_seconds': [round(r['seconds'], 2) for r in ordered],
+            'retries': len(failures),
+            'failures': failures,
+            'stitch': method,
+            'stitch_seconds': round(stitch_time, 2),
+            'calibration_frames': calibration_frames if frame_seconds is not None else 0,
+            'calibration_seconds': round(calibration_time, 2),
+            # Calibrated per-frame time times the frame count, over the wall-clock time of segments and stitching
+            'sequential_estimate_seconds': round(sequential_time, 2) if sequential_time is not None else None,
+            'parallel_seconds': round(parallel_time, 2),
+            'speedup': round(sequential_time / parallel_time, 2) if sequential_time and parallel_time > 0 else None,
+            # Busy time of all workers together, and how many were busy on average
+            'worker_seconds': round(worker_time, 2),
+            'mean_parallelism': round(worker_time / parallel_time, 2) if parallel_time > 0 else None
+        }
+    }
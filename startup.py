@@ -0,0 +1,92 @@
+"""Cold-start bookkeeping: phase timings and readiness
+
+The apps import only Flask and the standard library at module level; torch,
+OpenCV and the model are loaded on a background thread after the server is
+up. This module records how long each phase of that took and whether the
+model is ready to serve, for the /ready endpoint.
+
+Import it before anything else so the 'imports' phase covers the whole app module.
+"""
+import contextlib
+import importlib
+import os
+import threading
+import time
+
+
+def _process_age():
+    """Seconds since this process started (Linux only, None elsewhere)"""
+    try:
+        with open('/proc/self/stat') as f:
+            # Field 22 (starttime) counted after the parenthesised command name
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+class StartupTimer:
+    """Per-phase startup timings and a readiness flag"""
+
+    def __init__(self):
+        self.created = time.perf_counter()
+        self.phases = {}
+        # Interpreter start-up and anything imported before this module
+        interpreter = _process_age()
+        if interpreter is not None:
+            self.phases['interpreter'] = round(interpreter, 4)
+        self.ready = threading.Event()
+        self.error = None
+        self._thread = None
+
+    def record(self, name, seconds):
+        self.phases[name] = round(seconds, 4)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time the enclosed block as one startup phase"""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start_time)
+
+    def start_background(self, load, warm=None, imports=()):
+        """Import the heavy modules, run load() and then warm(detector) on a background thread
+
+        Readiness flips once all of it has finished.
+        """
+        def run():
+            try:
+                with self.phase('heavy_imports'):
+                    for module in imports:
+                        importlib.import_module(module)
+                with self.phase('load_model'):
+                    detector = load()
+                if warm is not None:
+                    with self.phase('warmup'):
+                        warm(detector)
+                self.record('until_ready', time.perf_counter() - self.created)
+                self.ready.set()
+                print(f"Model ready after {self.phases['until_ready']:.2f}s")
+            except Exception as e:
+                self.error = str(e)
+                print(f"Error warming up model: {self.error}")
+
+        self._thread = threading.Thread(target=run, name='model-warmup', daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def report(self):
+        """Readiness and the phase breakdown"""
+        return {
+            'ready': self.ready.is_set(),
+            'error': self.error,
+            'uptime': round(time.perf_counter() - self.created, 3),
+            'phases': dict(self.phases)
+        }
+
+
+startup_timer = StartupTimer()
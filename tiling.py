@@ -0,0 +1,128 @@
+"""Tiled (sliced) inference for high-resolution frames
+
+Shrinking a 4K frame to 640 px makes small objects (distant pedestrians,
+garbage bins) vanish. Instead the frame is cut into overlapping tiles that
+run through the model as a single batch; the boxes are shifted back to frame
+coordinates. An object cut by a tile border shows up as a fragment in one tile
+and a larger (or the whole) box in the next, and the two barely pass an IoU
+test. So same-class boxes are first joined into their union when one of them
+touches an inner tile border and they cover most of the smaller box. Then
+class-aware NMS removes the remaining duplicates.
+"""
+import numpy as np
+
+from inference import results_to_array, class_nms
+
+# A box within this many pixels of an inner tile edge counts as cut by it
+BORDER_MARGIN = 2
+# Cut boxes are joined with same-class boxes covering at least this fraction of the smaller box
+MERGE_THRESHOLD = 0.5
+
+
+def tile_windows(width, height, tile_size=640, overlap=0.2):
+    """Overlapping (x1, y1, x2, y2) windows covering the frame, all of the same size"""
+    stride = max(1, int(tile_size * (1 - overlap)))
+
+    def starts(length):
+        if length <= tile_size:
+            return [0]
+        # The last tile is aligned to the far edge so no tile runs past the frame
+        return list(range(0, length - tile_size, stride)) + [length - tile_size]
+
+    return [(x, y, min(x + tile_size, width), min(y + tile_size, height))
+            for y in starts(height) for x in starts(width)]
+
+
+def batch_detector(model, conf_threshold):
+    """Return a detect_batch(images, size) function for an in-process model or a worker pool
+
+    Anything with infer/infer_batch methods (InferencePool, scheduler.StreamClient) counts as a pool.
+    """
+    if hasattr(model, 'infer_batch'):
+        def detect_pool_batch(images, size):
+            # Only equally sized images can be stacked into one shared-memory batch
+            if len({img.shape for img in images}) == 1:
+                return model.infer_batch(images, conf=conf_threshold, size=size)
+            return [model.infer(img, conf=conf_threshold, size=size)[0] for img in images]
+        return detect_pool_batch
+
+    def detect_batch(images, size):
+        model.conf = conf_threshold
+        results = model(list(images), size=size)
+        return [results_to_array(results, i) for i in range(len(images))]
+    return detect_batch
+
+
+def cut_by_border(dets, window, width, height, margin=BORDER_MARGIN):
+    """(N,) bool array of the tile's boxes (tile coordinates) touching an edge shared with another tile"""
+    x1, y1, x2, y2 = window
+    return (((x1 > 0) & (dets[:, 0] <= margin)) | ((y1 > 0) & (dets[:, 1] <= margin)) |
+            ((x2 < width) & (dets[:, 2] >= x2 - x1 - margin)) | ((y2 < height) & (dets[:, 3] >= y2 - y1 - margin)))
+
+
+def intersection_over_smaller(box, boxes):
+    """Intersection of one box with each of boxes, over the smaller of the two areas"""
+    inter_w = np.clip(np.minimum(box[2], boxes[:, 2]) - np.maximum(box[0], boxes[:, 0]), 0, None)
+    inter_h = np.clip(np.minimum(box[3], boxes[:, 3]) - np.maximum(box[1], boxes[:, 1]), 0, None)
+    area = (box[2] - box[0]) * (box[3] - box[1])
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    return inter_w * inter_h / np.maximum(np.minimum(area, areas), 1e-9)
+
+
+def merge_cut_boxes(dets, cut, threshold=MERGE_THRESHOLD):
+    """Join each box cut by a tile border with the same-class boxes covering most of the smaller box
+
+    The joined box is the union of the parts with the highest confidence among them. Joining repeats
+    until nothing more overlaps, so an object spread over four tiles ends up as one box.
+    """
+    dets = dets.copy()
+    cut = cut.copy()
+    alive = np.ones(len(dets), dtype=bool)
+    for i in np.argsort(-dets[:, 4]):
+        if not alive[i]:
+            continue
+        while True:
+            others = np.where(alive & (dets[:, 5] == dets[i, 5]))[0]
+            others = others[others != i]
+            if not len(others):
+                break
+            overlap = intersection_over_smaller(dets[i], dets[others])
+            join = others[(overlap >= threshold) & (cut[others] | cut[i])]
+            if not len(join):
+                break
+            group = np.append(join, i)
+            dets[i, :2] = dets[group, :2].min(0)
+            dets[i, 2:4] = dets[group, 2:4].max(0)
+            dets[i, 4] = dets[group, 4].max()
+            cut[i] = True
+            alive[join] = False
+    return dets[alive]
+
+
+def tiled_detect(detect_batch, img, tile_size=640, overlap=0.2, full_frame_size=None, iou_threshold=0.45):
+    """Detect on overlapping tiles in one batch and merge the boxes in frame coordinates
+
+    When full_frame_size is set, an extra pass over the whole (downscaled) frame is merged in
+    so objects larger than a tile are still found. Returns (dets, tile_count).
+    """
+    height, width = img.shape[:2]
+    windows = tile_windows(width, height, tile_size, overlap)
+    tiles = [img[y1:y2, x1:x2] for x1, y1, x2, y2 in windows]
+
+    all_dets, all_cut = [], []
+    for window, dets in zip(windows, detect_batch(tiles, tile_size)):
+        if len(dets):
+            all_cut.append(cut_by_border(dets, window, width, height))
+            dets = dets.copy()
+            dets[:, [0, 2]] += window[0]
+            dets[:, [1, 3]] += window[1]
+            all_dets.append(dets)
+    if full_frame_size:
+        dets = detect_batch([img], full_frame_size)[0]
+        all_dets.append(dets)
+        all_cut.append(np.zeros(len(dets), dtype=bool))
+
+    if not all_dets:
+        return np.zeros((0, 6), dtype=np.float32), len(windows)
+    dets = merge_cut_boxes(np.concatenate(all_dets), np.concatenate(all_cut))
+    return class_nms(dets, iou_threshold), len(windows)
@@ -0,0 +1,268 @@
+"""Chunked, resumable video uploads that can be processed while they arrive
+
+Large CCTV exports are sent as a series of raw chunks instead of one
+multipart body:
+
+    POST  /uploads        {"filename": "...", "size": N}      -> {"upload_id", "offset": 0, ...}
+    PATCH /uploads/<id>   chunk bytes, Upload-Offset: <offset> -> {"offset", ...}
+    GET   /uploads/<id>                                       -> {"offset", "size", "complete", ...}
+
+Chunks are streamed to disk BLOCK_SIZE bytes at a time, so memory use does
+not depend on the chunk or file size. A chunk must start at the current
+offset (otherwise 409 with the offset to resume from). The offset is the
+file size on disk, so an interrupted upload resumes wherever it stopped,
+even across a server restart.
+
+While an upload is still running, open_source() hands the video pipeline a
+FIFO fed from the received prefix; the decoder simply blocks on it until
+more chunks arrive. MP4/MOV files whose index (moov box) comes after the
+media data cannot be decoded from a prefix, so those wait for the upload to
+finish first. An upload that stalls for STALL_TIMEOUT fails the job with an
+UploadError instead of having its truncated prefix processed as the video.
+"""
+import errno
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+UPLOAD_DIR = 'static/uploads'
+# Bytes read from the request body and written to disk (or the FIFO) at a time
+BLOCK_SIZE = 1 << 20
+# Chunk size suggested to clients
+CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_SIZE', 8 << 20))
+# Stop waiting for a stalled upload after this many seconds without new data
+STALL_TIMEOUT = float(os.environ.get('UPLOAD_STALL_TIMEOUT', 300))
+# Containers whose index may sit at the end of the file
+MP4_EXTENSIONS = ('.mp4', '.m4v', '.mov')
+# Number of finished uploads kept in memory (the rest are reloaded from disk on demand)
+MAX_TRACKED_UPLOADS = 100
+
+_UPLOAD_ID = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+_EXTENSION = re.compile(r'\.[A-Za-z0-9]{1,8}')
+
+
+class UploadError(Exception):
+    """A rejected upload request, with the HTTP status to answer with and the offset to resume from"""
+
+    def __init__(self, message, status=400, offset=None):
+        super().__init__(message)
+        self.status = status
+        self.offset = offset
+
+
+def moov_first(path):
+    """True if an MP4's index precedes its media data, False if not, None if the prefix is too short to tell"""
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return None
+            size = int.from_bytes(header[:4], 'big')
+            box = header[4:8]
+            if box == b'moov':
+                return True
+            if box == b'mdat':
+                return False
+            header_size = 8
+            if size == 1:
+                # 64-bit box size follows the type
+                large = f.read(8)
+                if len(large) < 8:
+                    return None
+                size = int.from_bytes(large, 'big')
+                header_size = 16
+            if size < header_size:
+                # Box runs to the end of the file (size 0) or the file is not an MP4
+                return False
+            f.seek(size - header_size, os.SEEK_CUR)
+
+
+class Upload:
+    """One chunked upload: a file growing on disk towards its declared size"""
+
+    def __init__(self, upload_id, filename, size):
+        self.upload_id = upload_id
+        self.filename = filename
+        self.size = size
+        extension = os.path.splitext(filename)[1]
+        self.extension = extension if _EXTENSION.fullmatch(extension) else '.mp4'
+        self.path = os.path.join(UPLOAD_DIR, upload_id + self.extension)
+        self.offset = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        self.updated = time.time()
+        # Set when the FIFO feeder gave up waiting, so the decoder saw a truncated video
+        self.stalled = False
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+
+    @property
+    def complete(self):
+        return self.offset >= self.size
+
+    def status(self):
+        return {
+            'upload_id': self.upload_id,
+            'filename': self.filename,
+            'size': self.size,
+            'offset': self.offset,
+            'complete': self.complete
+        }
+
+    def write(self, stream, offset, length=None):
+        """Append a chunk read from a file-like stream at the given offset; return the new offset"""
+        if not self._write_lock.acquire(blocking=False):
+            raise UploadError('Another chunk is being written', 409, self.offset)
+        try:
+            if offset != self.offset:
+                raise UploadError(f'Expected offset {self.offset}', 409, self.offset)
+            if length is not None and offset + length > self.size:
+                raise UploadError('Chunk runs past the declared size', 400, self.offset)
+            with open(self.path, 'ab') as f:
+                while not self.complete:
+                    block = stream.read(min(BLOCK_SIZE, self.size - self.offset))
+                    if not block:
+                        break
+                    f.write(block)
+                    # Flush every block so the FIFO feeder sees it straight away
+                    f.flush()
+                    with self._cond:
+                        self.offset += len(block)
+                        self.updated = time.time()
+                        self._cond.notify_all()
+        finally:
+            self._write_lock.release()
+        return self.offset
+
+    def wait(self, offset, timeout=STALL_TIMEOUT):
+        """Block until more than offset bytes have arrived or the upload is complete; False on a stall"""
+        with self._cond:
+            return self._cond.wait_for(lambda: self.offset > offset or self.complete, timeout)
+
+    def wait_complete(self):
+        """Block until the whole file has arrived (or the upload stalls)"""
+        while not self.complete:
+            if not self.wait(self.offset):
+                return False
+        return True
+
+    def stall_error(self):
+        """UploadError for a job whose upload stopped arriving before it was complete"""
+        return UploadError(f'Upload stalled at {self.offset} of {self.size} bytes', 408, self.offset)
+
+    def require_complete(self):
+        """Block until the whole file has arrived; raises UploadError if the upload stalls first"""
+        if not self.wait_complete():
+            raise self.stall_error()
+        return self.path
+
+    def _streamable(self):
+        """Whether the received prefix can be decoded, waiting for enough bytes to tell"""
+        if not hasattr(os, 'mkfifo'):
+            return False
+        if self.extension.lower() not in MP4_EXTENSIONS:
+            return True
+        while True:
+            moov = moov_first(self.path)
+            if moov is not None or self.complete:
+                return bool(moov)
+            if not self.wait(self.offset):
+                return False
+
+    def open_source(self):
+        """Path for the video decoder: the file once complete, else a FIFO fed while the upload runs"""
+        if self.complete or not self._streamable():
+            return self.require_complete()
+        fifo = os.path.join(tempfile.mkdtemp(prefix='upload-'), 'stream' + self.extension)
+        os.mkfifo(fifo)
+        self.stalled = False
+        threading.Thread(target=self._feed, args=(fifo,), name=f"upload-feed-{self.upload_id}", daemon=True).start()
+        return fifo
+
+    def _feed(self, fifo):
+        """Copy the received bytes into the FIFO, waiting for new chunks whenever the decoder catches up"""
+        try:
+            fd = _open_fifo_writer(fifo)
+            if fd is None:
+                return
+            with os.fdopen(fd, 'wb') as out, open(self.path, 'rb') as src:
+                position = 0
+                while True:
+                    block = src.read(BLOCK_SIZE)
+                    if block:
+                        out.write(block)
+                        position += len(block)
+                    elif self.complete and position >= self.offset:
+                        break
+                    elif not self.wait(position):
+                        print(f"Upload {self.upload_id} stalled after {position} bytes")
+                        self.stalled = True
+                        break
+        except BrokenPipeError:
+            # The decoder stopped reading
+            pass
+        finally:
+            shutil.rmtree(os.path.dirname(fifo), ignore_errors=True)
+
+
+def _open_fifo_writer(fifo, timeout=30.0):
+    """Open a FIFO for writing once the decoder has opened it for reading (None if it never does)"""
+    deadline = time.time() + timeout
+    while True:
+        try:
+            fd = os.open(fifo, os.O_WRONLY | os.O_NONBLOCK)
+            break
+        except OSError as e:
+            if e.errno != errno.ENXIO or time.time() > deadline:
+                return None
+            time.sleep(0.05)
+    os.set_blocking(fd, True)
+    return fd
+
+
+_uploads = {}
+_uploads_lock = threading.Lock()
+
+
+def _meta_path(upload_id):
+    return os.path.join(UPLOAD_DIR, upload_id + '.upload.json')
+
+
+def _track(upload):
+    """Keep an upload in memory, forgetting the oldest finished ones beyond MAX_TRACKED_UPLOADS"""
+    _uploads[upload.upload_id] = upload
+    for upload_id in [upload_id for upload_id, u in _uploads.items() if u.complete]:
+        if len(_uploads) <= MAX_TRACKED_UPLOADS:
+            break
+        del _uploads[upload_id]
+
+
+def create_upload(filename, size):
+    """Start a new upload of a file with the given name and total size in bytes"""
+    if size <= 0:
+        raise UploadError('size must be a positive number of bytes')
+    upload = Upload(str(uuid.uuid4()), os.path.basename(filename or ''), size)
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    open(upload.path, 'wb').close()
+    with open(_meta_path(upload.upload_id), 'w') as f:
+        json.dump({'filename': upload.filename, 'size': size}, f)
+    with _uploads_lock:
+        _track(upload)
+    return upload
+
+
+def get_upload(upload_id):
+    """Return an upload by id (reloading it from disk after a restart), or None if there is no such upload"""
+    if not _UPLOAD_ID.fullmatch(upload_id or ''):
+        return None
+    with _uploads_lock:
+        upload = _uploads.get(upload_id)
+        if upload is None and os.path.exists(_meta_path(upload_id)):
+            with open(_meta_path(upload_id)) as f:
+                meta = json.load(f)
+            upload = Upload(upload_id, meta['filename'], meta['size'])
+            _track(upload)
+        return upload
@@ -0,0 +1,268 @@
+"""Multi-process inference workers with shared-memory frame handoff
+
+Each worker process owns its own YOLOv5 model and a fixed torch thread budget,
+so N workers on a large box don't fight over the GIL or over intra-op threads.
+Frames are copied once into a shared-memory slot owned by the worker and read
+there as a NumPy view; only the small detection arrays travel through pipes.
+"""
+import atexit
+import multiprocessing as mp
+import os
+import queue
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# Initial size of each worker's frame slot (grown on demand for larger frames)
+DEFAULT_SLOT_BYTES = 1920 * 1080 * 3
+
+
+def _worker_main(worker_id, model_path, conf_threshold, iou_threshold, torch_threads, force_reload, optimize, conn):
+    """Worker process loop: read frames from shared memory, run the model, reply with detections"""
+    # Pin the native thread pools before torch is imported
+    os.environ['OMP_NUM_THREADS'] = str(torch_threads)
+    os.environ['MKL_NUM_THREADS'] = str(torch_threads)
+    import torch
+    from inference import load_yolo_model, results_to_array
+
+    torch.set_num_threads(torch_threads)
+    torch.set_num_interop_threads(1)
+
+    try:
+        model = load_yolo_model(model_path, conf_threshold, iou_threshold, force_reload=force_reload, optimize=optimize)
+    except Exception as e:
+        conn.send({'ready': False, 'error': str(e)})
+        return
+    conn.send({'ready': True, 'names': model.names})
+
+    shm = None
+    while True:
+        try:
+            msg = conn.recv()
+        except EOFError:
+            break
+        if msg is None:
+            break
+
+        # Re-attach when the parent has grown (replaced) this worker's slot
+        if shm is None or shm.name != msg['shm']:
+            if shm is not None:
+                shm.close()
+            # Spawned workers share the parent's resource tracker, so the parent's unlink covers this too
+            shm = shared_memory.SharedMemory(name=msg['shm'])
+
+        frame = np.ndarray(msg['shape'], dtype=msg['dtype'], buffer=shm.buf)
+        start_time = time.perf_counter()
+        try:
+            model.conf = msg['conf']
+            if frame.ndim == 4:
+                # A stacked batch of equally sized images (e.g. tiles) runs as one forward pass
+                results = model(list(frame), size=msg['size'])
+                dets = [results_to_array(results, i) for i in range(len(frame))]
+            else:
+                results = model(frame, size=msg['size'])
+                dets = results_to_array(results)
+            if msg['render'] and frame.ndim == 3:
+                # Write the annotated image back into the slot instead of pickling it
+                results.render()
+                np.copyto(frame, results.ims[0])
+            del results
+            conn.send({'dets': dets, 'inference_time': time.perf_counter() - start_time})
+        except Exception as e:
+            conn.send({'error': str(e), 'inference_time': time.perf_counter() - start_time})
+        finally:
+            del frame
+
+    if shm is not None:
+        shm.close()
+
+
+class _Worker:
+    """Parent-side handle on one worker process, its shared-memory slot and its stats"""
+
+    def __init__(self, worker_id, process, conn, shm):
+        self.worker_id = worker_id
+        self.process = process
+        self.conn = conn
+        self.shm = shm
+        self.busy = False
+        self.requests = 0
+        self.errors = 0
+        self.busy_time = 0.0
+        self.inference_time = 0.0
+        self.restarts = 0
+
+
+class InferencePool:
+    """Pool of inference worker processes fed through shared memory"""
+
+    def __init__(self, model_path, num_workers, conf_threshold=0.25, iou_threshold=0.45,
+                 torch_threads=None, slot_bytes=DEFAULT_SLOT_BYTES, force_reload=False, optimize=None):
+        self.model_path = model_path
+        self.num_workers = num_workers
+        self.conf_threshold = conf_threshold
+        self.iou_threshold = iou_threshold
+        self.torch_threads = torch_threads or max(1, (os.cpu_count() or 1) // num_workers)
+        self.slot_bytes = slot_bytes
+        self.optimize = optimize
+        self.names = None
+        self.started = time.time()
+        self.last_used = self.started
+        # Spawn (not fork) so workers never inherit a half-initialised torch runtime
+        self._ctx = mp.get_context('spawn')
+        self._idle = queue.Queue()
+        self._workers = []
+
+        # The first worker loads (and optionally refreshes) the hub cache; the rest reuse it concurrently
+        first = self._start_worker(0, force_reload=force_reload)
+        self._wait_ready(first)
+        rest = [self._start_worker(worker_id) for worker_id in range(1, num_workers)]
+        for worker in rest:
+            self._wait_ready(worker)
+        for worker in [first] + rest:
+            self._workers.append(worker)
+            self._idle.put(worker)
+
+        atexit.register(self.close)
+
+    def _start_worker(self, worker_id, force_reload=False, shm=None):
+        """Start one worker process with its own shared-memory slot"""
+        if shm is None:
+            shm = shared_memory.SharedMemory(create=True, size=self.slot_bytes)
+        parent_conn, child_conn = self._ctx.Pipe()
+        process = self._ctx.Process(
+            target=_worker_main,
+            args=(worker_id, self.model_path, self.conf_threshold, self.iou_threshold,
+                  self.torch_threads, force_reload, self.optimize, child_conn),
+            name=f"inference-worker-{worker_id}",
+            daemon=True
+        )
+        process.start()
+        child_conn.close()
+        return _Worker(worker_id, process, parent_conn, shm)
+
+    def _wait_ready(self, worker):
+        """Block until a worker has loaded its model"""
+        msg = worker.conn.recv()
+        if not msg['ready']:
+            raise RuntimeError(f"Inference worker {worker.worker_id} failed to load model: {msg['error']}")
+        self.names = msg['names']
+
+    def _restart(self, worker):
+        """Replace a dead worker process, keeping its slot and stats"""
+        worker.conn.close()
+        worker.process.join(timeout=1)
+        replacement = self._start_worker(worker.worker_id, shm=worker.shm)
+        self._wait_ready(replacement)
+        worker.process = replacement.process
+        worker.conn = replacement.conn
+        worker.restarts += 1
+
+    def _ensure_slot(self, worker, nbytes):
+        """Grow a worker's shared-memory slot if the frame does not fit"""
+        if worker.shm.size >= nbytes:
+            return
+        worker.shm.close()
+        worker.shm.unlink()
+        worker.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+
+    def infer(self, frame, conf=None, size=640, render=False):
+        """Run detection on one frame in the next idle worker
+
+        Returns (dets, rendered): an (N, 6) array of x1, y1, x2, y2, conf, cls and,
+        when render is set, a copy of the annotated frame (otherwise None).
+        """
+        return self._run(np.ascontiguousarray(frame), conf, size, render)
+
+    def infer_batch(self, images, conf=None, size=640):
+        """Run detection on equally sized images as one batch in the next idle worker
+
+        Returns one (N, 6) detection array per image.
+        """
+        dets, _ = self._run(np.stack(images), conf, size, False)
+        return dets
+
+    def _run(self, frame, conf, size, render):
+        """Copy a frame (or stacked batch) into an idle worker's slot and wait for its detections"""
+        worker = self._idle.get()
+        worker.busy = True
+        start_time = time.perf_counter()
+        slot = None
+        try:
+            self._ensure_slot(worker, frame.nbytes)
+            slot = np.ndarray(frame.shape, dtype=frame.dtype, buffer=worker.shm.buf)
+            np.copyto(slot, frame)
+            try:
+                worker.conn.send({
+                    'shm': worker.shm.name,
+                    'shape': frame.shape,
+                    'dtype': frame.dtype.str,
+                    'conf': self.conf_threshold if conf is None else conf,
+                    'size': size,
+                    'render': render
+                })
+                reply = worker.conn.recv()
+            except (EOFError, OSError, BrokenPipeError):
+                worker.errors += 1
+                self._restart(worker)
+                raise RuntimeError(f"Inference worker {worker.worker_id} died and was restarted")
+
+            worker.requests += 1
+            worker.inference_time += reply['inference_time']
+            if 'error' in reply:
+                worker.errors += 1
+                raise RuntimeError(reply['error'])
+
+            rendered = slot.copy() if render else None
+            return reply['dets'], rendered
+        finally:
+            # Drop the view so the slot can be closed or grown later
+            slot = None
+            worker.busy_time += time.perf_counter() - start_time
+            worker.busy = False
+            self.last_used = time.time()
+            self._idle.put(worker)
+
+    def idle_time(self):
+        """Seconds since the pool last finished a request (0 while any worker is busy)"""
+        if any(worker.busy for worker in self._workers):
+            return 0.0
+        return time.time() - self.last_used
+
+    def stats(self):
+        """Per-worker utilisation and request counters"""
+        uptime = max(time.time() - self.started, 1e-9)
+        stats = []
+        for worker in self._workers:
+            stats.append({
+                'worker': worker.worker_id,
+                'pid': worker.process.pid,
+                'alive': worker.process.is_alive(),
+                'busy': worker.busy,
+                'requests': worker.requests,
+                'errors': worker.errors,
+                'restarts': worker.restarts,
+                'utilisation': round(worker.busy_time / uptime, 4),
+                'avg_inference_ms': round(1000 * worker.inference_time / worker.requests, 2) if worker.requests else None,
+                'torch_threads': self.torch_threads,
+                'optimize': self.optimize,
+                'slot_bytes': worker.shm.size
+            })
+        return stats
+
+    def close(self):
+        """Stop the workers and release their shared memory"""
+        workers, self._workers = self._workers, []
+        for worker in workers:
+            try:
+                worker.conn.send(None)
+            except (OSError, BrokenPipeError):
+                pass
+        for worker in workers:
+            worker.process.join(timeout=5)
+            if worker.process.is_alive():
+                worker.process.terminate()
+            worker.conn.close()
+            worker.shm.close()
+            worker.shm.unlink()